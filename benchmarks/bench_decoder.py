@@ -0,0 +1,247 @@
+"""Microbenchmarks of the cutils decoder and the log_parse hot paths
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/bench_decoder.py --json before.json
+    PYTHONPATH=. python benchmarks/bench_decoder.py --json after.json --compare before.json
+
+Every case runs over a sweep of synthetic streams (1K to 10M accelerometer
+samples by default) covering all packet types and compressed widths, and
+records the best time of --repeat runs and the peak traced memory of one
+more run. Cases that build one Python object per log (convert) stop at
+--object-limit samples.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+
+from cutils.sensors.converter import (convert, convert_columnar, get_log_count, get_log_stats,
+                                      decompress_stream, _decompress_stream_scalar,
+                                      decompress_stream_parallel, StreamDecompressor, LogView)
+from cutils.sensors.features import accel_features
+from parsers.log_parse import stamp_log_file, get_accel_counts, activity_features
+from parsers.synthetic import synthetic_stream, write_data_file
+from parsers.cache import DecodeCache
+
+DEFAULT_SIZES = '1e3,1e4,1e5,1e6,1e7'
+FEED_CHUNK = 64 * 1024
+LOST_RATE = 0.02
+# samples per feature window, one minute at 20 ms
+FEATURE_WINDOW = 3000
+
+
+def _feed(stream):
+    decoder = StreamDecompressor()
+    for offset in range(0, len(stream), FEED_CHUNK):
+        decoder.feed(stream[offset:offset + FEED_CHUNK])
+    return decoder.bytes_out
+
+
+def _cached_stamp(fname):
+    """stamp_log_file through a cache next to the data file, every run but
+    the first is a warm call
+    """
+    return stamp_log_file(fname, cache=DecodeCache(os.path.join(os.path.dirname(fname), 'cache')))
+
+
+def _resample_features(fname):
+    """The pandas equivalent of activity_features, on the whole DataFrame
+    """
+    frame = stamp_log_file(fname)
+    vm = np.sqrt((frame.astype(float) ** 2).sum(axis=1))
+    moved = frame.diff().abs().max(axis=1)
+    features = frame.resample('60s').mean()
+    features['vm'] = vm.resample('60s').mean()
+    features['counts'] = vm.diff().abs().resample('60s').sum()
+    features['still'] = (moved.fillna(0) <= 1).resample('60s').mean()
+    return features
+
+
+class Inputs(object):
+    """Synthetic inputs of one size, generated once or read from the cache
+    """
+
+    def __init__(self, n_samples, work_dir, cache_dir=None):
+        self.n_samples = n_samples
+        self.work_dir = work_dir
+        self.cache_dir = cache_dir
+        self._data = {}
+
+    def _stream(self, name, **kwargs):
+        if name in self._data:
+            return self._data[name]
+        path = None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, '{}_{}.bin'.format(name, self.n_samples))
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self._data[name] = f.read()
+                return self._data[name]
+        stream = synthetic_stream(self.n_samples, **kwargs)
+        if path:
+            with open(path, 'wb') as f:
+                f.write(stream)
+        self._data[name] = stream
+        return stream
+
+    @property
+    def compressed(self):
+        return self._stream('compressed', compressed=True)
+
+    @property
+    def lost(self):
+        return self._stream('lost', compressed=True, lost=LOST_RATE)
+
+    @property
+    def raw(self):
+        return self._stream('raw', compressed=False)
+
+    @property
+    def decompressed(self):
+        if 'decompressed' not in self._data:
+            self._data['decompressed'] = decompress_stream(self.compressed)[0].tobytes()
+        return self._data['decompressed']
+
+    @property
+    def data_file(self):
+        fname = os.path.join(self.work_dir, 'WED_data_{}.dat'.format(self.n_samples))
+        if not os.path.exists(fname):
+            write_data_file(fname, self.compressed)
+        return fname
+
+
+# name, input, function, builds Python objects per log
+CASES = [
+    ('convert', 'decompressed', convert, True),
+    ('convert_columnar', 'decompressed', convert_columnar, False),
+    ('LogView', 'decompressed', LogView, False),
+    ('LogView.columnar', 'decompressed', lambda logs: LogView(logs).columnar(), False),
+    ('get_log_count', 'compressed', get_log_count, False),
+    ('get_log_stats', 'compressed', get_log_stats, False),
+    ('decompress_stream', 'compressed', decompress_stream, False),
+    ('decompress_stream_scalar', 'compressed', _decompress_stream_scalar, False),
+    ('decompress_stream_parallel', 'compressed', decompress_stream_parallel, False),
+    ('decompress_stream_lost', 'lost', decompress_stream, False),
+    ('decompress_stream_lost_scalar', 'lost', _decompress_stream_scalar, False),
+    ('decompress_stream_raw', 'raw', decompress_stream, False),
+    ('StreamDecompressor.feed', 'compressed', _feed, False),
+    ('stamp_log_file', 'data_file', stamp_log_file, False),
+    ('stamp_log_file.cached', 'data_file', _cached_stamp, False),
+    ('get_accel_counts', 'data_file', get_accel_counts, False),
+    ('accel_features', 'compressed', lambda logs: accel_features(logs, FEATURE_WINDOW), False),
+    ('stamp_log_file.resample', 'data_file', _resample_features, False),
+    ('activity_features', 'data_file', activity_features, False),
+]
+
+
+def measure(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    before = dict(((r['case'], r['samples']), r) for r in baseline['results'])
+    print("\nCompared to {} ({}):".format(baseline_file, baseline.get('revision')))
+    for r in results:
+        b = before.get((r['case'], r['samples']))
+        if b is None:
+            continue
+        print("{:<30} {:>9}  {:6.2f}x speed  {:6.2f}x memory".format(
+            r['case'], r['samples'], b['seconds'] / r['seconds'] if r['seconds'] else float('nan'),
+            r['peak_memory'] / b['peak_memory'] if b['peak_memory'] else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decoder microbenchmarks")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Comma separated sample counts")
+    parser.add_argument('--cases', help="Comma separated case names, all if not set")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--object-limit', dest='object_limit', type=float, default=1e6,
+                        help="Largest size for cases that build Python objects per log")
+    parser.add_argument('--cache', dest='cache_dir', help="Directory to keep the generated streams in")
+    parser.add_argument('--json', dest='json_out', help="Save the results to a JSON file")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    options = parser.parse_args()
+
+    sizes = [int(float(s)) for s in options.sizes.split(',')]
+    cases = CASES
+    if options.cases:
+        names = options.cases.split(',')
+        cases = [c for c in CASES if c[0] in names]
+    if options.cache_dir and not os.path.isdir(options.cache_dir):
+        os.makedirs(options.cache_dir)
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='wed_bench_')
+    try:
+        for n_samples in sizes:
+            inputs = Inputs(n_samples, work_dir, options.cache_dir)
+            for name, source, func, objects in cases:
+                if objects and n_samples > options.object_limit:
+                    continue
+                arg = getattr(inputs, source)
+                n_bytes = os.path.getsize(arg) if source == 'data_file' else len(arg)
+                seconds, peak = measure(func, arg, options.repeat)
+                result = {'case': name,
+                          'samples': n_samples,
+                          'bytes': n_bytes,
+                          'seconds': seconds,
+                          'samples_per_second': n_samples / seconds if seconds else None,
+                          'mb_per_second': n_bytes / seconds / 1e6 if seconds else None,
+                          'peak_memory': peak,
+                          }
+                results.append(result)
+                print("{case:<30} {samples:>9}  {seconds:9.5f} s  {samples_per_second:12.0f} samples/s  "
+                      "{mb_per_second:8.1f} MB/s  peak {peak_mb:8.1f} MB".format(
+                          peak_mb=peak / 1e6, **result))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'repeat': options.repeat,
+              'results': results,
+              }
+    if options.json_out:
+        with open(options.json_out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""End to end download benchmark against simulated Wavelet devices
+
+Run from the repository root, with the pylink directory on the path as for
+wed_tool:
+
+    PYTHONPATH=.:pylink python benchmarks/bench_download.py --devices 4
+    PYTHONPATH=.:pylink python benchmarks/bench_download.py --fleet 120 --devices 20
+
+Single device runs report logs/s, bytes/s and the CPU time of the download
+pipeline per device (the simulated radio thread is not counted). Fleet runs
+drive the scheduler of wed_tool for a fixed time and report devices/hour,
+--adapters spreads them over several simulated adapters.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+import yaml
+
+os.environ['WED_BACKEND'] = 'simulated'
+
+
+def simulator_config(options, path):
+    macs = ['00:00:00:00:{:02X}:{:02X}'.format(i // 256, i % 256) for i in range(options.devices)]
+    config = {'defaults': {'total_logs': options.logs,
+                           'rate': options.rate,
+                           'loss': options.loss,
+                           'disconnect': options.disconnect,
+                           'connect_time': options.connect_time,
+                           'connect_timeout': options.connect_timeout,
+                           },
+              'devices': {}}
+    adapters = adapter_names(options)
+    for i, mac in enumerate(macs):
+        # each device is close to one adapter and farther from the others
+        config['devices'][mac] = {'rssi': dict((a, -50 if j == i % len(adapters) else -70)
+                                               for j, a in enumerate(adapters)),
+                                  'in_range': i < len(macs) - options.absent}
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    os.environ['WED_SIMULATOR_CONFIG'] = path
+    return macs
+
+
+def adapter_names(options):
+    return ['hci{}'.format(i) for i in range(options.adapters)]
+
+
+def bench_devices(macs, options, data_dir):
+    from multiprocessing import Lock
+    from devices import DeviceInterface
+    from wed_settings import Commands
+
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for mac in macs:
+            device = DeviceInterface(mac, Commands.DOWNLOAD, Lock(), log_stream=devnull,
+                                     fname=os.path.join(data_dir, 'WED_data'), raw=options.raw,
+                                     min_logs=0, status_dict={}, data_format=options.data_format)
+            cpu = time.process_time()
+            wall = time.time()
+            device.run()
+            wall = time.time() - wall
+            requester = device.requester
+            cpu = time.process_time() - cpu - requester.stream_cpu
+            transfer = (requester.last_sent or 0) - (requester.first_sent or 0)
+            manifest = requester.manifest
+            result = {'device': mac,
+                      'logs': requester.log_count,
+                      'bytes': manifest.bytes if manifest else 0,
+                      'complete': requester.done,
+                      'lost_notifications': requester.lost,
+                      'transfer_seconds': transfer,
+                      'wall_seconds': wall,
+                      'cpu_seconds': cpu,
+                      'logs_per_second': requester.log_count / transfer if transfer > 0 else None,
+                      'bytes_per_second': manifest.bytes / transfer if manifest and transfer > 0 else None,
+                      }
+            results.append(result)
+            print("{device}  logs: {logs}  complete: {complete}  {transfer_seconds:.2f} s  "
+                  "cpu: {cpu_seconds:.2f} s  {logs_per_second:.0f} logs/s  {bytes_per_second:.0f} B/s".format(
+                      **dict(result, logs_per_second=result['logs_per_second'] or 0,
+                             bytes_per_second=result['bytes_per_second'] or 0)))
+            sys.stdout.flush()
+    return results
+
+
+def bench_fleet(macs, options, data_dir, log_dir):
+    from wed_tool import start_pool_polling, fleet_telemetry, device_state_store, presence_scanner
+    from adapters import AdapterPool
+    from wed_settings import Commands
+
+    pool_options = {'devices': macs,
+                    'scheduler': options.scheduler,
+                    'log_dir': log_dir,
+                    'metrics_json': os.path.join(log_dir, 'telemetry.jsonl'),
+                    'metrics_textfile': os.path.join(log_dir, 'wed.prom'),
+                    'state_db': os.path.join(log_dir, 'wed_state.db'),
+                    'adapters': [(a, options.max_process) for a in adapter_names(options)],
+                    'start_method': options.start_method,
+                    'presence_ttl': options.presence_ttl,
+                    'scan_seconds': 1,
+                    'scan_interval': 5,
+                    'timeout': 900,
+                    'max_retries': 3,
+                    'backoff': 0,
+                    'device_kwargs': {'command': Commands.DOWNLOAD,
+                                      'fname': os.path.join(data_dir, 'WED_data'),
+                                      'battery_warn': 20,
+                                      'raw': options.raw,
+                                      'min_logs': 0,
+                                      'data_format': options.data_format,
+                                      },
+                    }
+    timer = threading.Timer(options.fleet, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    if options.scheduler == 'polling':
+        # the legacy loop prints its own devices/hour and exits
+        try:
+            start_pool_polling(pool_options)
+        except SystemExit:
+            pass
+        return {'scheduler': 'polling', 'seconds': options.fleet}
+
+    from scheduler import FleetScheduler, worker_context
+    telemetry = fleet_telemetry(pool_options)
+    context = worker_context(options.start_method)
+    adapters = AdapterPool(pool_options['adapters'], context.Lock)
+    presence, scanner = presence_scanner(pool_options, adapters)
+    fleet = FleetScheduler(macs, adapters, log_dir,
+                           pool_options['device_kwargs'], telemetry=telemetry, mp_context=context,
+                           state_store=device_state_store(pool_options), presence=presence)
+    if scanner is not None:
+        scanner.start()
+    try:
+        fleet.run()
+    finally:
+        if scanner is not None:
+            scanner.stop()
+    print(telemetry.prometheus_text())
+    return {'scheduler': 'async',
+            'seconds': options.fleet,
+            'serviced': fleet.serviced,
+            'timed_out': fleet.timed_out,
+            'devices_per_hour': fleet.devices_per_hour,
+            'bytes': telemetry.bytes,
+            'logs': telemetry.logs,
+            'lock_wait_seconds': telemetry.lock_wait,
+            'lock_hold_seconds': telemetry.lock_hold,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download benchmark on simulated devices")
+    parser.add_argument('--devices', type=int, default=4, help="Number of simulated devices")
+    parser.add_argument('--logs', type=int, default=20000, help="Accelerometer samples per device")
+    parser.add_argument('--rate', type=float, default=0, help="Notifications per second, 0 for unlimited")
+    parser.add_argument('--loss', type=float, default=0.0, help="Probability of losing a notification")
+    parser.add_argument('--disconnect', type=float, default=0.0, help="Probability of a disconnect per download")
+    parser.add_argument('--connect-time', dest='connect_time', type=float, default=0.0,
+                        help="Seconds to connect to a device")
+    parser.add_argument('--connect-timeout', dest='connect_timeout', type=float, default=5.0,
+                        help="Seconds a connect to an out of range device takes to fail")
+    parser.add_argument('--absent', type=int, default=0, help="Number of devices out of range")
+    parser.add_argument('--presence-ttl', dest='presence_ttl', type=float, default=0,
+                        help="Only service devices seen by a scan in this many seconds, 0 to not scan")
+    parser.add_argument('--raw', action='store_true', help="Download raw instead of compressed logs")
+    parser.add_argument('--data-format', dest='data_format', type=int, choices=[1, 2], default=1,
+                        help="Data file format to write")
+    parser.add_argument('--fleet', type=float, help="Run the fleet scheduler for this many seconds")
+    parser.add_argument('--scheduler', choices=['async', 'polling'], default='async')
+    parser.add_argument('--max-process', dest='max_process', type=int, default=3, help="Processes per adapter")
+    parser.add_argument('--adapters', type=int, default=1, help="Number of simulated adapters")
+    parser.add_argument('--start-method', dest='start_method', default='forkserver',
+                        choices=['forkserver', 'fork', 'spawn'], help="How worker processes are started")
+    parser.add_argument('--json', dest='json_out', help="Save the results to a JSON file")
+    options = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='wed_bench_')
+    data_dir = os.path.join(work_dir, 'data')
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(data_dir)
+    os.makedirs(log_dir)
+    try:
+        macs = simulator_config(options, os.path.join(work_dir, 'simulator.yaml'))
+        report = {'options': vars(options)}
+        if options.fleet:
+            report['fleet'] = bench_fleet(macs, options, data_dir, log_dir)
+        else:
+            results = bench_devices(macs, options, data_dir)
+            report['devices'] = results
+            transfer = sum(r['transfer_seconds'] for r in results)
+            report['summary'] = {
+                'logs_per_second': sum(r['logs'] for r in results) / transfer if transfer else None,
+                'bytes_per_second': sum(r['bytes'] for r in results) / transfer if transfer else None,
+                'cpu_seconds_per_device': sum(r['cpu_seconds'] for r in results) / len(results),
+            }
+            print("Total: {logs_per_second:.0f} logs/s  {bytes_per_second:.0f} B/s  "
+                  "{cpu_seconds_per_device:.2f} cpu s/device".format(**report['summary']))
+        if options.json_out:
+            with open(options.json_out, 'w') as f:
+                json.dump(report, f, indent=1)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
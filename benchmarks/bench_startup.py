@@ -0,0 +1,134 @@
+"""Per device visit process startup benchmark
+
+Run from the repository root, with the pylink directory on the path as for
+wed_tool:
+
+    PYTHONPATH=.:pylink python benchmarks/bench_startup.py --visits 20
+
+A visit starts a worker and imports the download modules (devices and the
+BLE backend) in it, as start_command does. Reported per start method:
+`fork` and `spawn` start a new process per visit that imports everything
+again (the legacy polling scheduler), `forkserver` forks from a server that
+has preloaded scheduler.WORKER_PRELOAD (the async scheduler), and `pool`
+hands the visit to a long-lived worker, the lower bound. The simulated
+backend is used so gattlib is not needed.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('WED_BACKEND', 'simulated')
+
+# imported by a visit only if a module loads them eagerly
+HEAVY_MODULES = ['pandas', 'dateutil', 'pyprind', 'gattlib', 'numpy']
+
+
+def _visit():
+    from devices import DeviceInterface
+    return sorted(m for m in HEAVY_MODULES if m in sys.modules)
+
+
+def _process_visit(context):
+    start = time.perf_counter()
+    p = context.Process(target=_visit)
+    p.start()
+    p.join()
+    return time.perf_counter() - start
+
+
+def bench_process(method, visits):
+    from scheduler import worker_context
+    context = worker_context(method)
+    # the first visit also starts the fork server
+    first = _process_visit(context)
+    times = [_process_visit(context) for _ in range(visits)]
+    return first, times
+
+
+def bench_pool(visits):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        start = time.perf_counter()
+        executor.submit(_visit).result()
+        first = time.perf_counter() - start
+        times = []
+        for _ in range(visits):
+            start = time.perf_counter()
+            executor.submit(_visit).result()
+            times.append(time.perf_counter() - start)
+    return first, times
+
+
+def cold_import():
+    """Wall time of a fresh interpreter importing devices, and the heavy
+    modules that came with it
+    """
+    code = ("import sys, time; s = time.perf_counter(); import devices; e = time.perf_counter() - s; "
+            "print(e); print(','.join(m for m in {!r} if m in sys.modules))".format(HEAVY_MODULES))
+    start = time.perf_counter()
+    out = subprocess.check_output([sys.executable, '-c', code]).decode('ascii').splitlines()
+    wall = time.perf_counter() - start
+    return {'interpreter_seconds': wall,
+            'import_seconds': float(out[0]),
+            'heavy_modules': [m for m in out[1].split(',') if m]}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per visit worker startup benchmark")
+    parser.add_argument('--visits', type=int, default=20)
+    parser.add_argument('--methods', default='fork,spawn,forkserver,pool',
+                        help="Comma separated start methods")
+    parser.add_argument('--json', dest='json_out', help="Save the results to a JSON file")
+    options = parser.parse_args()
+
+    cold = cold_import()
+    print("import devices: {import_seconds:.3f} s, interpreter and import {interpreter_seconds:.3f} s, "
+          "heavy modules: {}".format(', '.join(cold['heavy_modules']) or 'none', **cold))
+
+    results = []
+    available = multiprocessing.get_all_start_methods() + ['pool']
+    for method in options.methods.split(','):
+        if method not in available:
+            print("{:<12} not available on this platform".format(method))
+            continue
+        if method == 'pool':
+            first, times = bench_pool(options.visits)
+        else:
+            first, times = bench_process(method, options.visits)
+        times.sort()
+        result = {'method': method,
+                  'first_seconds': first,
+                  'mean_seconds': sum(times) / len(times),
+                  'median_seconds': times[len(times) // 2],
+                  'visits': len(times),
+                  }
+        results.append(result)
+        print("{:<12} per visit {:8.1f} ms mean  {:8.1f} ms median  first {:8.1f} ms".format(
+            method, result['mean_seconds'] * 1000, result['median_seconds'] * 1000, first * 1000))
+        sys.stdout.flush()
+
+    if options.json_out:
+        with open(options.json_out, 'w') as f:
+            json.dump({'revision': git_revision(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cold_import': cold,
+                       'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
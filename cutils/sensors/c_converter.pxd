@@ -1,24 +1,29 @@
 
-from libc.stdint cimport uint8_t, uint32_t, int8_t, uint16_t, int16_t
+from libc.stdint cimport uint8_t, uint32_t, int8_t, uint16_t, int16_t, int64_t
+from cpython.bytes cimport PyBytes_FromStringAndSize
 
-cdef extern from "cmodules/sensor_parse.h":
+cdef extern from "cmodules/sensor_parse.h" nogil:
 
     cdef enum AMERR:
         AMERR_INVALID_PARAM          = -2
         AMERR_UNPROCESED_INPUT       = -3
         AMERR_INVALID_PACKET         = -4
         AMERR_INVALID_CMP_PACKET     = -5
+        AMERR_OUTPUT_OVERFLOW        = -6
 
     ctypedef enum WED_LOG_TYPE:
-        WED_LOG_TIME        = 0
-        WED_LOG_ACCEL       = 1
-        WED_LOG_LS_CONFIG   = 2
-        WED_LOG_LS_DATA     = 3
-        WED_LOG_TEMP        = 4
-        WED_LOG_TAG         = 5
-        WED_LOG_ACCEL_CMP   = 6
-        WED_LOG_COUNT       = 7
-        WED_LOG_EVENT       = 8
+        C_WED_LOG_TIME "WED_LOG_TIME"             = 0
+        C_WED_LOG_ACCEL "WED_LOG_ACCEL"           = 1
+        C_WED_LOG_LS_CONFIG "WED_LOG_LS_CONFIG"   = 2
+        C_WED_LOG_LS_DATA "WED_LOG_LS_DATA"       = 3
+        C_WED_LOG_TEMP "WED_LOG_TEMP"             = 4
+        C_WED_LOG_TAG "WED_LOG_TAG"               = 5
+        C_WED_LOG_ACCEL_CMP "WED_LOG_ACCEL_CMP"   = 6
+        C_WED_LOG_COUNT "WED_LOG_COUNT"           = 7
+        C_WED_LOG_EVENT "WED_LOG_EVENT"           = 8
+
+    cdef enum:
+        WED_LOG_TYPE_COUNT = 9
 
     ctypedef packed struct WEDLogTimestamp:
         uint8_t type
@@ -77,10 +82,40 @@ cdef extern from "cmodules/sensor_parse.h":
         amiigo_accel_t accel
         unsigned int ignored_cmp_count
 
+    ctypedef packed struct restart_point_t:
+        int in_offset
+        int out_offset
+        int sample
+        int64_t tick
+
     int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
 
+    int stream_decompress_scalar(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+
     int stream_len(const char * pInBuf, int * pnInLen, int * pnOutLen, const cmp_state_t * pState)
 
+    int stream_compress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+
+    int stream_type_counts(const char * pInBuf, int * pnInLen, int * pCounts)
+
+    int stream_restart_points(const char * pInBuf, int * pnInLen, restart_point_t * pPoints, int * pnPoints,
+                              int nMinSpacing, const cmp_state_t * pState)
+
     int get_packet_len(const char * pPayload)
 
     int get_compressed_log_count(const char * pPayload)
+
+
+# Chunk bytes copied to complete a packet split between two chunks, more
+#   than the longest packet
+cdef enum:
+    FEED_HEAD_BYTES = 32
+
+cdef inline bytes feed_head(bytes tail, const char * chunk, Py_ssize_t nChunk):
+    # the partial packet left by the previous chunk and the first bytes of
+    #   this one, the packet split between them is decoded from it
+    return tail + PyBytes_FromStringAndSize(chunk if nChunk else NULL, min(nChunk, FEED_HEAD_BYTES))
+
+cdef inline bytes feed_tail(const char * chunk, Py_ssize_t nChunk, Py_ssize_t used):
+    # the incomplete packet at the end of a chunk, kept for the next one
+    return PyBytes_FromStringAndSize(chunk + used if nChunk else NULL, nChunk - used)
@@ -1,5 +1,6 @@
 
 #include <errno.h>
+#include <limits.h>
 #include <stdlib.h>
 #include <stdint.h>
 #include <stdio.h>
@@ -7,6 +8,9 @@
 
 #include "sensor_parse.h"
 
+// Most output bytes of one packet, a compressed packet of 16 samples
+#define MAX_PACKET_OUT 64
+
 /******************************************************************************/
 typedef struct _get_bits {
     const uint8 * buf;
@@ -98,6 +102,10 @@ int stream_len(const char * pInBuf, int * pnInLen, int * pnOutLen, const cmp_sta
         if ((packet_len + payload) > buflen) {
             break;
         }
+        if (copied > INT_MAX - MAX_PACKET_OUT - packet_len) {
+            err = AMERR_OUTPUT_OVERFLOW;
+            break;
+        }
         switch (log_type) {
         default:
             copied += packet_len;
@@ -170,7 +178,41 @@ int8 decode_accel(int8 old_accel, int8 diff, uint8 nbits)
     return accel;
 }
 /******************************************************************************/
-int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+/*
+ * Decode the delta fields of a 3 to 6 bit compressed packet at once
+ *
+ * For these widths decode_accel reduces to a saturating add: without
+ * overflow the decoded diff always fits nbits, and an int8 overflow always
+ * needs more than 6 bits with old_accel and diff of the same sign.
+ */
+static inline void cmp_decode_batch(const uint8 * pdu, uint8 nbits, int field_count, int8 accel[3], uint8 * pOut)
+{
+    uint32_t acc = 0;
+    int accbits = 0;
+    const uint32_t mask = (1u << nbits) - 1;
+    const uint32_t sign = 1u << (nbits - 1);
+    int i, k;
+    for (k = 0; k < field_count; ++k) {
+        pOut[0] = WED_LOG_ACCEL;
+        for (i = 0; i < 3; ++i) {
+            if (accbits < nbits) {
+                acc = (acc << 8) | *pdu++;
+                accbits += 8;
+            }
+            accbits -= nbits;
+            int diff = (int)(((acc >> accbits) & mask) ^ sign) - (int)sign;
+            int v = accel[i] + diff;
+            v = v < -128 ? -128 : v;
+            v = v > 127 ? 127 : v;
+            accel[i] = (int8)v;
+            pOut[1 + i] = (uint8)v;
+        }
+        pOut += sizeof(WEDLogAccel);
+    }
+}
+/******************************************************************************/
+static int stream_decompress_impl(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen,
+                                  cmp_state_t * pState, int batch)
 {
     int err = 0;
     if (pInBuf == NULL || pnInLen == NULL || pOutBuf == NULL || pnOutLen == NULL || pState == NULL)
@@ -199,8 +241,11 @@ int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int *
             err = AMERR_INVALID_PACKET;
             break;
         }
-        if ((packet_len + payload) > buflen ||
-                (copied + packet_len) > nOutLen) {
+        if ((packet_len + payload) > buflen) {
+            break;
+        }
+        // compressed packets check their own (decompressed) output size
+        if (log_type != WED_LOG_ACCEL_CMP && (copied + packet_len) > nOutLen) {
             break;
         }
         int no_room = 0;
@@ -257,6 +302,9 @@ int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int *
                     memcpy(&pOutBuf[copied], &logAccel, sizeof(logAccel));
                     copied += sizeof(WEDLogAccel);
                 }
+            } else if (batch) {
+                cmp_decode_batch(pdu, nbits, field_count, logAccel.accel, (uint8 *)&pOutBuf[copied]);
+                copied += field_count * sizeof(WEDLogAccel);
             } else {
                 get_bits_t gb;
                 cmpGetBitsInit(&gb, pdu);
@@ -288,6 +336,17 @@ int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int *
     return err;
 }
 /******************************************************************************/
+int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+{
+    return stream_decompress_impl(pInBuf, pnInLen, pOutBuf, pnOutLen, pState, 1);
+}
+/******************************************************************************/
+// Field by field decoder through decode_accel, the reference for the batch one
+int stream_decompress_scalar(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+{
+    return stream_decompress_impl(pInBuf, pnInLen, pOutBuf, pnOutLen, pState, 0);
+}
+/******************************************************************************/
 int get_packet_len(const char * pPayload) {
     WED_LOG_TYPE log_type = pPayload[0] & WED_TAG_BITS;
     int packet_len = -1;
@@ -333,3 +392,268 @@ int get_compressed_log_count(const char * pPayload) {
     return (((uint8) pPayload[1]) & 0xF) + 1;
 }
 
+/******************************************************************************/
+int stream_type_counts(const char * pInBuf, int * pnInLen, int * pCounts)
+{
+    int err = 0;
+    if (pInBuf == NULL || pnInLen == NULL || pCounts == NULL)
+        return AMERR_INVALID_PARAM;
+    memset(pCounts, 0, sizeof(int) * WED_LOG_TYPE_COUNT);
+    if (*pnInLen <= 0) {
+        *pnInLen = 0;
+        return AMERR_INVALID_PARAM;
+    }
+
+    int buflen = *pnInLen;
+    int payload = 0;
+    while (payload < buflen) {
+        WED_LOG_TYPE log_type = pInBuf[payload] & WED_TAG_BITS;
+        int packet_len = get_packet_len(&pInBuf[payload]);
+        if (packet_len <= 0) {
+            err = AMERR_INVALID_PACKET;
+            break;
+        }
+        if ((packet_len + payload) > buflen)
+            break;
+        pCounts[log_type]++;
+        payload += packet_len;
+    } // end while(payload <
+
+    if (!err && *pnInLen != payload)
+        err = AMERR_UNPROCESED_INPUT;
+
+    *pnInLen = payload;
+    return err;
+}
+/******************************************************************************/
+int stream_restart_points(const char * pInBuf, int * pnInLen, restart_point_t * pPoints, int * pnPoints,
+                          int nMinSpacing, const cmp_state_t * pState)
+{
+    int err = 0;
+    if (pInBuf == NULL || pnInLen == NULL || pPoints == NULL || pnPoints == NULL || pState == NULL)
+        return AMERR_INVALID_PARAM;
+    int nMaxPoints = *pnPoints;
+    *pnPoints = 0;
+    if (*pnInLen <= 0) {
+        *pnInLen = 0;
+        return AMERR_INVALID_PARAM;
+    }
+    const WEDLogTimestamp * pTimestamp;
+    uint8_t field_count;
+    int nbits;
+
+    int bValid = pState->accel.bValid;
+    int buflen = *pnInLen;
+    int payload = 0;
+    int copied = 0;
+    int samples = 0;
+    int points = 0;
+    int last_point = 0;
+    int64_t tick = -1;
+    while (payload < buflen) {
+        WED_LOG_TYPE log_type = pInBuf[payload] & 0x0F;
+        int packet_len = get_packet_len(&pInBuf[payload]);
+        if (packet_len <= 0) {
+            err = AMERR_INVALID_PACKET;
+            break;
+        }
+        if ((packet_len + payload) > buflen) {
+            break;
+        }
+        if (copied > INT_MAX - MAX_PACKET_OUT - packet_len) {
+            err = AMERR_OUTPUT_OVERFLOW;
+            break;
+        }
+        // packets that fully reset the accel state, decoding can start there
+        int reset = 0;
+        int out_len = packet_len;
+        field_count = 0;
+        switch (log_type) {
+        default:
+            break;
+        case WED_LOG_TIME:
+            pTimestamp = (const WEDLogTimestamp *)&pInBuf[payload];
+            if (!(pTimestamp->flags & WED_TIME_FLAG_DEBUG))
+                tick = pTimestamp->timestamp;
+            break;
+        case WED_LOG_ACCEL:
+            reset = 1;
+            bValid = 1;
+            field_count = 1;
+            break;
+        case WED_LOG_ACCEL_CMP:
+            nbits = get_cmp_nbits(pInBuf[payload + 1]);
+            out_len = 0;
+            if (nbits < 0) {
+                err = AMERR_INVALID_CMP_PACKET;
+                break;
+            }
+            if (nbits == 8) {
+                reset = 1;
+                bValid = 1;
+            }
+            if (!bValid)
+                break;
+            field_count = (pInBuf[payload + 1] & 0xF) + 1;
+            out_len = field_count * sizeof(WEDLogAccel);
+            break;
+        } // end switch (log_type
+
+        if (reset && (points == 0 || payload - last_point >= nMinSpacing)) {
+            if (points >= nMaxPoints)
+                break;
+            pPoints[points].in_offset = payload;
+            pPoints[points].out_offset = copied;
+            pPoints[points].sample = samples;
+            pPoints[points].tick = tick;
+            last_point = payload;
+            points++;
+        }
+
+        copied += out_len;
+        samples += field_count;
+        payload += packet_len;
+    } // end while(payload <
+
+    *pnInLen = payload;
+    *pnPoints = points;
+    return err;
+}
+/******************************************************************************/
+// Most samples a compressed packet holds, per bits per axis (144 bits max)
+static const uint8 cmp_max_fields[9] = {0, 0, 0, 16, 12, 9, 8, 0, 6};
+static const uint8 cmp_encoding[9] = {0, 0, 0,
+    WED_LOG_ACCEL_CMP_3_BIT, WED_LOG_ACCEL_CMP_4_BIT, WED_LOG_ACCEL_CMP_5_BIT, WED_LOG_ACCEL_CMP_6_BIT,
+    0, WED_LOG_ACCEL_CMP_8_BIT};
+
+#define CMP_MAX_FIELDS 16
+#define CMP_STILL_BITS (0x80 | (WED_LOG_ACCEL_CMP_STILL << 4))
+
+static inline void cmpPutBits(uint8 * buf, unsigned int * pos, int8 val, uint8 nbits)
+{
+    unsigned int i;
+    for (i = 0; i < nbits; ++i) {
+        if ((val >> (nbits - 1 - i)) & 1)
+            buf[*pos >> 3] |= 0x80 >> (*pos & 7);
+        (*pos)++;
+    }
+}
+/******************************************************************************/
+int stream_compress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState)
+{
+    int err = 0;
+    if (pInBuf == NULL || pnInLen == NULL || pOutBuf == NULL || pnOutLen == NULL || pState == NULL)
+        return AMERR_INVALID_PARAM;
+    if (*pnInLen <= 0 || *pnOutLen <= 0) {
+        *pnInLen = 0;
+        *pnOutLen = 0;
+        return 0;
+    }
+    amiigo_accel_t * pAccel = &pState->accel;
+    int8 run[CMP_MAX_FIELDS][3];
+    uint8 width[CMP_MAX_FIELDS];
+    int i, k;
+    int buflen = *pnInLen;
+    int nOutLen = *pnOutLen;
+    int payload = 0;
+    int copied = 0;
+    while (payload < buflen) {
+        WED_LOG_TYPE log_type = pInBuf[payload] & 0x0F;
+        int packet_len = get_packet_len(&pInBuf[payload]);
+        if (packet_len <= 0) {
+            err = AMERR_INVALID_PACKET;
+            break;
+        }
+        if ((packet_len + payload) > buflen)
+            break;
+        if (log_type != WED_LOG_ACCEL) {
+            if (copied + packet_len > nOutLen)
+                break;
+            // the decoder state after a compressed packet is not tracked
+            if (log_type == WED_LOG_ACCEL_CMP)
+                pAccel->bValid = 0;
+            memcpy(&pOutBuf[copied], &pInBuf[payload], packet_len);
+            copied += packet_len;
+            payload += packet_len;
+            continue;
+        }
+
+        // look ahead at the run of uncompressed accel packets
+        int n = 0;
+        int offset = payload;
+        while (n < CMP_MAX_FIELDS && offset + (int)sizeof(WEDLogAccel) <= buflen &&
+               (pInBuf[offset] & 0x0F) == WED_LOG_ACCEL) {
+            int prev[3];
+            uint8 nbits = 0;
+            for (i = 0; i < 3; ++i) {
+                run[n][i] = pInBuf[offset + 1 + i];
+                prev[i] = n ? run[n - 1][i] : pAccel->accel[i];
+                uint8 b = cmpNbits((int16)(run[n][i] - prev[i]));
+                if (b > nbits)
+                    nbits = b;
+            }
+            width[n] = (!pAccel->bValid && n == 0) ? 8 : nbits;
+            n++;
+            offset += sizeof(WEDLogAccel);
+        }
+
+        // leading samples equal to the decoder state
+        int still = 0;
+        if (pAccel->bValid) {
+            while (still < n && run[still][0] == (still ? run[still - 1][0] : pAccel->accel[0]) &&
+                   run[still][1] == (still ? run[still - 1][1] : pAccel->accel[1]) &&
+                   run[still][2] == (still ? run[still - 1][2] : pAccel->accel[2]))
+                still++;
+        }
+
+        // pick the encoding with the fewest bytes per sample, STILL first
+        static const uint8 candidates[5] = {3, 4, 5, 6, 8};
+        uint8 best_bits = 0;
+        int best_count = still;
+        int best_len = 2;
+        for (k = 0; k < 5; ++k) {
+            uint8 bits = candidates[k];
+            int count = 0;
+            while (count < n && count < cmp_max_fields[bits] && (bits == 8 || width[count] <= bits))
+                count++;
+            if (!count)
+                continue;
+            int len = 2 + (count * 3 * bits - 1) / 8 + 1;
+            if (!best_count || len * best_count < best_len * count) {
+                best_bits = bits;
+                best_count = count;
+                best_len = len;
+            }
+        }
+
+        if (copied + best_len > nOutLen)
+            break;
+        uint8 * pdu = (uint8 *)&pOutBuf[copied];
+        pdu[0] = WED_LOG_ACCEL_CMP;
+        if (!best_bits) {
+            pdu[1] = CMP_STILL_BITS | (best_count - 1);
+        } else {
+            pdu[1] = (cmp_encoding[best_bits] << 4) | (best_count - 1);
+            memset(&pdu[2], 0, best_len - 2);
+            if (best_bits == 8) {
+                for (k = 0; k < best_count; ++k)
+                    for (i = 0; i < 3; ++i)
+                        pdu[2 + k * 3 + i] = run[k][i];
+            } else {
+                unsigned int pos = 0;
+                for (k = 0; k < best_count; ++k)
+                    for (i = 0; i < 3; ++i)
+                        cmpPutBits(&pdu[2], &pos, run[k][i] - (k ? run[k - 1][i] : pAccel->accel[i]), best_bits);
+            }
+        }
+        for (i = 0; i < 3; ++i)
+            pAccel->accel[i] = run[best_count - 1][i];
+        pAccel->bValid = 1;
+        copied += best_len;
+        payload += best_count * sizeof(WEDLogAccel);
+    } // end while(payload <
+
+    *pnInLen = payload;
+    *pnOutLen = copied;
+    return err;
+}
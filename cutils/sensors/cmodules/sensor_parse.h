@@ -38,6 +38,7 @@ extern "C" {
 #define AMERR_UNPROCESED_INPUT       -3 // Some input not processed due to error
 #define AMERR_INVALID_PACKET         -4 // Invalid or unknown packet
 #define AMERR_INVALID_CMP_PACKET     -5 // Invalid compressed packet
+#define AMERR_OUTPUT_OVERFLOW        -6 // Output longer than an int can count
 
 
 typedef enum {
@@ -52,6 +53,8 @@ typedef enum {
     WED_LOG_EVENT,
 } WED_LOG_TYPE;
 
+#define WED_LOG_TYPE_COUNT (WED_LOG_EVENT + 1)
+
 
 typedef struct {
     uint8 type; // WED_LOG_TIME
@@ -59,6 +62,8 @@ typedef struct {
     uint8 flags;
 } PACKED WEDLogTimestamp;
 
+#define WED_TIME_FLAG_DEBUG 0x10
+
 typedef struct {
     uint8 type; // WED_LOG_ACCEL
     int8 accel[3];
@@ -157,6 +162,13 @@ typedef struct _cmp_state {
     unsigned int ignored_cmp_count;
 } cmp_state_t;
 
+typedef struct _restart_point {
+    int in_offset;  // offset of the resetting packet in the compressed stream
+    int out_offset; // offset of its first sample in the decompressed stream
+    int sample;     // number of accel samples before it
+    int64_t tick;   // last WED_LOG_TIME ticks before it, -1 if none
+} PACKED restart_point_t;
+
 
 #ifdef __cplusplus
 }
@@ -168,6 +180,15 @@ int get_compressed_log_count(const char * pPayload);
 
 int stream_decompress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState);
 
+int stream_decompress_scalar(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState);
+
 int stream_len(const char * pInBuf, int * pnInLen, int * pnOutLen, const cmp_state_t * pState);
 
+int stream_compress(const char * pInBuf, int * pnInLen, char * pOutBuf, int * pnOutLen, cmp_state_t * pState);
+
+int stream_type_counts(const char * pInBuf, int * pnInLen, int * pCounts);
+
+int stream_restart_points(const char * pInBuf, int * pnInLen, restart_point_t * pPoints, int * pnPoints,
+                          int nMinSpacing, const cmp_state_t * pState);
+
 #endif // include guard
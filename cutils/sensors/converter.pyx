@@ -1,9 +1,17 @@
-
-from c_converter cimport *
+# cython: language_level=2
+from cutils.sensors.c_converter cimport *
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 cimport numpy as np
 cimport cython
+from libc.string cimport memcpy
+from libc.limits cimport INT_MAX
+
 
+# Bumped whenever the output of the decoder changes, caches of decoded
+#   logs (parsers.cache) are keyed on it
+DECODER_VERSION = 1
 
 # intentionally do not add __cinit__ to reduce overhead
 
@@ -12,6 +20,22 @@ FLAG_SLEEP = 0x02
 FLAG_DEBUG = 0x10
 FLAG_REBOOT = 0x80
 
+# Packet types (WED_LOG_TYPE of sensor_parse.h) as Python names, cdef code
+#   uses the C_WED_LOG_* constants of c_converter.pxd
+WED_LOG_TIME = C_WED_LOG_TIME
+WED_LOG_ACCEL = C_WED_LOG_ACCEL
+WED_LOG_LS_CONFIG = C_WED_LOG_LS_CONFIG
+WED_LOG_LS_DATA = C_WED_LOG_LS_DATA
+WED_LOG_TEMP = C_WED_LOG_TEMP
+WED_LOG_TAG = C_WED_LOG_TAG
+WED_LOG_ACCEL_CMP = C_WED_LOG_ACCEL_CMP
+WED_LOG_COUNT = C_WED_LOG_COUNT
+WED_LOG_EVENT = C_WED_LOG_EVENT
+
+# Error of scan_restart_points when the decompressed stream gets longer than
+#   an int counts, the stream has to be decoded in segments
+ERR_OUTPUT_OVERFLOW = <int>AMERR_OUTPUT_OVERFLOW
+
 cdef class TimestampSensorLog:
     cdef public:
         uint32_t timestamp
@@ -363,7 +387,7 @@ cdef get_packet(const char * log):
     pk_type = log[0] & WED_TAG_BITS
 
     cdef WEDLogTimestamp *p_ts
-    if pk_type == WED_LOG_TIME:
+    if pk_type == C_WED_LOG_TIME:
         p_ts = <WEDLogTimestamp *>&log[0]
         pkt = TimestampSensorLog()
         pkt.timestamp = p_ts.timestamp
@@ -371,7 +395,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogAccel *p_accel
-    if pk_type == WED_LOG_ACCEL:
+    if pk_type == C_WED_LOG_ACCEL:
         p_accel = <WEDLogAccel *>&log[0]
         pkt = AccelerometerSensorLog()
         pkt.x = p_accel.accel[0]
@@ -380,7 +404,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogAccelCmp *p_accel_cmp
-    if pk_type == WED_LOG_ACCEL_CMP:
+    if pk_type == C_WED_LOG_ACCEL_CMP:
         p_accel_cmp = <WEDLogAccelCmp *>&log[0]
         pkt = AccelerometerCompressedSensorLog()
         pkt.count_bits = p_accel_cmp.count_bits
@@ -390,7 +414,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogLSConfig *p_ls_conf
-    if pk_type == WED_LOG_LS_CONFIG:
+    if pk_type == C_WED_LOG_LS_CONFIG:
         p_ls_conf = <WEDLogLSConfig *>&log[0]
         pkt = LightSensorConfigLog()
         pkt.dac_on = p_ls_conf.dac_on
@@ -401,7 +425,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogLSData *p_ls
-    if pk_type == WED_LOG_LS_DATA:
+    if pk_type == C_WED_LOG_LS_DATA:
         p_ls = <WEDLogLSData *>&log[0]
         pkt = LightSensorLog()
         pkt.flags = (log[0] & 0xE0) >> 5
@@ -414,7 +438,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogTemp *p_temp
-    if pk_type == WED_LOG_TEMP:
+    if pk_type == C_WED_LOG_TEMP:
         p_temp = <WEDLogTemp *>&log[0]
         pkt = TemperatureSensorLog()
         pkt.temperature = p_temp.temperature
@@ -422,7 +446,7 @@ cdef get_packet(const char * log):
 
     cdef uint32_t tag
     cdef WEDLogTag *p_tag
-    if pk_type == WED_LOG_TAG:
+    if pk_type == C_WED_LOG_TAG:
         p_tag = <WEDLogTag *>&log[0]
         pkt = TagLog()
         tag = (
@@ -435,7 +459,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogCount * p_cnt
-    if pk_type == WED_LOG_COUNT:
+    if pk_type == C_WED_LOG_COUNT:
         p_cnt = <WEDLogCount *>&log[0]
         pkt = LogCount()
         pkt.log_timestamp = p_cnt.log_timestamp
@@ -445,7 +469,7 @@ cdef get_packet(const char * log):
         return pkt
 
     cdef WEDLogEvent * p_ev
-    if pk_type == WED_LOG_COUNT:
+    if pk_type == C_WED_LOG_EVENT:
         p_ev = <WEDLogEvent *>&log[0]
         pkt = EventLog()
         pkt.flags = p_ev.flags
@@ -453,32 +477,51 @@ cdef get_packet(const char * log):
 
     raise ValueError('Unknown packet of type %d' % pk_type)
 
+cdef const uint8_t[::1] byte_view(logs):
+    # zero-copy view of bytes, bytearray, memoryview, mmap or uint8 arrays
+    if isinstance(logs, np.ndarray):
+        logs = logs.reshape(-1).view(np.uint8)
+    return logs
+
+cdef int stream_length(Py_ssize_t length) except -1:
+    # the C functions count bytes in an int, longer streams are decoded in
+    #   segments (see parsers.data_file)
+    if length > INT_MAX:
+        raise OverflowError("Stream of %d bytes, at most %d per call" % (length, INT_MAX))
+    return <int>length
+
+cdef int check_stream(int res) except -1:
+    # error of a length pass, an incomplete last packet is not one
+    if res == AMERR_OUTPUT_OVERFLOW:
+        raise OverflowError("Decompressed stream longer than %d bytes" % INT_MAX)
+    if res < 0 and res != AMERR_UNPROCESED_INPUT:
+        raise RuntimeError("Invalid stream (%d)" % res)
+    return 0
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def convert(logs_str not None, ignore_unknown=True):
     """
     Separate stream into chunks
-    :param logs_str:      byte stream of logs (uncompressed)
+    :param logs_str:      byte stream of logs (uncompressed), any contiguous buffer
     :return:              list of Python objects for logs
     """
     converted = []
-    if not logs_str:
-        return converted
-
-    data_len = len(logs_str)
+    cdef const uint8_t[::1] view = byte_view(logs_str)
+    cdef Py_ssize_t data_len = view.shape[0]
     if data_len < 2:
         return converted
 
-    cdef char* logs = logs_str
+    cdef const char* logs = <const char *>&view[0]
 
-    cdef int count = 0
+    cdef Py_ssize_t count = 0
 
     while count < data_len:
         packet_len = get_packet_len(<const char *>&logs[count])
         if count + packet_len > data_len:
             break
         pk_type = logs[count] & WED_TAG_BITS
-        if ignore_unknown and (pk_type < 0 or pk_type > WED_LOG_EVENT):
+        if ignore_unknown and (pk_type < 0 or pk_type > C_WED_LOG_EVENT):
             break
         converted.append(get_packet(<const char *>&logs[count]))
         count = count + packet_len
@@ -489,30 +532,27 @@ def convert(logs_str not None, ignore_unknown=True):
 def get_log_count(logs_str not None, ignore_unknown=True):
     """
     Return number of logs in a log stream
-    :param logs_str:      byte stream of logs (compressed or uncompressed)
+    :param logs_str:      byte stream of logs (compressed or uncompressed), any contiguous buffer
     :return:              number of logs in the byte stream
     """
-
-    if not logs_str:
-        return 0
-
-    data_len = len(logs_str)
+    cdef const uint8_t[::1] view = byte_view(logs_str)
+    cdef Py_ssize_t data_len = view.shape[0]
     if data_len < 2:
         return 0
 
-    cdef char* logs = logs_str
+    cdef const char* logs = <const char *>&view[0]
 
-    cdef int count = 0
-    cdef int total_logs = 0
+    cdef Py_ssize_t count = 0
+    cdef long long total_logs = 0
 
     while count < data_len:
         packet_len = get_packet_len(<const char *>&logs[count])
         if count + packet_len > data_len:
             break
         pk_type = logs[count] & WED_TAG_BITS
-        if ignore_unknown and (pk_type < 0 or pk_type > WED_LOG_EVENT):
+        if ignore_unknown and (pk_type < 0 or pk_type > C_WED_LOG_EVENT):
             break
-        if pk_type == WED_LOG_ACCEL_CMP:
+        if pk_type == C_WED_LOG_ACCEL_CMP:
             total_logs += get_compressed_log_count(<const char *>&logs[count])
         else:
             total_logs += 1
@@ -521,33 +561,845 @@ def get_log_count(logs_str not None, ignore_unknown=True):
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def decompress_stream(logs not None):
+def get_log_stats(logs_str not None, ignore_unknown=True):
+    """
+    Return log counts and time range of a log stream in one pass
+    :param logs_str:      byte stream of logs (compressed or uncompressed)
+    :return:              (total logs, accelerometer logs,
+                           first timestamp ticks, last timestamp ticks),
+                          timestamps are None if there is no timestamp log
+    """
+    cdef const uint8_t[::1] view = byte_view(logs_str)
+    cdef Py_ssize_t data_len = view.shape[0]
+    if data_len < 2:
+        return 0, 0, None, None
+
+    cdef const char* logs = <const char *>&view[0]
+
+    cdef Py_ssize_t count = 0
+    cdef int packet_len
+    cdef int pk_type
+    cdef int n
+    cdef long long total_logs = 0
+    cdef long long accel_logs = 0
+    cdef long long first_timestamp = -1
+    cdef long long last_timestamp = -1
+    cdef WEDLogTimestamp *p_ts
+
+    while count < data_len:
+        packet_len = get_packet_len(<const char *>&logs[count])
+        if packet_len <= 0 or count + packet_len > data_len:
+            break
+        pk_type = logs[count] & WED_TAG_BITS
+        if ignore_unknown and (pk_type < 0 or pk_type > C_WED_LOG_EVENT):
+            break
+        if pk_type == C_WED_LOG_ACCEL_CMP:
+            n = get_compressed_log_count(<const char *>&logs[count])
+            total_logs += n
+            accel_logs += n
+        else:
+            total_logs += 1
+            if pk_type == C_WED_LOG_ACCEL:
+                accel_logs += 1
+            elif pk_type == C_WED_LOG_TIME:
+                p_ts = <WEDLogTimestamp *>&logs[count]
+                if not p_ts.flags & FLAG_DEBUG:
+                    last_timestamp = p_ts.timestamp
+                    if first_timestamp < 0:
+                        first_timestamp = last_timestamp
+        count = count + packet_len
+    return (total_logs, accel_logs,
+            first_timestamp if first_timestamp >= 0 else None,
+            last_timestamp if last_timestamp >= 0 else None)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef np.uint8_t[::1] output_view(out, int nOutLen):
+    # writable view of the caller's output buffer, or a new array
+    if out is None:
+        return np.empty(nOutLen, dtype=np.uint8)
+    if isinstance(out, np.ndarray):
+        out = out.reshape(-1).view(np.uint8)
+    cdef np.uint8_t[::1] outBuf = out
+    if outBuf.shape[0] < nOutLen:
+        raise ValueError("Output buffer too small, %d bytes needed" % nOutLen)
+    return outBuf[:nOutLen]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _decompress(logs, bint batch, out=None):
+
+    cdef const np.uint8_t[::1] inBuf = byte_view(logs)
+
+    cdef int res
+    cdef int nInLen = stream_length(inBuf.shape[0])
+    cdef int nOutLen = 0
+    cdef cmp_state_t state
+    state.accel.bValid = 0
+    state.ignored_cmp_count = 0
+    if nInLen > 0:
+        with nogil:
+            res = stream_len(<const char *>&inBuf[0], &nInLen, &nOutLen, &state)
+    else:
+        res = AMERR_INVALID_PARAM
+    # In case of invalid packet, go ahead and decompress valid ones
+    check_stream(res)
+    if nInLen == 0:
+        raise RuntimeError("Empty input stream")
+    cdef np.uint8_t[::1] outBuf = output_view(out, nOutLen)
+    if nOutLen > 0:
+        with nogil:
+            if batch:
+                res = stream_decompress(<const char *>&inBuf[0], &nInLen, <char *>&outBuf[0], &nOutLen, &state)
+            else:
+                res = stream_decompress_scalar(<const char *>&inBuf[0], &nInLen, <char *>&outBuf[0], &nOutLen, &state)
+        if res < 0:
+            raise RuntimeError("Decompression error or invalid packet (%d)" % res)
+
+    return np.asarray(outBuf), nInLen, state.ignored_cmp_count
+
+def decompress_stream(logs not None, out=None):
     '''Decompress stream
     Inputs:
-        logs - byte stream of logs (potentially compressed)
+        logs - byte stream of logs (potentially compressed), any contiguous buffer
+        out - writable buffer to decompress into instead of a new array,
+              at least decompressed_size(logs) bytes
     Outputs:
-        outBuf - decompressed byte array
+        outBuf - decompressed byte array, a view of out if given
+    '''
+    return _decompress(logs, True, out)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def decompressed_size(logs not None):
+    '''Size in bytes of the decompressed stream, to size the out buffer of
+    decompress_stream
+    '''
+    cdef const np.uint8_t[::1] inBuf = byte_view(logs)
+    cdef int res
+    cdef int nInLen = stream_length(inBuf.shape[0])
+    cdef int nOutLen = 0
+    cdef cmp_state_t state
+    state.accel.bValid = 0
+    state.ignored_cmp_count = 0
+    if nInLen == 0:
+        return 0
+    with nogil:
+        res = stream_len(<const char *>&inBuf[0], &nInLen, &nOutLen, &state)
+    check_stream(res)
+    return nOutLen
+
+def _decompress_stream_scalar(logs not None):
+    '''decompress_stream through the field by field decoder, for testing and
+    benchmarking the batch decoder against
     '''
+    return _decompress(logs, False)
 
-    cdef np.uint8_t[:] inBuf
-    inBuf = np.ascontiguousarray(logs, dtype=np.uint8)
+# Input bytes below which decompress_stream_parallel decodes serially
+PARALLEL_MIN_SEGMENT = 1 << 20
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _decompress_segment(const np.uint8_t[::1] inBuf not None, np.uint8_t[::1] outBuf not None,
+                        int in_start, int in_end, int out_start, int out_end):
+    '''Decode one segment starting at a restart point into its slice of the
+    output, without the GIL
+    '''
+    cdef int res = 0
+    cdef int nInLen = in_end - in_start
+    cdef int nOutLen = out_end - out_start
+    cdef cmp_state_t state
+    state.accel.bValid = 0
+    state.ignored_cmp_count = 0
+    if nInLen > 0 and nOutLen > 0:
+        with nogil:
+            res = stream_decompress(<const char *>&inBuf[in_start], &nInLen,
+                                    <char *>&outBuf[out_start], &nOutLen, &state)
+    return res, nInLen, nOutLen, state.ignored_cmp_count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def decompress_stream_parallel(logs not None, int workers=0, int min_segment=PARALLEL_MIN_SEGMENT, out=None):
+    '''Decompress stream on several threads, same output as decompress_stream
+    Inputs:
+        logs - byte stream of logs (potentially compressed), any contiguous buffer
+        workers - number of threads, number of CPUs if 0
+        min_segment - minimum input bytes decoded by one thread
+        out - writable buffer to decompress into instead of a new array
+    Outputs:
+        outBuf - decompressed byte array
+    '''
+    cdef const np.uint8_t[::1] inBuf = byte_view(logs)
+    cdef int nInLen = stream_length(inBuf.shape[0])
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    if workers == 1 or nInLen < 2 * min_segment:
+        return decompress_stream(logs, out)
 
     cdef int res
-    cdef int nInLen = len(inBuf)
-    cdef int nOutLen
+    cdef int nOutLen = 0
     cdef cmp_state_t state
     state.accel.bValid = 0
     state.ignored_cmp_count = 0
-    res = stream_len(<const char *>&inBuf[0], &nInLen, &nOutLen, &state)
-    # In case of invalid packet, go ahead and decompress valid ones
-    if res < 0 and res != AMERR_UNPROCESED_INPUT:
-        raise RuntimeError("Invalid stream (%d)" % res)
+    with nogil:
+        res = stream_len(<const char *>&inBuf[0], &nInLen, &nOutLen, &state)
+    check_stream(res)
     if nInLen == 0:
         raise RuntimeError("Empty input stream")
-    cdef np.uint8_t[:] outBuf = np.zeros(nOutLen, dtype=np.uint8)
-    if nOutLen > 0:
-        res = stream_decompress(<const char *>&inBuf[0], &nInLen, <char *>&outBuf[0], &nOutLen, &state)
-        if res < 0:
+
+    # a few segments per thread to even out the load, each one starts
+    #   at a packet that fully resets the decompression state
+    points = restart_points(inBuf[:nInLen], max(min_segment, nInLen // (4 * workers)))
+    in_offsets = [0] + [int(p) for p in points['in_offset'] if p > 0] + [nInLen]
+    out_offsets = [0] + [int(p['out_offset']) for p in points if p['in_offset'] > 0] + [nOutLen]
+
+    cdef int n_segments = len(in_offsets) - 1
+    cdef np.uint8_t[::1] outBuf = output_view(out, nOutLen)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_decompress_segment, [inBuf] * n_segments, [outBuf] * n_segments,
+                                    in_offsets[:n_segments], in_offsets[1:],
+                                    out_offsets[:n_segments], out_offsets[1:]))
+    ignored = 0
+    for i, (res, n_in, n_out, n_ignored) in enumerate(results):
+        if res < 0 or n_in != in_offsets[i + 1] - in_offsets[i] or n_out != out_offsets[i + 1] - out_offsets[i]:
             raise RuntimeError("Decompression error or invalid packet (%d)" % res)
+        ignored += n_ignored
+
+    return np.asarray(outBuf), nInLen, ignored
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def compress_stream(logs not None):
+    '''Compress the uncompressed accelerometer logs of a stream
+    Inputs:
+        logs - byte stream of logs, any contiguous buffer
+    Outputs:
+        outBuf - compressed byte array, decompress_stream restores the input
+        nInLen - number of input bytes compressed
+    '''
+    cdef const np.uint8_t[::1] inBuf = byte_view(logs)
+
+    cdef int res = 0
+    # a lone 8-bit sample is the worst case, 5 bytes for 4
+    cdef int nOutLen = stream_length(inBuf.shape[0] + inBuf.shape[0] // 4 + 8)
+    cdef int nInLen = stream_length(inBuf.shape[0])
+    cdef cmp_state_t state
+    state.accel.bValid = 0
+    state.ignored_cmp_count = 0
+    cdef np.uint8_t[:] outBuf = np.empty(nOutLen, dtype=np.uint8)
+    if nInLen > 0:
+        with nogil:
+            res = stream_compress(<const char *>&inBuf[0], &nInLen, <char *>&outBuf[0], &nOutLen, &state)
+    else:
+        nOutLen = 0
+    check_stream(res)
+
+    return np.asarray(outBuf)[:nOutLen].copy(), nInLen
+
+RESTART_DTYPE = np.dtype([
+    ('in_offset', np.int32), ('out_offset', np.int32),
+    ('sample', np.int32), ('tick', np.int64),
+])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def scan_restart_points(logs not None, int min_spacing=0):
+    '''Find the packets where decompression can restart with a fresh state,
+    up to the end of the stream or its first invalid packet
+    Inputs:
+        logs - byte stream of logs (potentially compressed), any contiguous buffer
+        min_spacing - minimum distance in bytes between two restart points
+    Outputs:
+        points - RESTART_DTYPE array of input/output offsets, the number of
+                 accel samples before each point and the last ticks seen
+        nInLen - number of input bytes scanned, the scan stops at a packet of
+                 unknown type or an incomplete last packet
+        res - 0 or the (negative) error of the first invalid packet
+    '''
+    cdef const np.uint8_t[::1] inBuf = byte_view(logs)
+    cdef int nInLen = stream_length(inBuf.shape[0])
+    cdef int nPoints = nInLen // max(min_spacing, <int>sizeof(WEDLogAccel)) + 1
+    cdef cmp_state_t state
+    state.accel.bValid = 0
+    state.ignored_cmp_count = 0
+    points = np.empty(nPoints, dtype=RESTART_DTYPE)
+    if nInLen == 0:
+        return points[:0], 0, 0
+
+    cdef int res
+    cdef restart_point_t * pPoints = <restart_point_t *>np.PyArray_BYTES(points)
+    with nogil:
+        res = stream_restart_points(<const char *>&inBuf[0], &nInLen, pPoints, &nPoints, min_spacing, &state)
+    if res == AMERR_UNPROCESED_INPUT:
+        res = 0
+    return points[:nPoints].copy(), nInLen, res
+
+
+def restart_points(logs not None, int min_spacing=0):
+    '''Find the packets where decompression can restart with a fresh state
+    Inputs:
+        logs - byte stream of logs (potentially compressed), any contiguous buffer
+        min_spacing - minimum distance in bytes between two restart points
+    Outputs:
+        points - RESTART_DTYPE array of input/output offsets, the number of
+                 accel samples before each point and the last ticks seen
+    '''
+    points, nInLen, res = scan_restart_points(logs, min_spacing)
+    check_stream(res)
+    return points
+
+# Row layouts of the columnar output, every row carries the packet index
+#   so the original stream order can be rebuilt from the separate arrays
+TIMESTAMP_DTYPE = np.dtype([
+    ('index', np.uint32), ('timestamp', np.uint32), ('flags', np.uint8),
+])
+ACCEL_DTYPE = np.dtype([
+    ('index', np.uint32), ('x', np.int8), ('y', np.int8), ('z', np.int8),
+])
+ACCEL_CMP_DTYPE = np.dtype([
+    ('index', np.uint32), ('count_bits', np.uint8),
+])
+LS_CONFIG_DTYPE = np.dtype([
+    ('index', np.uint32), ('dac_on', np.uint8), ('flags', np.uint8),
+    ('level_led', np.uint8), ('gain', np.uint8), ('log_size', np.uint8),
+])
+LS_DATA_DTYPE = np.dtype([
+    ('index', np.uint32), ('red', np.uint16), ('ir', np.uint16),
+    ('off', np.uint16), ('flags', np.uint8),
+])
+TEMP_DTYPE = np.dtype([
+    ('index', np.uint32), ('temperature', np.int16),
+])
+TAG_DTYPE = np.dtype([
+    ('index', np.uint32), ('tag', np.uint32),
+])
+LOG_COUNT_DTYPE = np.dtype([
+    ('index', np.uint32), ('log_timestamp', np.uint32),
+    ('log_accel_count', np.uint16), ('old_timestamp', np.uint32),
+    ('timestamp', np.uint32),
+])
+EVENT_DTYPE = np.dtype([
+    ('index', np.uint32), ('flags', np.uint8),
+])
+
+# (key, dtype) of the columnar output, in WED_LOG_TYPE order
+COLUMNAR_LAYOUT = (
+    (u'timestamp', TIMESTAMP_DTYPE),
+    (u'accelerometer', ACCEL_DTYPE),
+    (u'lightsensor_config', LS_CONFIG_DTYPE),
+    (u'lightsensor', LS_DATA_DTYPE),
+    (u'temperature', TEMP_DTYPE),
+    (u'tag', TAG_DTYPE),
+    (u'accelerometer_compressed', ACCEL_CMP_DTYPE),
+    (u'log_count', LOG_COUNT_DTYPE),
+    (u'event', EVENT_DTYPE),
+)
+
+ctypedef packed struct TimestampRow:
+    uint32_t index
+    uint32_t timestamp
+    uint8_t flags
+
+ctypedef packed struct AccelRow:
+    uint32_t index
+    int8_t x
+    int8_t y
+    int8_t z
+
+ctypedef packed struct AccelCmpRow:
+    uint32_t index
+    uint8_t count_bits
+
+ctypedef packed struct LSConfigRow:
+    uint32_t index
+    uint8_t dac_on
+    uint8_t flags
+    uint8_t level_led
+    uint8_t gain
+    uint8_t log_size
+
+ctypedef packed struct LSDataRow:
+    uint32_t index
+    uint16_t red
+    uint16_t ir
+    uint16_t off
+    uint8_t flags
+
+ctypedef packed struct TempRow:
+    uint32_t index
+    int16_t temperature
+
+ctypedef packed struct TagRow:
+    uint32_t index
+    uint32_t tag
+
+ctypedef packed struct LogCountRow:
+    uint32_t index
+    uint32_t log_timestamp
+    uint16_t log_accel_count
+    uint32_t old_timestamp
+    uint32_t timestamp
+
+ctypedef packed struct EventRow:
+    uint32_t index
+    uint8_t flags
+
+cdef struct columns_t:
+    # row buffers of each type, and the number of rows filled so far
+    char * rows[WED_LOG_TYPE_COUNT]
+    int filled[WED_LOG_TYPE_COUNT]
+
+cdef int fill_packet(columns_t * cols, const char * log, uint32_t index) nogil:
+    """Write one packet as the next row of its type
+    """
+    cdef int pk_type = log[0] & WED_TAG_BITS
+    cdef int row = cols.filled[pk_type]
+    cols.filled[pk_type] += 1
+
+    cdef WEDLogTimestamp *p_ts
+    cdef TimestampRow *r_ts
+    if pk_type == C_WED_LOG_TIME:
+        p_ts = <WEDLogTimestamp *>log
+        r_ts = &(<TimestampRow *>cols.rows[pk_type])[row]
+        r_ts.index = index
+        r_ts.timestamp = p_ts.timestamp
+        r_ts.flags = p_ts.flags
+        return 0
+
+    cdef WEDLogAccel *p_accel
+    cdef AccelRow *r_accel
+    if pk_type == C_WED_LOG_ACCEL:
+        p_accel = <WEDLogAccel *>log
+        r_accel = &(<AccelRow *>cols.rows[pk_type])[row]
+        r_accel.index = index
+        r_accel.x = p_accel.accel[0]
+        r_accel.y = p_accel.accel[1]
+        r_accel.z = p_accel.accel[2]
+        return 0
+
+    cdef WEDLogAccelCmp *p_accel_cmp
+    cdef AccelCmpRow *r_accel_cmp
+    if pk_type == C_WED_LOG_ACCEL_CMP:
+        p_accel_cmp = <WEDLogAccelCmp *>log
+        r_accel_cmp = &(<AccelCmpRow *>cols.rows[pk_type])[row]
+        r_accel_cmp.index = index
+        r_accel_cmp.count_bits = p_accel_cmp.count_bits
+        return 0
+
+    cdef WEDLogLSConfig *p_ls_conf
+    cdef LSConfigRow *r_ls_conf
+    if pk_type == C_WED_LOG_LS_CONFIG:
+        p_ls_conf = <WEDLogLSConfig *>log
+        r_ls_conf = &(<LSConfigRow *>cols.rows[pk_type])[row]
+        r_ls_conf.index = index
+        r_ls_conf.dac_on = p_ls_conf.dac_on
+        r_ls_conf.flags = p_ls_conf.flags
+        r_ls_conf.level_led = p_ls_conf.level_led
+        r_ls_conf.gain = p_ls_conf.gain
+        r_ls_conf.log_size = p_ls_conf.log_size
+        return 0
+
+    # flags is the validity mask of red/ir/off, same as LightSensorLog
+    cdef WEDLogLSData *p_ls
+    cdef LSDataRow *r_ls
+    if pk_type == C_WED_LOG_LS_DATA:
+        p_ls = <WEDLogLSData *>log
+        r_ls = &(<LSDataRow *>cols.rows[pk_type])[row]
+        r_ls.index = index
+        r_ls.flags = (<uint8_t>log[0] & 0xE0) >> 5
+        r_ls.red = p_ls.val[0] if r_ls.flags & 1 else 0
+        r_ls.ir = p_ls.val[1] if r_ls.flags & 2 else 0
+        r_ls.off = p_ls.val[2] if r_ls.flags & 4 else 0
+        return 0
+
+    cdef WEDLogTemp *p_temp
+    cdef TempRow *r_temp
+    if pk_type == C_WED_LOG_TEMP:
+        p_temp = <WEDLogTemp *>log
+        r_temp = &(<TempRow *>cols.rows[pk_type])[row]
+        r_temp.index = index
+        r_temp.temperature = p_temp.temperature
+        return 0
+
+    cdef WEDLogTag *p_tag
+    cdef TagRow *r_tag
+    if pk_type == C_WED_LOG_TAG:
+        p_tag = <WEDLogTag *>log
+        r_tag = &(<TagRow *>cols.rows[pk_type])[row]
+        r_tag.index = index
+        r_tag.tag = (
+            p_tag.tag[0] |
+            ( <uint32_t>p_tag.tag[1] << 8 ) |
+            ( <uint32_t>p_tag.tag[2] << 16 ) |
+            ( <uint32_t>p_tag.tag[3] << 24 )
+        )
+        return 0
+
+    cdef WEDLogCount *p_cnt
+    cdef LogCountRow *r_cnt
+    if pk_type == C_WED_LOG_COUNT:
+        p_cnt = <WEDLogCount *>log
+        r_cnt = &(<LogCountRow *>cols.rows[pk_type])[row]
+        r_cnt.index = index
+        r_cnt.log_timestamp = p_cnt.log_timestamp
+        r_cnt.log_accel_count = p_cnt.log_accel_count
+        r_cnt.old_timestamp = p_cnt.old_timestamp
+        r_cnt.timestamp = p_cnt.timestamp
+        return 0
+
+    cdef WEDLogEvent *p_ev
+    cdef EventRow *r_ev
+    if pk_type == C_WED_LOG_EVENT:
+        p_ev = <WEDLogEvent *>log
+        r_ev = &(<EventRow *>cols.rows[pk_type])[row]
+        r_ev.index = index
+        r_ev.flags = p_ev.flags
+        return 0
+
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def convert_columnar(logs_str not None, ignore_unknown=True, uint32_t index_base=0):
+    """
+    Separate stream into one structured array per log type
+    :param logs_str:      byte stream of logs (uncompressed), any contiguous buffer
+    :param index_base:    packet index of the first log in the stream
+    :return:              dict of numpy structured arrays keyed by log name,
+                          see COLUMNAR_LAYOUT for the keys and dtypes
+    """
+    cdef int counts[WED_LOG_TYPE_COUNT]
+    cdef columns_t cols
+    cdef const uint8_t[::1] view = byte_view(logs_str)
+    cdef int data_len = stream_length(view.shape[0])
+    cdef int res
+    cdef int ii
+
+    for ii in range(WED_LOG_TYPE_COUNT):
+        counts[ii] = 0
+        cols.filled[ii] = 0
+
+    cdef const char* logs = NULL
+    if data_len >= 2:
+        logs = <const char *>&view[0]
+        # count pass
+        with nogil:
+            res = stream_type_counts(<const char *>logs, &data_len, counts)
+        if res == AMERR_INVALID_PACKET and not ignore_unknown:
+            raise ValueError('Unknown packet of type %d' % (logs[data_len] & WED_TAG_BITS))
+
+    converted = {}
+    for ii, (key, dtype) in enumerate(COLUMNAR_LAYOUT):
+        arr = np.empty(counts[ii], dtype=dtype)
+        converted[key] = arr
+        cols.rows[ii] = np.PyArray_BYTES(arr)
+
+    if logs == NULL:
+        return converted
+
+    # fill pass
+    cdef int count = 0
+    cdef uint32_t index = index_base
+    with nogil:
+        while count < data_len:
+            fill_packet(&cols, <const char *>&logs[count], index)
+            count += get_packet_len(<const char *>&logs[count])
+            index += 1
+
+    return converted
+
+
+cdef class StreamDecompressor:
+    """Incremental decompressor for a log stream that arrives in chunks
+
+    The compression state and the partial packet at the end of each chunk
+    are kept between feed() calls, so the concatenated output is the same
+    as decompress_stream() of the whole stream.
+    """
+    cdef cmp_state_t state
+    cdef bytes tail
+    cdef public:
+        unsigned long long bytes_in
+        unsigned long long bytes_out
+        unsigned long long logs
+
+    def __cinit__(self):
+        self.reset()
+
+    def reset(self):
+        self.state.accel.bValid = 0
+        self.state.ignored_cmp_count = 0
+        self.tail = b''
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.logs = 0
+
+    property ignored_cmp_count:
+        def __get__(self):
+            return self.state.ignored_cmp_count
+
+    property pending:
+        def __get__(self):
+            return len(self.tail)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def feed(self, chunk not None):
+        '''Decompress the next chunk of the stream
+        Inputs:
+            chunk - next bytes of the log stream (potentially compressed), any contiguous buffer
+        Outputs:
+            outBuf - decompressed byte array of the complete packets so far
+        '''
+        cdef const np.uint8_t[::1] view = byte_view(chunk)
+        cdef int nChunk = stream_length(view.shape[0])
+        cdef int nTail = len(self.tail)
+        cdef cmp_state_t state = self.state
+        cdef int res
+        cdef int nHeadIn = 0
+        cdef int nHeadOut = 0
+        cdef int nRestIn
+        cdef int nRestOut = 0
+        cdef int offset
+        cdef int counts[WED_LOG_TYPE_COUNT]
+        cdef int ii
+        cdef bytes head
+        cdef const char * headBuf
+        cdef np.uint8_t[::1] headOut
+        self.bytes_in += nChunk
+
+        # only the packet split between the previous chunk and this one is
+        #   copied, the rest of the chunk is decoded in place
+        if nTail > 0:
+            head = feed_head(self.tail, <const char *>&view[0] if nChunk else NULL, nChunk)
+            headBuf = head
+            nHeadIn = len(head)
+            with nogil:
+                res = stream_len(headBuf, &nHeadIn, &nHeadOut, &state)
+            check_stream(res)
+            if nHeadIn < nTail:
+                self.tail = head
+                return np.empty(0, dtype=np.uint8)
+            headOut = np.empty(nHeadOut, dtype=np.uint8)
+            if nHeadOut > 0:
+                with nogil:
+                    res = stream_decompress(headBuf, &nHeadIn, <char *>&headOut[0], &nHeadOut, &state)
+                if res < 0:
+                    raise RuntimeError("Decompression error or invalid packet (%d)" % res)
+
+        offset = nHeadIn - nTail
+        nRestIn = nChunk - offset
+        if nRestIn > 0:
+            with nogil:
+                res = stream_len(<const char *>&view[offset], &nRestIn, &nRestOut, &state)
+            check_stream(res)
+        cdef np.uint8_t[::1] outBuf = np.empty(nHeadOut + nRestOut, dtype=np.uint8)
+        if nHeadOut > 0:
+            memcpy(&outBuf[0], &headOut[0], nHeadOut)
+        if nRestOut > 0:
+            with nogil:
+                res = stream_decompress(<const char *>&view[offset], &nRestIn,
+                                        <char *>&outBuf[nHeadOut], &nRestOut, &state)
+            if res < 0:
+                raise RuntimeError("Decompression error or invalid packet (%d)" % res)
+        self.state = state
+        self.tail = feed_tail(<const char *>&view[0] if nChunk else NULL, nChunk, offset + nRestIn)
+        nRestOut += nHeadOut
+        if nRestOut > 0:
+            stream_type_counts(<const char *>&outBuf[0], &nRestOut, counts)
+            for ii in range(WED_LOG_TYPE_COUNT):
+                self.logs += counts[ii]
+        self.bytes_out += nRestOut
+
+        return np.asarray(outBuf)
+
+    def feed_columnar(self, chunk not None):
+        """Decompress the next chunk of the stream into columnar arrays,
+        packet indices continue from the previous chunks
+        """
+        index_base = self.logs
+        return convert_columnar(self.feed(chunk), index_base=index_base)
+
+
+# Packet types by name, e.g. for LogView.of_type
+LOG_TYPES = {
+    u'WED_LOG_TIME': WED_LOG_TIME,
+    u'WED_LOG_ACCEL': WED_LOG_ACCEL,
+    u'WED_LOG_LS_CONFIG': WED_LOG_LS_CONFIG,
+    u'WED_LOG_LS_DATA': WED_LOG_LS_DATA,
+    u'WED_LOG_TEMP': WED_LOG_TEMP,
+    u'WED_LOG_TAG': WED_LOG_TAG,
+    u'WED_LOG_ACCEL_CMP': WED_LOG_ACCEL_CMP,
+    u'WED_LOG_COUNT': WED_LOG_COUNT,
+    u'WED_LOG_EVENT': WED_LOG_EVENT,
+}
+
+
+cdef class LogView:
+    """Lazy view over a log stream
+
+    One scan indexes the offset and type of every packet. Packet objects are
+    only built when indexed, slices and of_type() return views sharing the
+    same buffer, and columnar() fills NumPy arrays for the packets in view.
+    Pickling sends only the packets in view as one byte string.
+    """
+    cdef readonly object base
+    cdef const uint8_t[::1] data
+    cdef readonly np.ndarray offsets
+    cdef readonly np.ndarray types
+    cdef readonly np.ndarray index
+
+    def __init__(self, logs not None, ignore_unknown=True, uint32_t index_base=0):
+        """
+        :param logs:          byte stream of logs (uncompressed), any contiguous buffer
+        :param index_base:    packet index of the first log in the stream
+        """
+        cdef int counts[WED_LOG_TYPE_COUNT]
+        cdef int ii, res
+        cdef int total = 0
+        cdef int data_len
+        self.base = logs
+        self.data = byte_view(logs)
+        data_len = stream_length(self.data.shape[0])
+        for ii in range(WED_LOG_TYPE_COUNT):
+            counts[ii] = 0
+        if data_len >= 2:
+            with nogil:
+                res = stream_type_counts(<const char *>&self.data[0], &data_len, counts)
+            if res == AMERR_INVALID_PACKET and not ignore_unknown:
+                raise ValueError('Unknown packet of type %d' % (self.data[data_len] & WED_TAG_BITS))
+            for ii in range(WED_LOG_TYPE_COUNT):
+                total += counts[ii]
+
+        self.offsets = np.empty(total, dtype=np.uint32)
+        self.types = np.empty(total, dtype=np.uint8)
+        self.index = np.arange(index_base, index_base + total, dtype=np.uint32)
+        if not total:
+            return
+
+        cdef uint32_t[::1] offsets = self.offsets
+        cdef uint8_t[::1] types = self.types
+        cdef const char * pLogs = <const char *>&self.data[0]
+        cdef int count = 0
+        with nogil:
+            for ii in range(total):
+                offsets[ii] = count
+                types[ii] = pLogs[count] & WED_TAG_BITS
+                count += get_packet_len(&pLogs[count])
+
+    def __len__(self):
+        return self.offsets.shape[0]
+
+    def __iter__(self):
+        cdef Py_ssize_t ii
+        for ii in range(self.offsets.shape[0]):
+            yield self._packet(ii)
+
+    def __getitem__(self, key):
+        cdef Py_ssize_t ii
+        if isinstance(key, (int, np.integer)):
+            ii = key
+            if ii < 0:
+                ii += self.offsets.shape[0]
+            if ii < 0 or ii >= self.offsets.shape[0]:
+                raise IndexError('LogView index out of range')
+            return self._packet(ii)
+        return self._subview(self.offsets[key], self.types[key], self.index[key])
+
+    def __repr__(self):
+        return '<LogView of %d logs>' % len(self)
+
+    def __reduce__(self):
+        data, offsets = self._compact()
+        return rebuild_log_view, (data, offsets, self.types.copy(), self.index.copy())
+
+    cdef _packet(self, Py_ssize_t ii):
+        return get_packet(<const char *>&self.data[<uint32_t>self.offsets[ii]])
+
+    cdef LogView _subview(self, offsets, types, index):
+        cdef LogView view = LogView.__new__(LogView)
+        view.base = self.base
+        view.data = self.data
+        view.offsets = offsets
+        view.types = types
+        view.index = index
+        return view
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _compact(self):
+        cdef Py_ssize_t n = self.offsets.shape[0]
+        cdef uint32_t[::1] offsets = np.ascontiguousarray(self.offsets)
+        cdef np.ndarray new_offsets = np.empty(n, dtype=np.uint32)
+        cdef uint32_t[::1] new_view = new_offsets
+        cdef Py_ssize_t ii
+        cdef uint32_t total = 0
+        cdef int packet_len
+        for ii in range(n):
+            new_view[ii] = total
+            total += get_packet_len(<const char *>&self.data[offsets[ii]])
+        out = np.empty(total, dtype=np.uint8)
+        cdef uint8_t[::1] out_view = out
+        for ii in range(n):
+            packet_len = get_packet_len(<const char *>&self.data[offsets[ii]])
+            out_view[new_view[ii]:new_view[ii] + packet_len] = self.data[offsets[ii]:offsets[ii] + packet_len]
+        return out.tobytes(), new_offsets
+
+    def tobytes(self):
+        """Log stream of the packets in view
+        """
+        return self._compact()[0]
+
+    def of_type(self, *pk_types):
+        """View of the packets of the given types, WED_LOG_* values or
+        COLUMNAR_LAYOUT keys
+        """
+        keys = [key for key, dtype in COLUMNAR_LAYOUT]
+        wanted = [keys.index(t) if isinstance(t, str) else t for t in pk_types]
+        mask = np.isin(self.types, wanted)
+        return self._subview(self.offsets[mask], self.types[mask], self.index[mask])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def columnar(self):
+        """The packets in view as one structured array per log type, same
+        layout as convert_columnar
+        """
+        cdef columns_t cols
+        cdef int ii
+        counts = np.bincount(self.types, minlength=WED_LOG_TYPE_COUNT)
+        converted = {}
+        for ii, (key, dtype) in enumerate(COLUMNAR_LAYOUT):
+            arr = np.empty(counts[ii], dtype=dtype)
+            converted[key] = arr
+            cols.rows[ii] = np.PyArray_BYTES(arr)
+            cols.filled[ii] = 0
+
+        cdef Py_ssize_t n = self.offsets.shape[0]
+        if not n:
+            return converted
+        cdef uint32_t[::1] offsets = np.ascontiguousarray(self.offsets)
+        cdef uint32_t[::1] index = np.ascontiguousarray(self.index)
+        cdef const char * logs = <const char *>&self.data[0]
+        cdef Py_ssize_t jj
+        with nogil:
+            for jj in range(n):
+                fill_packet(&cols, &logs[offsets[jj]], index[jj])
+        return converted
 
-    return np.asarray(outBuf), nInLen, state.ignored_cmp_count
\ No newline at end of file
+    def column(self, pk_type):
+        """Structured array of the packets of one type in view
+        """
+        keys = [key for key, dtype in COLUMNAR_LAYOUT]
+        ii = keys.index(pk_type) if isinstance(pk_type, str) else pk_type
+        return self.of_type(ii).columnar()[keys[ii]]
+
+
+def rebuild_log_view(data, offsets, types, index):
+    cdef LogView view = LogView.__new__(LogView)
+    view.base = data
+    view.data = byte_view(data)
+    view.offsets = offsets
+    view.types = types
+    view.index = index
+    return view
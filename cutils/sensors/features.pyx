@@ -0,0 +1,232 @@
+# cython: language_level=2
+from cutils.sensors.c_converter cimport *
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.math cimport sqrt, fabs
+from libc.stdlib cimport abs
+
+
+# One row per window of samples, start is the index of its first
+#   accelerometer sample in the stream, x/y/z the mean of each axis
+#   (posture), vm the mean vector magnitude, counts the summed change of
+#   vector magnitude between samples, still/active the fractions of samples
+#   that moved at most / more than still_threshold on every axis
+FEATURE_DTYPE = np.dtype([
+    ('start', np.int64), ('samples', np.uint32),
+    ('x', np.float32), ('y', np.float32), ('z', np.float32),
+    ('vm', np.float32), ('counts', np.float32),
+    ('still', np.float32), ('active', np.float32),
+])
+
+cdef enum:
+    CMP_STILL = 0xD0
+    # output of the longest compressed packet, 16 samples of WEDLogAccel
+    CMP_OUT_BYTES = 64
+
+cdef struct window_t:
+    long long start
+    long n
+    long long sx
+    long long sy
+    long long sz
+    double svm
+    double counts
+    long n_still
+
+
+cdef class FeatureExtractor:
+    """Windowed activity features computed in one pass over a log stream
+
+    Feed the stream (compressed or not) in chunks of any size, e.g. as it
+    is downloaded; feed() returns the windows completed so far and flush()
+    the last partial one. Accelerometer packets are decoded one at a time,
+    a WED_LOG_ACCEL_CMP_STILL run of n samples is added to the window in
+    one step without decoding it.
+    """
+    cdef cmp_state_t state
+    cdef window_t win
+    cdef bytes tail
+    cdef int px, py, pz
+    cdef double pvm
+    cdef bint has_prev
+    cdef list rows
+    cdef readonly long window
+    cdef readonly int still_threshold
+    cdef readonly long long samples
+    cdef readonly long long still_runs
+
+    def __init__(self, long window, int still_threshold=1):
+        """
+        :param window:           accelerometer samples per window
+        :param still_threshold:  largest change on any axis between two
+                                 samples that still counts as not moving
+        """
+        if window <= 0:
+            raise ValueError("window must be positive")
+        self.window = window
+        self.still_threshold = still_threshold
+        self.reset()
+
+    def reset(self):
+        self.state.accel.bValid = 0
+        self.state.ignored_cmp_count = 0
+        self.tail = b''
+        self.has_prev = False
+        self.samples = 0
+        self.still_runs = 0
+        self.rows = []
+        self._clear(0)
+
+    cdef void _clear(self, long long start):
+        self.win.start = start
+        self.win.n = 0
+        self.win.sx = self.win.sy = self.win.sz = 0
+        self.win.svm = 0
+        self.win.counts = 0
+        self.win.n_still = 0
+
+    cdef _emit(self):
+        cdef double n = self.win.n
+        self.rows.append((self.win.start, self.win.n,
+                          self.win.sx / n, self.win.sy / n, self.win.sz / n,
+                          self.win.svm / n, self.win.counts,
+                          self.win.n_still / n, 1.0 - self.win.n_still / n))
+        self._clear(self.samples)
+
+    cdef inline _add_sample(self, int x, int y, int z):
+        cdef double vm = sqrt(x * x + y * y + z * z)
+        cdef int moved
+        if self.has_prev:
+            moved = max(abs(x - self.px), abs(y - self.py), abs(z - self.pz))
+            if moved <= self.still_threshold:
+                self.win.n_still += 1
+            self.win.counts += fabs(vm - self.pvm)
+        else:
+            self.win.n_still += 1
+            self.has_prev = True
+        self.px = x
+        self.py = y
+        self.pz = z
+        self.pvm = vm
+        self.win.sx += x
+        self.win.sy += y
+        self.win.sz += z
+        self.win.svm += vm
+        self.win.n += 1
+        self.samples += 1
+        if self.win.n == self.window:
+            self._emit()
+
+    cdef _add_still(self, long n):
+        # n repeats of the previous sample, split over the windows they span
+        cdef long take
+        self.still_runs += 1
+        while n > 0:
+            take = min(n, self.window - self.win.n)
+            self.win.sx += take * self.px
+            self.win.sy += take * self.py
+            self.win.sz += take * self.pz
+            self.win.svm += take * self.pvm
+            self.win.n_still += take
+            self.win.n += take
+            self.samples += take
+            n -= take
+            if self.win.n == self.window:
+                self._emit()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef Py_ssize_t _process(self, const char * buf, Py_ssize_t buflen) except -1:
+        """Add the complete packets of buf, return the bytes used
+        """
+        cdef Py_ssize_t pos = 0
+        cdef int packet_len, pk_type, res, i
+        cdef int nIn, nOut
+        cdef char out[CMP_OUT_BYTES]
+        cdef WEDLogAccel * samples = <WEDLogAccel *>out
+        while pos + 2 <= buflen:
+            packet_len = get_packet_len(&buf[pos])
+            if packet_len <= 0:
+                raise ValueError('Unknown packet of type %d' % (buf[pos] & WED_TAG_BITS))
+            if pos + packet_len > buflen:
+                break
+            pk_type = buf[pos] & WED_TAG_BITS
+            if pk_type == C_WED_LOG_ACCEL_CMP and (<uint8_t>buf[pos + 1] & 0xF0) == CMP_STILL:
+                # the decoder ignores compressed packets until it has a sample
+                if not self.state.accel.bValid:
+                    self.state.ignored_cmp_count += 1
+                elif self.has_prev:
+                    self._add_still((<uint8_t>buf[pos + 1] & 0xF) + 1)
+            elif pk_type == C_WED_LOG_ACCEL or pk_type == C_WED_LOG_ACCEL_CMP:
+                nIn = packet_len
+                nOut = sizeof(out)
+                res = stream_decompress(&buf[pos], &nIn, out, &nOut, &self.state)
+                if res < 0:
+                    raise RuntimeError("Decompression error or invalid packet (%d)" % res)
+                for i in range(nOut // <int>sizeof(WEDLogAccel)):
+                    self._add_sample(samples[i].accel[0], samples[i].accel[1], samples[i].accel[2])
+            pos += packet_len
+        return pos
+
+    def _take_rows(self):
+        rows = np.array(self.rows, dtype=FEATURE_DTYPE)
+        self.rows = []
+        return rows
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def feed(self, chunk not None):
+        '''Add the next chunk of the log stream
+        Inputs:
+            chunk - next bytes of the log stream (potentially compressed), any contiguous buffer
+        Outputs:
+            rows - FEATURE_DTYPE array of the windows completed by this chunk
+        '''
+        if isinstance(chunk, np.ndarray):
+            chunk = chunk.reshape(-1).view(np.uint8)
+        cdef const uint8_t[::1] view = chunk
+        cdef Py_ssize_t nChunk = view.shape[0]
+        cdef Py_ssize_t nTail = len(self.tail)
+        cdef Py_ssize_t offset = 0
+        cdef Py_ssize_t used
+        cdef bytes head
+        if nTail > 0:
+            head = feed_head(self.tail, <const char *>&view[0] if nChunk else NULL, nChunk)
+            used = self._process(head, len(head))
+            if used < nTail:
+                self.tail = head
+                return self._take_rows()
+            offset = used - nTail
+        used = 0
+        if nChunk > offset:
+            used = self._process(<const char *>&view[offset], nChunk - offset)
+        self.tail = feed_tail(<const char *>&view[0] if nChunk else NULL, nChunk, offset + used)
+        return self._take_rows()
+
+    def flush(self):
+        """Return the last partial window, if any, and start a new one
+        """
+        if self.win.n:
+            self._emit()
+        return self._take_rows()
+
+    property ignored_cmp_count:
+        def __get__(self):
+            return self.state.ignored_cmp_count
+
+    property pending:
+        def __get__(self):
+            return len(self.tail)
+
+
+def accel_features(logs not None, long window, int still_threshold=1):
+    """Windowed features of a whole log stream, see FeatureExtractor
+    :param logs:    byte stream of logs (compressed or uncompressed), any contiguous buffer
+    :param window:  accelerometer samples per window
+    :return:        FEATURE_DTYPE array, the last window may be partial
+    """
+    extractor = FeatureExtractor(window, still_threshold)
+    rows = extractor.feed(logs)
+    last = extractor.flush()
+    return np.concatenate([rows, last]) if len(last) else rows
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import os
+import json
+import time
+import fnmatch
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from parsers.export import export_data_file, DEFAULT_MAX_MEMORY
+from parsers.manifest import MANIFEST_SUFFIX
+from parsers.seek_index import INDEX_SUFFIX
+
+BATCH_MANIFEST = 'batch_manifest.json'
+
+
+def find_data_files(data_dir, pattern='*.dat*'):
+    """Data files of a directory, largest first so the long jobs start early
+    """
+    files = []
+    for name in os.listdir(data_dir):
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        if name.endswith((MANIFEST_SUFFIX, INDEX_SUFFIX, '.tmp')):
+            continue
+        fname = os.path.join(data_dir, name)
+        if os.path.isfile(fname):
+            files.append(fname)
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+
+def export_path(fname, out_dir, fmt):
+    base = os.path.basename(fname)
+    if fmt == 'hdf5':
+        return os.path.join(out_dir, base + '.h5')
+    return os.path.join(out_dir, base)
+
+
+class BatchManifest(object):
+    """Files already converted, keyed by name with their size and mtime
+
+    A file is skipped on the next run only if it did not change since.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def is_done(self, fname):
+        entry = self.entries.get(os.path.basename(fname))
+        if entry is None:
+            return False
+        st = os.stat(fname)
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+    def add(self, report):
+        self.entries[os.path.basename(report['file'])] = {
+            'size': report['size'],
+            'mtime': report['mtime'],
+            'out': report['out'],
+            'samples': report['samples'],
+            'seconds': report['seconds'],
+        }
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def convert_file(fname, out, fmt, max_memory):
+    """Convert one file, errors are reported instead of raised
+    """
+    st = os.stat(fname)
+    report = {
+        'file': fname,
+        'out': out,
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'samples': 0,
+        'seconds': 0.0,
+        'error': None,
+    }
+    start = time.time()
+    try:
+        report['samples'] = export_data_file(fname, out, fmt=fmt, max_memory=max_memory)
+    except Exception:
+        report['error'] = traceback.format_exc()
+    report['seconds'] = time.time() - start
+    return report
+
+
+def convert_directory(data_dir, out_dir, fmt='parquet', workers=None, threads=False,
+                      max_memory=DEFAULT_MAX_MEMORY, pattern='*.dat*', callback=None):
+    """Export every data file of a directory in parallel
+    :param data_dir:    directory of .dat files
+    :param out_dir:     directory of the exported files and the batch manifest
+    :param fmt:         'parquet' or 'hdf5'
+    :param workers:     number of workers, number of CPUs if None
+    :param threads:     use a thread pool instead of processes, the decoder
+                        releases the GIL
+    :param max_memory:  memory ceiling of each worker in bytes
+    :param callback:    called with each report as files finish
+    :return:            list of per-file reports of this run
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    manifest = BatchManifest(os.path.join(out_dir, BATCH_MANIFEST))
+    todo = [f for f in find_data_files(data_dir, pattern) if not manifest.is_done(f)]
+
+    reports = []
+    if not todo:
+        return reports
+
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(max_workers=workers or os.cpu_count()) as executor:
+        # submitted largest first, the pool picks them up in this order
+        futures = [executor.submit(convert_file, f, export_path(f, out_dir, fmt), fmt, max_memory)
+                   for f in todo]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            if report['error'] is None:
+                manifest.add(report)
+                manifest.save()
+            if callback is not None:
+                callback(report)
+    return reports
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+from cutils.sensors.converter import DECODER_VERSION
+
+# Bumped whenever what is stored for a data file changes
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+# Bytes read from each end of a data file for its quick hash
+QUICK_HASH_BYTES = 64 * 1024
+
+META_FILE = 'meta.json'
+LOCK_FILE = '.lock'
+
+
+def quick_hash(fname, size):
+    """Hash of the size and the first and last QUICK_HASH_BYTES of a file
+    """
+    digest = hashlib.sha1(str(size).encode('ascii'))
+    with open(fname, 'rb') as f:
+        digest.update(f.read(QUICK_HASH_BYTES))
+        if size > 2 * QUICK_HASH_BYTES:
+            f.seek(size - QUICK_HASH_BYTES)
+            digest.update(f.read(QUICK_HASH_BYTES))
+    return digest.hexdigest()
+
+
+class DecodeCache(object):
+    """Decoded arrays of data files kept as .npy files in a directory
+
+    An entry is keyed on the path, size, mtime and quick hash of a data file
+    plus DECODER_VERSION and CACHE_VERSION, so a changed file or decoder
+    never hits an old entry. Arrays are loaded memory-mapped copy-on-write,
+    a hit costs a stat, a quick hash and opening the files.
+
+    Entries are written to a temporary directory and renamed in place, so
+    any number of processes can share the cache. The least recently used
+    entries are removed under a lock file once the total size goes over
+    max_bytes; processes that still map their files keep them until done.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir:  directory of the cache, created if missing
+        :param max_bytes:  total size of the entries kept
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def key(self, fname):
+        fname = os.path.realpath(fname)
+        st = os.stat(fname)
+        identity = [fname, st.st_size, st.st_mtime_ns, quick_hash(fname, st.st_size),
+                    DECODER_VERSION, CACHE_VERSION]
+        return hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, fname, key=None):
+        """Return the arrays stored for a data file as a dict, None if missing
+        """
+        entry = self._entry(key or self.key(fname))
+        try:
+            with open(os.path.join(entry, META_FILE)) as f:
+                names = json.load(f)['arrays']
+            arrays = dict((name, np.load(os.path.join(entry, name + '.npy'), mmap_mode='c'))
+                          for name in names)
+            # most recently used
+            os.utime(os.path.join(entry, META_FILE), None)
+        except (IOError, OSError, ValueError):
+            # missing, being written or just evicted
+            return None
+        return arrays
+
+    def store(self, fname, arrays, key=None):
+        """Save the arrays (name: ndarray) of a data file, then evict the
+        least recently used entries over max_bytes
+        """
+        key = key or self.key(fname)
+        size = sum(array.nbytes for array in arrays.values())
+        if size > self.max_bytes:
+            return
+        tmp_path = os.path.join(self.cache_dir, '.{}.{}.tmp'.format(key, os.getpid()))
+        os.makedirs(tmp_path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'), array)
+            with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+                json.dump({'fname': os.path.realpath(fname), 'arrays': sorted(arrays),
+                           'bytes': size, 'created': time.time()}, f)
+            try:
+                os.rename(tmp_path, self._entry(key))
+            except OSError:
+                # stored by another process meanwhile
+                pass
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """Return (last used, bytes, key) of every entry, oldest first
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue
+            entry = self._entry(key)
+            try:
+                used = os.path.getmtime(os.path.join(entry, META_FILE))
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            except (IOError, OSError):
+                continue
+            entries.append((used, size, key))
+        return sorted(entries)
+
+    @property
+    def total_bytes(self):
+        return sum(size for used, size, key in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries until the total size is at
+        most max_bytes (the limit of the cache if None)
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.entries()
+            total = sum(size for used, size, key in entries)
+            for used, size, key in entries:
+                if total <= max_bytes:
+                    break
+                # renamed first so no reader opens a half removed entry
+                trash = os.path.join(self.cache_dir, '.{}.{}.evicted'.format(key, os.getpid()))
+                try:
+                    os.rename(self._entry(key), trash)
+                except OSError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        self.evict(0)
@@ -0,0 +1,216 @@
+import struct
+import zlib
+from datetime import datetime, timedelta
+import numpy as np
+from cutils.sensors.converter import decompress_stream, get_log_stats, scan_restart_points, RESTART_DTYPE
+
+# Layout of a v2 data file, all integers little-endian:
+#   header   HEADER
+#   chunks   CHUNK_HEADER then payload, each payload starts at a packet that
+#            fully resets the decompression state (except the first one,
+#            which starts the stream) so it decodes on its own
+#   index    one CHUNK_DTYPE row per chunk
+#   trailer  TRAILER, last bytes of the file
+# A file without a valid trailer (interrupted download) is read by walking
+#   the chunk headers.
+MAGIC = b'WED2'
+VERSION = 2
+FLAG_COMPRESSED = 0x01
+# magic, version, flags, start time (microseconds since 1970), sample period (ms)
+HEADER = struct.Struct('<4sHHqI12x')
+CHUNK_MAGIC = b'WCHK'
+# magic, payload bytes, decompressed bytes, accel samples, crc32, first and
+#   last timestamp ticks (-1 if none)
+CHUNK_HEADER = struct.Struct('<4sIIIIqq')
+TRAILER_MAGIC = b'WIDX'
+# magic, number of chunks, file offset of the index, crc32 of the index
+TRAILER = struct.Struct('<4sIQI')
+
+# Payload bytes per chunk, a chunk ends at the first restart point after it
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+CHUNK_DTYPE = np.dtype([
+    ('offset', '<u8'), ('length', '<u4'), ('out_length', '<u4'),
+    ('sample', '<i8'), ('samples', '<u4'),
+    ('first_tick', '<i8'), ('last_tick', '<i8'), ('crc', '<u4'),
+])
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(when):
+    delta = when - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def is_chunked(prefix):
+    """True if the first bytes of a data file are those of a v2 file
+    """
+    return bytes(prefix[:len(MAGIC)]) == MAGIC
+
+
+def read_header(buf):
+    """Return (compressed, start_time, sample_period) of a v2 file
+    """
+    if len(buf) < HEADER.size:
+        raise ValueError("Truncated v2 data file header")
+    magic, version, flags, start_us, sample_period = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a v2 data file")
+    if version != VERSION:
+        raise NotImplementedError("Data file version {} is not supported".format(version))
+    return bool(flags & FLAG_COMPRESSED), EPOCH + timedelta(microseconds=start_us), sample_period
+
+
+def read_index(buf):
+    """Return the CHUNK_DTYPE index of a v2 file, from the footer or, if the
+    file was not closed, by walking the chunk headers
+    """
+    size = len(buf)
+    if size >= HEADER.size + TRAILER.size:
+        magic, n_chunks, index_offset, crc = TRAILER.unpack_from(buf, size - TRAILER.size)
+        index_end = index_offset + n_chunks * CHUNK_DTYPE.itemsize
+        if magic == TRAILER_MAGIC and index_end == size - TRAILER.size:
+            index = buf[index_offset:index_end]
+            if zlib.crc32(index) & 0xffffffff == crc:
+                return np.frombuffer(index, dtype=CHUNK_DTYPE).copy()
+    return scan_chunks(buf)
+
+
+def scan_chunks(buf):
+    """Index of the complete chunks of a v2 file, up to the first damaged one
+    """
+    rows = []
+    offset = HEADER.size
+    sample = 0
+    while offset + CHUNK_HEADER.size <= len(buf):
+        magic, length, out_length, samples, crc, first_tick, last_tick = CHUNK_HEADER.unpack_from(buf, offset)
+        start = offset + CHUNK_HEADER.size
+        if magic != CHUNK_MAGIC or start + length > len(buf):
+            break
+        rows.append((start, length, out_length, sample, samples, first_tick, last_tick, crc))
+        sample += samples
+        offset = start + length
+    return np.array(rows, dtype=CHUNK_DTYPE)
+
+
+def index_restart_points(index):
+    """RESTART_DTYPE rows of the chunk starts after the first, in payload and
+    decompressed offsets as if the chunks were one stream
+    """
+    points = np.empty(max(len(index) - 1, 0), dtype=RESTART_DTYPE)
+    if not len(points):
+        return points
+    points['in_offset'] = np.cumsum(index['length'])[:-1]
+    points['out_offset'] = np.cumsum(index['out_length'])[:-1]
+    points['sample'] = index['sample'][1:]
+    # last timestamp seen before each point
+    ticks = np.maximum.accumulate(np.where(index['last_tick'] >= 0, np.arange(len(index)), -1))[:-1]
+    points['tick'] = np.where(ticks >= 0, index['last_tick'][np.maximum(ticks, 0)], -1)
+    return points
+
+
+class ChunkedWriter(object):
+    """File-like writer of the v2 data file layout
+
+    write() takes the log stream in pieces of any size, e.g. the batches of
+    a RingBufferWriter, and writes a chunk every time chunk_size bytes are
+    buffered and a restart point follows them; each byte is scanned for
+    restart points once. Where the stream turns invalid the bytes before
+    are written as a chunk, and the invalid bytes in chunks of chunk_size
+    until restart points are found again. close() writes the rest of
+    the stream and the index, the underlying file stays open. Data not yet
+    in a chunk (at most about chunk_size bytes) is lost if the process dies
+    before close().
+    """
+
+    def __init__(self, f, compressed, start_time, sample_period, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param f:              file opened in binary mode, positioned at its start
+        :param compressed:     if the stream is compressed
+        :param start_time:     datetime the download started
+        :param sample_period:  nominal sample period in milliseconds
+        :param chunk_size:     payload bytes per chunk
+        """
+        self.file = f
+        self.compressed = compressed
+        self.chunk_size = chunk_size
+        self.pending = bytearray()
+        # bytes of pending scanned so far, and the restart points found in them
+        self.scanned = 0
+        self.points = np.empty(0, dtype=np.int64)
+        self.index = []
+        self.samples = 0
+        self.offset = HEADER.size
+        self.closed = False
+        flags = FLAG_COMPRESSED if compressed else 0
+        f.write(HEADER.pack(MAGIC, VERSION, flags, _to_us(start_time), int(sample_period)))
+
+    def write(self, data):
+        self.pending += data
+        while len(self.pending) >= self.chunk_size:
+            end = self._chunk_end()
+            if end is None:
+                return
+            self._write_chunk(self.pending[:end])
+            del self.pending[:end]
+            self.scanned = max(self.scanned - end, 0)
+            self.points = self.points[self.points > end] - end
+
+    def _chunk_end(self):
+        """Offset in pending the next chunk ends at, the first restart point
+        from chunk_size on, None if not received yet
+        """
+        res = 0
+        if self.scanned < len(self.pending):
+            # only the bytes received since the last scan
+            points, length, res = scan_restart_points(bytes(self.pending[self.scanned:]))
+            self.points = np.concatenate([self.points, points['in_offset'] + self.scanned])
+            self.scanned += length
+        ends = self.points[self.points >= self.chunk_size]
+        if len(ends):
+            return int(ends[0])
+        if res < 0:
+            # not a valid stream from scanned on, readers fail on the chunk of
+            #   the invalid bytes only
+            return self.scanned or self.chunk_size
+        return None
+
+    def _write_chunk(self, payload):
+        payload = bytes(payload)
+        try:
+            decoded = decompress_stream(payload)[0] if self.compressed else payload
+            out_length = len(decoded)
+        except RuntimeError:
+            # written as received, readers fail on this chunk only
+            decoded = payload
+            out_length = 0
+        _, samples, first_tick, last_tick = get_log_stats(decoded)
+        first_tick = -1 if first_tick is None else first_tick
+        last_tick = -1 if last_tick is None else last_tick
+        crc = zlib.crc32(payload) & 0xffffffff
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(payload), out_length, samples, crc,
+                                          first_tick, last_tick))
+        self.file.write(payload)
+        start = self.offset + CHUNK_HEADER.size
+        self.index.append((start, len(payload), out_length, self.samples, samples, first_tick, last_tick, crc))
+        self.offset = start + len(payload)
+        self.samples += samples
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.pending:
+            self._write_chunk(self.pending)
+            self.pending = bytearray()
+        index = np.array(self.index, dtype=CHUNK_DTYPE).tobytes()
+        self.file.write(index)
+        self.file.write(TRAILER.pack(TRAILER_MAGIC, len(self.index), self.offset, zlib.crc32(index) & 0xffffffff))
+        self.file.flush()
@@ -0,0 +1,295 @@
+import os
+import mmap
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.parser import parse as datetime_parser
+from cutils.sensors.converter import (decompress_stream, decompress_stream_parallel, decompressed_size,
+                                      compress_stream, restart_points, scan_restart_points, ERR_OUTPUT_OVERFLOW)
+from parsers import container
+
+HEADER_LINES = 3
+# Payload bytes of a v1 file decoded per call, the decoder counts the bytes
+#   in and out in an int
+SEGMENT_BYTES = 1 << 28
+# between the restart points a segment may end at
+SEGMENT_SPACING = SEGMENT_BYTES // 64
+
+
+class WedDataFile(object):
+    """Binary-safe reader of the .dat files written by DeviceInterface
+
+    The three header lines are parsed once and the log stream that follows
+    is exposed as a read-only memoryview of the memory-mapped file, which
+    the converter functions accept without a copy.
+
+    v2 files (see parsers.container) are memory-mapped too, their chunk
+    index is read from the footer. Chunks are views of the file and decode
+    in parallel; payload joins them into one stream on first use.
+
+    Arrays built on top of payload or chunks (e.g. numpy.frombuffer) must be
+    dropped before the file is closed.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._file = open(fname, 'rb')
+        self._mmap = None
+        self._view = None
+        self._payload = None
+        self.version = 1
+        self.chunks = None
+        try:
+            if container.is_chunked(self._file.read(len(container.MAGIC))):
+                self._open_chunked()
+                return
+            self._file.seek(0)
+            header = [self._file.readline() for _ in range(HEADER_LINES)]
+            kind = header[0].strip()
+            if kind == b'compressed':
+                self.compressed = True
+            elif kind == b'raw':
+                self.compressed = False
+            else:
+                raise NotImplementedError("The time-stamping does not support this type of file")
+
+            self.start_time = datetime_parser(header[1].split(b':', 1)[1].strip().decode('ascii'))
+            self.sample_period = int(header[2].split(b':', 1)[1].strip())
+            self.header_len = self._file.tell()
+
+            if os.fstat(self._file.fileno()).st_size > self.header_len:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+                self._payload = self._view[self.header_len:]
+            else:
+                self._payload = memoryview(b'')
+        except Exception:
+            self.close()
+            raise
+
+    def _open_chunked(self):
+        self.version = 2
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self.compressed, self.start_time, self.sample_period = container.read_header(self._view)
+        self.header_len = container.HEADER.size
+        self.chunks = container.read_index(self._view)
+        self._in_offsets = np.concatenate([[0], np.cumsum(self.chunks['length'], dtype=np.int64)])
+
+    @property
+    def payload(self):
+        """The whole log stream, for v2 files a copy of the chunks joined
+        """
+        if self._payload is None:
+            self._payload = memoryview(b''.join(self.chunk(i) for i in range(len(self.chunks))))
+        return self._payload
+
+    def chunk(self, i):
+        """Payload of the ith chunk of a v2 file, a view of the file
+        """
+        row = self.chunks[i]
+        return self._view[int(row['offset']):int(row['offset']) + int(row['length'])]
+
+    def verify(self):
+        """Return the numbers of the chunks whose checksum does not match,
+        always empty for v1 files
+        """
+        if self.version == 1:
+            return []
+        return [i for i in range(len(self.chunks))
+                if zlib.crc32(self.chunk(i)) & 0xffffffff != self.chunks['crc'][i]]
+
+    def __len__(self):
+        if self.version == 2:
+            return int(self._in_offsets[-1])
+        return len(self.payload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def decompressed(self, out=None):
+        """Return the uncompressed log stream, the payload itself for raw files
+        :param out:  writable buffer to decompress into, e.g. one reused across files
+        """
+        if self.version == 2 and self.compressed:
+            return self.decompress_chunks(0, len(self.chunks), out)
+        if self.compressed and len(self.payload):
+            if len(self.payload) <= SEGMENT_BYTES:
+                try:
+                    return decompress_stream_parallel(self.payload, out=out)[0]
+                except OverflowError:
+                    # decompresses to more than 2 GB
+                    pass
+            return self.decompress_segments(out)
+        return self.payload
+
+    def segments(self):
+        """[begin, stop) of the consecutive pieces of the payload of a v1 file
+        the decoder takes in one call, at most SEGMENT_BYTES in and 2 GB out
+        each, split at restart points so each one decodes on its own
+        """
+        payload = self.payload
+        bounds = [0]
+        while True:
+            begin = bounds[-1]
+            with payload[begin:begin + SEGMENT_BYTES] as window:
+                points, _, res = scan_restart_points(window, SEGMENT_SPACING)
+                last = begin + len(window) == len(payload)
+            if last and res != ERR_OUTPUT_OVERFLOW:
+                break
+            offsets = points['in_offset'][points['in_offset'] > 0]
+            if not len(offsets):
+                if res < 0 and res != ERR_OUTPUT_OVERFLOW:
+                    raise RuntimeError("Invalid stream ({})".format(res))
+                raise RuntimeError("No restart point in {} bytes of {}".format(SEGMENT_BYTES, self.fname))
+            bounds.append(begin + int(offsets[-1]))
+        bounds.append(len(payload))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def decompress_segments(self, out=None):
+        """Decompress a v1 file one segment (see segments()) at a time, for
+        payloads too long for one call
+        :param out:  writable buffer to decompress into
+        """
+        payload = self.payload
+        segments = self.segments()
+        sizes = []
+        for begin, stop in segments:
+            with payload[begin:stop] as segment:
+                sizes.append(decompressed_size(segment))
+        ends = np.cumsum(sizes, dtype=np.int64)
+        total = int(ends[-1]) if len(ends) else 0
+        target = np.empty(total, dtype=np.uint8) if out is None else np.frombuffer(out, dtype=np.uint8)
+        if len(target) < total:
+            raise ValueError("Output buffer too small")
+        for (begin, stop), size, end in zip(segments, sizes, ends):
+            with payload[begin:stop] as segment:
+                decompress_stream_parallel(segment, out=target[int(end) - size:int(end)])
+        return target[:total]
+
+    def decompress_chunks(self, first, stop, out=None, workers=0):
+        """Decompress chunks [first, stop) of a compressed v2 file, each on its
+        own thread straight to its place in the output
+        :param out:      writable buffer to decompress into
+        :param workers:  number of threads, number of CPUs if 0
+        """
+        sizes = self.chunks['out_length'][first:stop].astype(np.int64)
+        ends = np.cumsum(sizes)
+        total = int(ends[-1]) if len(ends) else 0
+        target = np.empty(total, dtype=np.uint8) if out is None else np.frombuffer(out, dtype=np.uint8)
+        if len(target) < total:
+            raise ValueError("Output buffer too small")
+
+        def _decode(i):
+            start = int(ends[i - first] - sizes[i - first])
+            chunk = self.chunk(i)
+            try:
+                if len(chunk):
+                    decompress_stream(chunk, out=target[start:int(ends[i - first])])
+            except (RuntimeError, ValueError):
+                raise ValueError("Chunk {} of {} does not decode".format(i, self.fname))
+            finally:
+                chunk.release()
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            list(executor.map(_decode, range(first, stop)))
+        return target[:total]
+
+    def find_chunks(self, first_sample, last_sample):
+        """Return [first, stop) of the chunks holding a range of accel samples
+        """
+        starts = self.chunks['sample']
+        first = max(int(np.searchsorted(starts, first_sample, side='right')) - 1, 0)
+        stop = int(np.searchsorted(starts, last_sample, side='right'))
+        return first, max(stop, first)
+
+    def restart_points(self, spacing):
+        """Packets decoding can restart at (see converter.restart_points), the
+        chunk starts of v2 files
+        """
+        if self.version == 2:
+            return container.index_restart_points(self.chunks)
+        return restart_points(self.payload, spacing)
+
+    def payload_range(self, begin, stop):
+        """Bytes [begin, stop) of the log stream, for v2 files joined from
+        only the chunks that hold them
+        """
+        if self.version == 1:
+            return self.payload[begin:stop]
+        first = max(int(np.searchsorted(self._in_offsets, begin, side='right')) - 1, 0)
+        last = int(np.searchsorted(self._in_offsets, stop, side='left'))
+        joined = b''.join(self.chunk(i) for i in range(first, min(last, len(self.chunks))))
+        skip = begin - int(self._in_offsets[first])
+        return memoryview(joined)[skip:skip + stop - begin]
+
+    def iter_payload(self, chunk_size):
+        """Consecutive pieces of the log stream of at most chunk_size bytes,
+        views of the file
+        """
+        if self.version == 1:
+            payload = self.payload
+            for offset in range(0, len(payload), chunk_size):
+                yield payload[offset:offset + chunk_size]
+            return
+        for i in range(len(self.chunks)):
+            chunk = self.chunk(i)
+            for offset in range(0, len(chunk), chunk_size):
+                yield chunk[offset:offset + chunk_size]
+
+    def close(self):
+        payload = getattr(self, '_payload', None)
+        if payload is not None:
+            payload.release()
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+
+def compress_data_file(fname, out):
+    """Write a compressed copy of a raw .dat file, existing tools read it
+    back to the same logs
+    :return:  (payload bytes in, payload bytes out)
+    """
+    with WedDataFile(fname) as data_file:
+        if data_file.compressed:
+            raise ValueError("{} is already compressed".format(fname))
+        payload, n_in = compress_stream(data_file.payload) if len(data_file) else (b'', 0)
+        # a partial packet at the end is kept as is
+        tail = data_file.payload[n_in:].tobytes()
+        header = "compressed\n"
+        header += "start_time: " + str(data_file.start_time) + '\n'
+        header += "sample_period: " + str(data_file.sample_period) + '\n'
+        size_in = len(data_file)
+    tmp_path = out + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(payload)
+        f.write(tail)
+    os.rename(tmp_path, out)
+    return size_in, len(payload) + len(tail)
+
+
+def convert_data_file(fname, out, chunk_size=container.DEFAULT_CHUNK_SIZE):
+    """Write a v2 copy of a .dat file (see parsers.container) with the same
+    log stream, byte for byte
+    :return:  number of chunks written
+    """
+    with WedDataFile(fname) as data_file:
+        tmp_path = out + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            writer = container.ChunkedWriter(f, data_file.compressed, data_file.start_time,
+                                             data_file.sample_period, chunk_size)
+            for piece in data_file.iter_payload(chunk_size):
+                writer.write(piece)
+                piece.release()
+            writer.close()
+    os.rename(tmp_path, out)
+    return len(writer.index)
@@ -0,0 +1,182 @@
+from __future__ import print_function
+import os
+import numpy as np
+import pandas as pd
+from cutils.sensors.converter import StreamDecompressor, TIMESTAMP_DTYPE, LOG_COUNT_DTYPE
+from parsers.data_file import WedDataFile
+from parsers.timing import SampleClock
+
+# Worst case bytes held in memory per byte of payload decoded at once, a
+#   WED_LOG_ACCEL_CMP_STILL packet expands 2 bytes into 16 samples and each
+#   sample then goes through columnar rows, positions and timestamps
+EXPANSION = 512
+# Share of the memory budget for rows waiting to be written
+PENDING_SHARE = 4
+ROW_BYTES = 16
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+
+TABLES = ('accel', 'light', 'temperature', 'tag')
+
+
+def iter_columnar(data_file, chunk_size):
+    """Decode the payload of a data file chunk by chunk
+    :param data_file:   WedDataFile
+    :param chunk_size:  payload bytes decoded at once
+    :return:            iterator of columnar logs, see convert_columnar
+    """
+    decoder = StreamDecompressor()
+    for piece in data_file.iter_payload(chunk_size):
+        yield decoder.feed_columnar(piece)
+
+
+def scan_clock(data_file, chunk_size):
+    """First pass, collect the timestamp anchors of a whole data file
+    """
+    n_samples = 0
+    ts, ts_pos, counts, count_pos = [], [], [], []
+    for logs in iter_columnar(data_file, chunk_size):
+        accel_index = logs['accelerometer']['index']
+        ts.append(logs['timestamp'])
+        ts_pos.append(n_samples + np.searchsorted(accel_index, logs['timestamp']['index']))
+        counts.append(logs['log_count'])
+        count_pos.append(n_samples + np.searchsorted(accel_index, logs['log_count']['index']))
+        n_samples += len(accel_index)
+
+    def _cat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+
+    return SampleClock.from_anchors(n_samples,
+                                    _cat(ts_pos, np.int64), _cat(ts, TIMESTAMP_DTYPE),
+                                    _cat(count_pos, np.int64), _cat(counts, LOG_COUNT_DTYPE),
+                                    data_file.start_time, data_file.sample_period)
+
+
+def stamp_frames(logs, clock, n_before):
+    """Timestamped DataFrames of one decoded chunk
+    :param logs:      columnar logs of the chunk
+    :param clock:     SampleClock of the whole file
+    :param n_before:  accelerometer samples in the previous chunks
+    """
+    accel = logs['accelerometer']
+    accel_index = accel['index']
+
+    def _time(rows):
+        pos = n_before + np.searchsorted(accel_index, rows['index'])
+        return pd.DatetimeIndex(clock.stamp(pos), name='time')
+
+    frames = {}
+    frames['accel'] = pd.DataFrame({'Ax': accel['x'], 'Ay': accel['y'], 'Az': accel['z']},
+                                   index=pd.DatetimeIndex(clock.stamp(n_before + np.arange(len(accel))), name='time'),
+                                   columns=['Ax', 'Ay', 'Az'])
+    light = logs['lightsensor']
+    frames['light'] = pd.DataFrame({'red': light['red'], 'ir': light['ir'], 'off': light['off'],
+                                    'flags': light['flags']},
+                                   index=_time(light), columns=['red', 'ir', 'off', 'flags'])
+    temp = logs['temperature']
+    frames['temperature'] = pd.DataFrame({'celsius': temp['temperature'] / np.float32(10)},
+                                         index=_time(temp))
+    tag = logs['tag']
+    frames['tag'] = pd.DataFrame({'tag': tag['tag']}, index=_time(tag))
+    return frames
+
+
+class ParquetExporter(object):
+    """One Parquet file per table in a directory, each flush is a row group
+    """
+
+    def __init__(self, out):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export needs pyarrow, `pip install pyarrow` should suffice")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.out = out
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        self.writers = {}
+
+    def write(self, table, df):
+        arrow_table = self._pa.Table.from_pandas(df, preserve_index=True)
+        writer = self.writers.get(table)
+        if writer is None:
+            writer = self._pq.ParquetWriter(os.path.join(self.out, table + '.parquet'), arrow_table.schema)
+            self.writers[table] = writer
+        writer.write_table(arrow_table)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+class HDF5Exporter(object):
+    """One appendable HDF5 table per table in a single file
+    """
+
+    def __init__(self, out):
+        try:
+            import tables
+        except ImportError:
+            raise ImportError("HDF5 export needs PyTables, `pip install tables` should suffice")
+        self.out = out
+        self.store = pd.HDFStore(out, mode='w', complevel=5, complib='blosc')
+
+    def write(self, table, df):
+        self.store.append(table, df, format='table', index=False)
+
+    def close(self):
+        self.store.close()
+
+
+def get_exporter(out, fmt=None):
+    if fmt is None:
+        fmt = 'hdf5' if os.path.splitext(out)[1].lower() in ('.h5', '.hdf5') else 'parquet'
+    if fmt == 'parquet':
+        return ParquetExporter(out)
+    if fmt == 'hdf5':
+        return HDF5Exporter(out)
+    raise ValueError("Unknown export format {}".format(fmt))
+
+
+def export_data_file(fname, out, fmt=None, max_memory=DEFAULT_MAX_MEMORY):
+    """Export a .dat file to Parquet or HDF5 with bounded memory
+    :param fname:       data file
+    :param out:         output directory (parquet) or .h5 file (hdf5)
+    :param fmt:         'parquet' or 'hdf5', guessed from out if None
+    :param max_memory:  ceiling in bytes for decoded data held at once
+    :return:            number of accelerometer samples exported
+    """
+    chunk_size = max(4096, max_memory // EXPANSION)
+    max_pending = max(1, max_memory // PENDING_SHARE // ROW_BYTES)
+
+    with WedDataFile(fname) as data_file:
+        clock = scan_clock(data_file, chunk_size)
+        exporter = get_exporter(out, fmt)
+        try:
+            pending = dict((t, []) for t in TABLES)
+            pending_rows = 0
+            n_before = 0
+            for logs in iter_columnar(data_file, chunk_size):
+                frames = stamp_frames(logs, clock, n_before)
+                n_before += len(logs['accelerometer'])
+                for table in TABLES:
+                    if len(frames[table]):
+                        pending[table].append(frames[table])
+                        pending_rows += len(frames[table])
+                if pending_rows >= max_pending:
+                    _flush(exporter, pending)
+                    pending_rows = 0
+            _flush(exporter, pending)
+        finally:
+            exporter.close()
+
+    return n_before
+
+
+def _flush(exporter, pending):
+    for table in TABLES:
+        if pending[table]:
+            exporter.write(table, pd.concat(pending[table]))
+            pending[table] = []
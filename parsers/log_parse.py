@@ -1,51 +1,120 @@
 from __future__ import print_function
-import pandas as pd
-from dateutil.parser import parse as datetime_parser
-import datetime
-from cutils.sensors.converter import decompress_stream, convert
+import os
+import numpy as np
+from cutils.sensors.converter import convert_columnar
+from cutils.sensors.features import FeatureExtractor
+from parsers.cache import DecodeCache, DEFAULT_MAX_BYTES
+from parsers.data_file import WedDataFile
+from parsers.manifest import DownloadManifest
+from parsers.timing import SampleClock
 
+# payload bytes fed to the feature extractor at once
+FEATURE_CHUNK_SIZE = 1024 * 1024
 
-def stamp_log_file(fname):
-    with open(fname, 'r') as f:
-        lines = f.readlines()
+# prefix of the columnar tables among the cached arrays
+LOGS_PREFIX = 'logs.'
 
-    if lines[0][:-1] == 'compressed':
-        compressed = True
-    elif lines[0][:-1] == 'raw':
-        compressed = False
-    else:
-        raise NotImplementedError("The time-stamping does not support this type of file")
+_cache = None
 
-    start_time = datetime_parser(lines[1][12:-1])
-    sampling_period = int(lines[2][15:-1])
 
-    log_bytes = ''.join(lines[3:])
-    if compressed:
-        decomp_bytes = decompress_stream(bytearray(log_bytes))[0].tobytes()
-        logs = convert(decomp_bytes)
-    else:
-        logs = convert(log_bytes)
-    accel_logs = [[l.x, l.y, l.z] for l in logs if l.name.startswith('accel')]
-    time_stamps = [start_time - datetime.timedelta(milliseconds=sampling_period * i) for i in range(len(accel_logs))][::-1]
+def set_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """Cache decoded data files in cache_dir from now on, None to stop
+    caching; the WED_CACHE_DIR (and WED_CACHE_MAX_BYTES) environment
+    variables set it at import
+    :return:  the DecodeCache, None if disabled
+    """
+    global _cache
+    _cache = DecodeCache(cache_dir, max_bytes) if cache_dir else None
+    return _cache
 
-    return pd.DataFrame(accel_logs, index=pd.DatetimeIndex(time_stamps), columns=['Ax', 'Ay', 'Az'], dtype=int)
+
+def get_cache():
+    return _cache
+
+
+if os.environ.get('WED_CACHE_DIR'):
+    set_cache(os.environ['WED_CACHE_DIR'], int(os.environ.get('WED_CACHE_MAX_BYTES', 0) or DEFAULT_MAX_BYTES))
+
+
+def _decode(fname):
+    with WedDataFile(fname) as data_file:
+        logs = convert_columnar(data_file.decompressed())
+        start_time = data_file.start_time
+        sampling_period = data_file.sample_period
+
+    accel = logs['accelerometer']
+    clock = SampleClock.from_logs(logs, start_time, sampling_period)
+
+    # one contiguous block, handed to pandas without another copy
+    values = np.empty((len(accel), 3), dtype=int)
+    values[:, 0] = accel['x']
+    values[:, 1] = accel['y']
+    values[:, 2] = accel['z']
+    return logs, values, clock.stamp()
+
+
+def decode_log_file(fname, cache=None):
+    """Columnar logs, accelerometer values and their timestamps of a data
+    file, from the cache if it has them
+    :param cache:  DecodeCache, the one of set_cache if None, False to not use any
+    :return:       (dict of columnar logs, (n, 3) values, datetime64[ns] of each sample)
+    """
+    if cache is None:
+        cache = _cache
+    if not cache:
+        return _decode(fname)
+
+    key = cache.key(fname)
+    arrays = cache.load(fname, key)
+    if arrays is None:
+        logs, values, stamps = _decode(fname)
+        arrays = dict((LOGS_PREFIX + name, table) for name, table in logs.items())
+        arrays['values'] = values
+        arrays['time'] = stamps
+        cache.store(fname, arrays, key)
+        return logs, values, stamps
+    logs = dict((name[len(LOGS_PREFIX):], array) for name, array in arrays.items()
+                if name.startswith(LOGS_PREFIX))
+    return logs, arrays['values'], arrays['time']
+
+
+def stamp_log_file(fname, cache=None):
+    """Accelerometer samples of a data file as a DataFrame indexed by time
+    :param cache:  DecodeCache, the one of set_cache if None, False to not use any
+    """
+    import pandas as pd
+    logs, values, stamps = decode_log_file(fname, cache)
+    return pd.DataFrame(values, index=pd.DatetimeIndex(stamps, copy=False), columns=['Ax', 'Ay', 'Az'], copy=False)
 
 
 def get_accel_counts(fname):
-    with open(fname, 'r') as f:
-        lines = f.readlines()
-
-    if lines[0][:-1] == 'compressed':
-        compressed = True
-    elif lines[0][:-1] == 'raw':
-        compressed = False
-    else:
-        raise NotImplementedError("The time-stamping does not support this type of file")
-
-    log_bytes = ''.join(lines[3:])
-    if compressed:
-        decomp_bytes = decompress_stream(bytearray(log_bytes))[0].tobytes()
-        logs = convert(decomp_bytes)
-    else:
-        logs = convert(log_bytes)
-    return len([l for l in logs if l.name.startswith('accel')])
+    manifest = DownloadManifest.load(fname)
+    if manifest is not None:
+        return manifest.accel_logs
+
+    with WedDataFile(fname) as data_file:
+        logs = convert_columnar(data_file.decompressed())
+    return len(logs['accelerometer'])
+
+
+def activity_features(fname, epoch=60, still_threshold=1, chunk_size=FEATURE_CHUNK_SIZE):
+    """Per epoch activity features of a data file, without expanding it in
+    memory (see cutils.sensors.features)
+    :param fname:            data file name
+    :param epoch:            seconds of samples per row, at the nominal sample period
+    :param still_threshold:  largest change on any axis of a still sample
+    :param chunk_size:       payload bytes decoded at once
+    :return:                 DataFrame of features indexed by the time of the first sample of each epoch
+    """
+    import pandas as pd
+    from parsers.export import scan_clock
+    with WedDataFile(fname) as data_file:
+        window = max(int(round(epoch * 1000.0 / data_file.sample_period)), 1)
+        extractor = FeatureExtractor(window, still_threshold)
+        rows = [extractor.feed(piece) for piece in data_file.iter_payload(chunk_size)]
+        rows.append(extractor.flush())
+        clock = scan_clock(data_file, chunk_size)
+
+    rows = np.concatenate(rows)
+    frame = pd.DataFrame(rows, index=pd.DatetimeIndex(clock.stamp(rows['start']), name='time'))
+    return frame.drop(columns=['start'])
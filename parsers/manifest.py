@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+from datetime import datetime
+from cutils.sensors.converter import get_log_stats
+
+MANIFEST_SUFFIX = '.json'
+
+
+def manifest_path(fname):
+    return fname + MANIFEST_SUFFIX
+
+
+class DownloadManifest(object):
+    """Running counts of a download, kept in a sidecar file next to the data
+
+    update() is called with every notification payload as it is written to
+    the data file, so the counts never need another pass over the file.
+    update() may run on the writer thread while another thread saves, a
+    lock keeps each saved manifest consistent.
+    """
+
+    FIELDS = ('mac_address', 'raw', 'start_time', 'sample_period', 'total_logs',
+              'logs', 'accel_logs', 'bytes', 'first_timestamp', 'last_timestamp',
+              'complete', 'updated')
+
+    def __init__(self, fname, mac_address=None, raw=False, start_time=None,
+                 sample_period=None, total_logs=None):
+        self.fname = fname
+        self.mac_address = mac_address
+        self.raw = raw
+        self.start_time = start_time
+        self.sample_period = sample_period
+        self.total_logs = total_logs
+        self.logs = 0
+        self.accel_logs = 0
+        self.bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.complete = False
+        self.updated = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return manifest_path(self.fname)
+
+    def update(self, data):
+        """Account for a chunk of the log stream
+        :param data:  log stream bytes written to the data file
+        :return:      number of logs in data
+        """
+        logs, accel_logs, first_timestamp, last_timestamp = get_log_stats(data)
+        with self._lock:
+            self.logs += logs
+            self.accel_logs += accel_logs
+            self.bytes += len(data)
+            if first_timestamp is not None:
+                if self.first_timestamp is None:
+                    self.first_timestamp = first_timestamp
+                self.last_timestamp = last_timestamp
+        return logs
+
+    def as_dict(self):
+        with self._lock:
+            meta = dict((k, getattr(self, k)) for k in self.FIELDS)
+        for k in ('start_time', 'updated'):
+            if meta[k] is not None:
+                meta[k] = str(meta[k])
+        return meta
+
+    def save(self):
+        self.updated = datetime.now()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        # atomic, readers never see a partial manifest
+        os.rename(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, fname):
+        """Return the manifest of a data file, or None if it has none
+        """
+        try:
+            with open(manifest_path(fname), 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        manifest = cls(fname)
+        for k in cls.FIELDS:
+            if k in meta:
+                setattr(manifest, k, meta[k])
+        return manifest
@@ -0,0 +1,126 @@
+from __future__ import division
+import os
+import numpy as np
+import pandas as pd
+from cutils.sensors.converter import decompress_stream, convert_columnar
+from parsers.data_file import WedDataFile
+from parsers.export import scan_clock
+from parsers.timing import SampleClock
+
+INDEX_SUFFIX = '.idx.npz'
+# Bytes of payload between two restart points, a query decodes about this much
+DEFAULT_SPACING = 64 * 1024
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def index_path(fname):
+    return fname + INDEX_SUFFIX
+
+
+class SeekIndex(object):
+    """Time-range index over the payload of a data file
+
+    Restart points are the packets that fully reset the decompression state
+    (uncompressed or 8-bit compressed accel), so decoding can start at any of
+    them; the chunks of a v2 file all start at one. With the sample clock of the whole file a time range maps to the
+    few restart points around it, and only those bytes are decoded.
+    """
+
+    def __init__(self, fname, points, clock, size, mtime):
+        self.fname = fname
+        self.points = points
+        self.clock = clock
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def build(cls, fname, spacing=DEFAULT_SPACING):
+        st = os.stat(fname)
+        with WedDataFile(fname) as data_file:
+            points = data_file.restart_points(spacing)
+            clock = scan_clock(data_file, SCAN_CHUNK_SIZE)
+        return cls(fname, points, clock, st.st_size, st.st_mtime)
+
+    @classmethod
+    def load(cls, fname):
+        """Return the saved index of a data file, None if missing or stale
+        """
+        try:
+            saved = np.load(index_path(fname))
+        except (IOError, OSError):
+            return None
+        st = os.stat(fname)
+        if saved['size'] != st.st_size or saved['mtime'] != st.st_mtime:
+            return None
+        clock = SampleClock(int(saved['origin_ns']), saved['anchor_pos'], saved['anchor_ns'],
+                            saved['period_ns'], int(saved['n_samples']))
+        return cls(fname, saved['points'], clock, int(saved['size']), float(saved['mtime']))
+
+    @classmethod
+    def open(cls, fname, spacing=DEFAULT_SPACING):
+        """Load the index of a data file, build and save it first if needed
+        """
+        index = cls.load(fname)
+        if index is None:
+            index = cls.build(fname, spacing)
+            index.save()
+        return index
+
+    def save(self):
+        path = index_path(self.fname)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, points=self.points,
+                 origin_ns=self.clock.origin_ns, anchor_pos=self.clock.anchor_pos,
+                 anchor_ns=self.clock.anchor_ns, period_ns=self.clock.period_ns,
+                 n_samples=self.clock.n_samples, size=self.size, mtime=self.mtime)
+        os.rename(tmp_path, path)
+
+    def read_range(self, start, end):
+        """Return the accelerometer samples between two datetimes (inclusive)
+        as a DataFrame in the same layout as stamp_log_file
+        """
+        # through pandas, numpy drops the nanoseconds of a Timestamp
+        bounds = pd.DatetimeIndex([start, end]).values
+        first, last = self.clock.locate(bounds)
+        # locate is not an exact inverse of stamp, the samples next to the
+        #   bounds are checked against their own stamps
+        first = max(int(np.floor(first)), 0)
+        last = min(int(np.ceil(last)), self.clock.n_samples - 1)
+        while first <= last and self.clock.stamp([first])[0] < bounds[0]:
+            first += 1
+        while last >= first and self.clock.stamp([last])[0] > bounds[1]:
+            last -= 1
+        if last < first:
+            return _accel_frame(np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=int), self.clock)
+
+        # closest restart point at or before the first sample, and the first
+        #   one after the last sample bounds the bytes to decode
+        samples = self.points['sample']
+        i = np.searchsorted(samples, first, side='right') - 1
+        j = np.searchsorted(samples, last, side='right')
+        with WedDataFile(self.fname) as data_file:
+            begin = self.points['in_offset'][i] if i >= 0 else 0
+            stop = self.points['in_offset'][j] if j < len(self.points) else len(data_file)
+            base = samples[i] if i >= 0 else 0
+            chunk = data_file.payload_range(begin, stop)
+            accel = convert_columnar(decompress_stream(chunk)[0] if data_file.compressed else chunk)['accelerometer']
+            del chunk
+
+        accel = accel[first - base:last - base + 1]
+        values = np.empty((len(accel), 3), dtype=int)
+        values[:, 0] = accel['x']
+        values[:, 1] = accel['y']
+        values[:, 2] = accel['z']
+        return _accel_frame(np.arange(first, first + len(accel)), values, self.clock)
+
+
+def _accel_frame(positions, values, clock):
+    return pd.DataFrame(values, index=pd.DatetimeIndex(clock.stamp(positions)),
+                        columns=['Ax', 'Ay', 'Az'], copy=False)
+
+
+def read_range(fname, start, end):
+    """Accelerometer samples of a data file between two datetimes, using
+    (and creating if needed) the seek index saved next to the file
+    """
+    return SeekIndex.open(fname).read_range(start, end)
@@ -0,0 +1,301 @@
+from __future__ import division
+import struct
+from datetime import datetime
+import numpy as np
+from parsers.timing import TICKS_PER_SECOND
+
+WED_LOG_TIME = 0
+WED_LOG_ACCEL = 1
+WED_LOG_LS_CONFIG = 2
+WED_LOG_LS_DATA = 3
+WED_LOG_TEMP = 4
+WED_LOG_TAG = 5
+WED_LOG_ACCEL_CMP = 6
+WED_LOG_COUNT = 7
+WED_LOG_EVENT = 8
+
+# count_bits encoding of WED_LOG_ACCEL_CMP, key is the bits per axis
+CMP_ENCODING = {3: 0, 4: 1, 5: 2, 6: 3, 8: 4}
+CMP_STILL = 0x80 | (5 << 4)
+# a compressed packet carries at most 144 bits of samples
+CMP_MAX_SAMPLES = {3: 16, 4: 12, 5: 9, 6: 8, 8: 6}
+STILL_MAX_SAMPLES = 16
+
+# Notification payload of a BLE 4.0 link, packets are never split
+NOTIFICATION_SIZE = 20
+
+_PACKET_SIZE = {
+    WED_LOG_TIME: 6,
+    WED_LOG_ACCEL: 4,
+    WED_LOG_LS_CONFIG: 6,
+    WED_LOG_TEMP: 3,
+    WED_LOG_TAG: 5,
+    WED_LOG_COUNT: 15,
+    WED_LOG_EVENT: 2,
+}
+
+
+def packet_len(buf, offset=0):
+    """Length of the packet at offset of a log stream, -1 if unknown
+    """
+    header = bytearray(buf[offset:offset + 2])
+    pk_type = header[0] & 0x1F
+    if pk_type in _PACKET_SIZE:
+        return _PACKET_SIZE[pk_type]
+    if pk_type == WED_LOG_LS_DATA:
+        return 1 + 2 * bin(header[0] & 0xE0).count('1')
+    if pk_type == WED_LOG_ACCEL_CMP:
+        if len(header) < 2:
+            return -1
+        count_bits = header[1]
+        encoding = (count_bits >> 4) & 0x7
+        if encoding == 5:
+            return 2
+        bits_per_axis = dict((v, k) for k, v in CMP_ENCODING.items()).get(encoding)
+        if bits_per_axis is None:
+            return -1
+        bits = ((count_bits & 0xF) + 1) * bits_per_axis * 3
+        if bits > 144:
+            return -1
+        return 2 + (bits - 1) // 8 + 1
+    return -1
+
+
+def delta_bits(delta):
+    """Bits needed to encode signed deltas, as cmpNbits in sensor_parse.c
+    :param delta:  integer array
+    """
+    v = np.where(delta < 0, ~delta, delta).astype(np.int64)
+    nbits = np.ones(v.shape, dtype=np.int64)
+    while np.any(v):
+        nbits += v > 0
+        v >>= 1
+    return nbits
+
+
+def accel_signal(n_samples, seed=0, still_share=0.3):
+    """Synthetic accelerometer samples, segments of stillness, walking,
+    steps of every delta size and abrupt motion around 1 g on the z axis
+    :return:  (n_samples, 3) int8 array
+    """
+    rng = np.random.RandomState(seed)
+    samples = np.empty((n_samples, 3), dtype=np.int16)
+    pos = 0
+    while pos < n_samples:
+        length = min(n_samples - pos, int(rng.randint(16, 2048)))
+        kind = rng.random_sample()
+        t = np.arange(length)
+        if kind < still_share:
+            segment = np.tile(rng.randint(-4, 5, size=3) + [0, 0, 64], (length, 1))
+        elif kind < 0.75:
+            # walking, about 2 steps per second at 50 Hz
+            segment = np.empty((length, 3))
+            segment[:, 0] = 12 * np.sin(2 * np.pi * t / 25.0)
+            segment[:, 1] = 6 * np.sin(2 * np.pi * t / 50.0 + 1)
+            segment[:, 2] = 64 + 20 * np.sin(2 * np.pi * t / 25.0 + 2)
+            segment += rng.normal(0, 1.5, size=(length, 3))
+        elif kind < 0.9:
+            # random walk with deltas needing 3 to 8 bits
+            bound = np.array([3, 7, 15, 31, 60])[rng.randint(0, 5, size=(length, 1))]
+            steps = rng.randint(-64, 65, size=(length, 3)) % (bound + 1)
+            steps *= rng.choice([-1, 1], size=(length, 3))
+            segment = np.clip(np.cumsum(steps, axis=0) // 4 + [0, 0, 64], -128, 127)
+        else:
+            segment = rng.normal(0, 40, size=(length, 3)) + [0, 0, 64]
+        samples[pos:pos + length] = np.clip(np.round(segment), -128, 127)
+        pos += length
+    return samples.astype(np.int8)
+
+
+def _pack_bits(values, nbits):
+    value = 0
+    mask = (1 << nbits) - 1
+    for v in values:
+        value = (value << nbits) | (int(v) & mask)
+    total = len(values) * nbits
+    n_bytes = (total - 1) // 8 + 1
+    value <<= n_bytes * 8 - total
+    return bytearray((value >> (8 * (n_bytes - 1 - i))) & 0xFF for i in range(n_bytes))
+
+
+def encode_accel(samples, prev=None):
+    """Compress accelerometer samples into WED_LOG_ACCEL_CMP packets
+    :param samples:  (n, 3) int8 array
+    :param prev:     last sample already encoded, None if the decoder has no
+                     state (the first packet is then 8-bit)
+    :return:         (packet bytes, last sample)
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    n = len(samples)
+    if n == 0:
+        return bytearray(), prev
+    previous = np.empty_like(samples)
+    previous[1:] = samples[:-1]
+    previous[0] = samples[0] if prev is None else prev
+    deltas = samples - previous
+    widths = np.maximum(delta_bits(deltas).max(axis=1), 3)
+    widths[widths > 6] = 8
+    if prev is None:
+        widths[0] = 8
+    still = ~deltas.any(axis=1)
+    if prev is None:
+        still[0] = False
+
+    out = bytearray()
+    i = 0
+    while i < n:
+        if still[i]:
+            j = i
+            while j < n and still[j] and j - i < STILL_MAX_SAMPLES:
+                j += 1
+            out += struct.pack('<BB', WED_LOG_ACCEL_CMP, CMP_STILL | (j - i - 1))
+            i = j
+            continue
+        width = int(widths[i])
+        j = i + 1
+        while j < n and j - i < CMP_MAX_SAMPLES[width] and not still[j] and \
+                (widths[j] == width or (width < 8 and widths[j] < width)):
+            j += 1
+        out += struct.pack('<BB', WED_LOG_ACCEL_CMP, (CMP_ENCODING[width] << 4) | (j - i - 1))
+        if width == 8:
+            out += samples[i:j].astype(np.int8).tobytes()
+        else:
+            out += _pack_bits(deltas[i:j].ravel(), width)
+        i = j
+    return out, samples[-1].copy()
+
+
+def timestamp_packet(tick, flags=0):
+    return struct.pack('<BIB', WED_LOG_TIME, tick & 0xFFFFFFFF, flags)
+
+
+def log_count_packet(tick, accel_count, old_tick=0):
+    return struct.pack('<BIHII', WED_LOG_COUNT, tick & 0xFFFFFFFF, accel_count & 0xFFFF,
+                       old_tick & 0xFFFFFFFF, tick & 0xFFFFFFFF)
+
+
+def drop_packets(stream, rate, rng):
+    """Drop accelerometer packets of a stream, as lost notifications would
+    """
+    out = bytearray()
+    offset = 0
+    while offset < len(stream):
+        length = packet_len(stream, offset)
+        pk_type = bytearray(stream[offset:offset + 1])[0] & 0x1F
+        if pk_type not in (WED_LOG_ACCEL, WED_LOG_ACCEL_CMP) or rng.random_sample() >= rate:
+            out += stream[offset:offset + length]
+        offset += length
+    return out
+
+
+def packet_histogram(stream):
+    """Count the packets of a stream by type, compressed accel packets by
+    bits per axis ('cmp_3' ... 'cmp_8', 'cmp_still')
+    """
+    names = {WED_LOG_TIME: 'time', WED_LOG_ACCEL: 'accel', WED_LOG_LS_CONFIG: 'ls_config',
+             WED_LOG_LS_DATA: 'ls_data', WED_LOG_TEMP: 'temp', WED_LOG_TAG: 'tag',
+             WED_LOG_COUNT: 'count', WED_LOG_EVENT: 'event'}
+    widths = dict((v, 'cmp_{}'.format(k)) for k, v in CMP_ENCODING.items())
+    widths[5] = 'cmp_still'
+    histogram = {}
+    offset = 0
+    while offset < len(stream):
+        length = packet_len(stream, offset)
+        if length <= 0:
+            raise ValueError("Unknown packet at offset {}".format(offset))
+        header = bytearray(stream[offset:offset + 2])
+        pk_type = header[0] & 0x1F
+        if pk_type == WED_LOG_ACCEL_CMP:
+            name = widths[(header[1] >> 4) & 0x7]
+        else:
+            name = names[pk_type]
+        histogram[name] = histogram.get(name, 0) + 1
+        offset += length
+    return histogram
+
+
+def synthetic_stream(n_samples, compressed=True, sample_period=20, seed=0,
+                     timestamp_every=256, start_tick=0, extras=True, log_count=True,
+                     lost=0.0):
+    """Synthetic WED log stream as stored on a device
+    :param n_samples:        accelerometer samples
+    :param compressed:       WED_LOG_ACCEL_CMP packets instead of WED_LOG_ACCEL
+    :param sample_period:    sample period in ms
+    :param timestamp_every:  accelerometer samples between two timestamps
+    :param extras:           interleave light sensor, temperature, tag and
+                             event logs
+    :param log_count:        end the stream with a WED_LOG_COUNT packet
+    :param lost:             probability of dropping each accelerometer packet,
+                             the decoder then has to recover from the gaps
+    :return:                 bytes
+    """
+    rng = np.random.RandomState(seed + 1)
+    samples = accel_signal(n_samples, seed)
+    ticks_per_sample = sample_period * TICKS_PER_SECOND / 1000.0
+    out = bytearray()
+    prev = None
+    for pos in range(0, n_samples, timestamp_every):
+        tick = start_tick + int(round(pos * ticks_per_sample))
+        out += timestamp_packet(tick)
+        if extras:
+            block = pos // timestamp_every
+            if block % 32 == 7:
+                out += timestamp_packet(tick + 1, flags=0x10)
+            if block % 4 == 0:
+                out += struct.pack('<Bh', WED_LOG_TEMP, int(rng.randint(150, 370)))
+            if block % 16 == 0:
+                out += struct.pack('<BBBBBB', WED_LOG_LS_CONFIG, 1, 0, 4, 2, 3)
+                mask = (0xE0, 0x20, 0x60, 0xA0)[(block // 16) % 4]
+                values = rng.randint(0, 65536, size=bin(mask).count('1'))
+                out += struct.pack('<B' + 'H' * len(values), WED_LOG_LS_DATA | mask, *values)
+            if block % 64 == 0:
+                out += struct.pack('<BI', WED_LOG_TAG, int(rng.randint(0, 2 ** 31)))
+            if block % 64 == 32:
+                out += struct.pack('<BB', WED_LOG_EVENT, 1)
+        segment = samples[pos:pos + timestamp_every]
+        if compressed:
+            packets, prev = encode_accel(segment, prev)
+        else:
+            packets = bytearray()
+            for sample in segment:
+                packets += struct.pack('<Bbbb', WED_LOG_ACCEL, *sample)
+        if lost:
+            packets = drop_packets(packets, lost, rng)
+        out += packets
+    if log_count:
+        tick = start_tick + int(round(n_samples * ticks_per_sample))
+        out += log_count_packet(tick, n_samples, start_tick)
+    return bytes(out)
+
+
+def split_notifications(stream, size=NOTIFICATION_SIZE):
+    """Split a log stream in notification payloads on packet boundaries
+    :return:  list of bytes
+    """
+    payloads = []
+    start = 0
+    offset = 0
+    while offset < len(stream):
+        length = packet_len(stream, offset)
+        if length <= 0:
+            raise ValueError("Unknown packet at offset {}".format(offset))
+        if offset + length - start > size:
+            payloads.append(stream[start:offset])
+            start = offset
+        offset += length
+    if start < len(stream):
+        payloads.append(stream[start:])
+    return payloads
+
+
+def write_data_file(fname, stream, compressed=True, start_time=None, sample_period=20):
+    """Write a log stream with the header of the .dat files of DeviceInterface
+    """
+    if start_time is None:
+        start_time = datetime(2016, 1, 1)
+    header = "compressed\n" if compressed else "raw\n"
+    header += "start_time: " + str(start_time) + '\n'
+    header += "sample_period: " + str(sample_period) + '\n'
+    with open(fname, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(stream)
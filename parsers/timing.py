@@ -0,0 +1,131 @@
+from __future__ import division
+import numpy as np
+from cutils.sensors.converter import FLAG_FAST, FLAG_SLEEP, FLAG_DEBUG, FLAG_REBOOT
+
+TICKS_PER_SECOND = 128
+NS_PER_TICK = 1e9 / TICKS_PER_SECOND
+MODE_BITS = FLAG_FAST | FLAG_SLEEP
+
+
+class SampleClock(object):
+    """Piecewise-linear map between accelerometer sample positions and time
+
+    The clock is anchored on the WED_LOG_TIME packets of the stream (device
+    ticks at 128 Hz); the sample period of each segment between two anchors
+    is measured from the anchors themselves so fast/slow/sleep mode changes
+    are followed. The open segment after the last anchor uses the period of
+    the last segment in the same mode, or the nominal sample period.
+
+    Device ticks are tied to the wall clock by the last WED_LOG_COUNT packet,
+    whose timestamp is the device tick at download start_time. Without one
+    the last sample is placed at start_time, same as the original files.
+    """
+
+    def __init__(self, origin_ns, anchor_pos, anchor_ns, period_ns, n_samples):
+        # anchor times are kept relative to origin_ns, float64 can not hold
+        #   epoch nanoseconds exactly
+        self.origin_ns = origin_ns
+        self.anchor_pos = anchor_pos
+        self.anchor_ns = anchor_ns
+        self.period_ns = period_ns
+        self.n_samples = n_samples
+
+    @classmethod
+    def from_logs(cls, logs, start_time, sample_period):
+        """Build the clock from the output of convert_columnar
+        :param logs:           dict of columnar logs (see convert_columnar)
+        :param start_time:     datetime the download started
+        :param sample_period:  nominal sample period in milliseconds
+        """
+        accel_index = logs['accelerometer']['index']
+        return cls.from_anchors(len(accel_index),
+                                np.searchsorted(accel_index, logs['timestamp']['index']),
+                                logs['timestamp'],
+                                np.searchsorted(accel_index, logs['log_count']['index']),
+                                logs['log_count'],
+                                start_time, sample_period)
+
+    @classmethod
+    def from_anchors(cls, n_samples, ts_pos, ts, count_pos, counts, start_time, sample_period):
+        """Build the clock from timestamp and log count rows
+        :param n_samples:     total number of accelerometer samples
+        :param ts_pos:        number of samples before each timestamp row
+        :param ts:            timestamp rows (TIMESTAMP_DTYPE)
+        :param count_pos:     number of samples before each log count row
+        :param counts:        log count rows (LOG_COUNT_DTYPE)
+        :param start_time:    datetime the download started
+        :param sample_period: nominal sample period in milliseconds
+        """
+        start_ns = np.datetime64(start_time, 'ns').astype(np.int64)
+        nominal_ns = float(sample_period) * 1e6
+
+        # debug timestamps carry an error code instead of ticks
+        valid = (ts['flags'] & FLAG_DEBUG) == 0
+        pos = np.asarray(ts_pos, dtype=np.int64)[valid]
+        raw_tick = ts['timestamp'][valid].astype(np.int64)
+        flags = ts['flags'][valid]
+
+        if len(pos) == 0:
+            # no anchor, samples are contiguous and end at start_time
+            last = max(n_samples - 1, 0)
+            return cls(start_ns, np.zeros(1, dtype=np.int64),
+                       np.array([-last * nominal_ns]),
+                       np.array([nominal_ns]), n_samples)
+
+        # only the last anchor before a sample matters
+        keep = np.append(pos[1:] != pos[:-1], True)
+        pos, raw_tick, flags = pos[keep], raw_tick[keep], flags[keep]
+
+        # unwrap reboots and counter resets, the new epoch is glued to the
+        #   previous one at the nominal period
+        dpos = np.diff(pos)
+        dtick = np.diff(raw_tick).astype(np.float64)
+        reset = (dtick < 0) | ((flags[1:] & FLAG_REBOOT) != 0)
+        dtick[reset] = dpos[reset] * nominal_ns / NS_PER_TICK
+        tick = raw_tick[0] + np.concatenate(([0.0], np.cumsum(dtick)))
+
+        period_ns = np.empty(len(pos))
+        period_ns[:-1] = dtick * NS_PER_TICK / dpos
+        measured = ~reset & (dtick > 0)
+        period_ns[:-1][~measured] = nominal_ns
+        mode = flags & MODE_BITS
+        same_mode = np.nonzero(measured & (mode[:-1] == mode[-1]))[0]
+        period_ns[-1] = period_ns[same_mode[-1]] if len(same_mode) else nominal_ns
+
+        # reference tick of start_time, in the unwrapped tick domain
+        ref_tick = None
+        if len(counts):
+            seg = np.searchsorted(pos, count_pos[-1], side='right') - 1
+            if seg >= 0 and counts['timestamp'][-1] >= raw_tick[seg]:
+                ref_tick = tick[seg] + (counts['timestamp'][-1] - raw_tick[seg])
+        anchor_ns = (tick - tick[-1]) * NS_PER_TICK
+        if ref_tick is None:
+            last = max(n_samples - 1, pos[-1])
+            anchor_ns -= (last - pos[-1]) * period_ns[-1]
+        else:
+            anchor_ns -= (ref_tick - tick[-1]) * NS_PER_TICK
+
+        return cls(start_ns, pos, anchor_ns, period_ns, n_samples)
+
+    def _segments(self, positions):
+        seg = np.searchsorted(self.anchor_pos, positions, side='right') - 1
+        return np.maximum(seg, 0)
+
+    def stamp(self, positions=None):
+        """Return datetime64[ns] of accelerometer sample positions
+        :param positions:  sample positions, all samples if None
+        """
+        if positions is None:
+            positions = np.arange(self.n_samples, dtype=np.int64)
+        positions = np.asarray(positions)
+        seg = self._segments(positions)
+        ns = self.anchor_ns[seg] + (positions - self.anchor_pos[seg]) * self.period_ns[seg]
+        return (self.origin_ns + np.rint(ns).astype(np.int64)).view('datetime64[ns]')
+
+    def locate(self, times):
+        """Return fractional sample positions of datetimes, inverse of stamp
+        :param times:  datetime or array of datetime64
+        """
+        ns = np.asarray(times, dtype='datetime64[ns]').astype(np.int64) - self.origin_ns
+        seg = np.maximum(np.searchsorted(self.anchor_ns, ns, side='right') - 1, 0)
+        return self.anchor_pos[seg] + (ns - self.anchor_ns[seg]) / self.period_ns[seg]
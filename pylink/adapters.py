@@ -0,0 +1,90 @@
+from multiprocessing import Lock
+
+DEFAULT_ADAPTER = 'hci0'
+
+# dBm assumed for a device never seen on an adapter, and recorded for an
+#   adapter that failed to connect to it
+UNKNOWN_RSSI = -80
+UNREACHABLE_RSSI = -127
+
+# adapters whose signal is within this many dB of the best are ranked by load
+RSSI_MARGIN = 10
+
+
+def parse_adapters(adapters, max_process):
+    """(name, limit) of each adapter of the yaml config, a name or a mapping
+    with `name` and `max_process`, limits default to max_process
+    """
+    if not adapters:
+        return [(DEFAULT_ADAPTER, max_process)]
+    parsed = []
+    for adapter in adapters:
+        if isinstance(adapter, dict):
+            parsed.append((adapter['name'], adapter.get('max_process', 0) or max_process))
+        else:
+            parsed.append((adapter, max_process))
+    return parsed
+
+
+class AdapterPool(object):
+    """BLE adapters (hci0..hciN) of the host, with one backend lock and one
+    concurrency limit each
+
+    Operations on different adapters do not wait for each other. A device is
+    assigned to the least loaded free adapter among those that saw it with a
+    signal close to the best one.
+    """
+
+    def __init__(self, adapters, lock_factory=Lock):
+        """
+        :param adapters:      list of (name, concurrency limit)
+        :param lock_factory:  creates the lock of each adapter
+        """
+        self.names = [name for name, limit in adapters]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Adapters listed more than once")
+        self.limits = dict(adapters)
+        self.lock_factory = lock_factory
+        self.locks = dict((name, lock_factory()) for name in self.names)
+        self.active = dict((name, 0) for name in self.names)
+        self.rssi = {}
+
+    @property
+    def capacity(self):
+        return sum(self.limits.values())
+
+    def seen(self, mac_address, adapter, rssi):
+        """Record the signal strength of a device on an adapter,
+        UNREACHABLE_RSSI if it could not connect. None (connected or found by
+        a scan, strength unknown, as with gattlib) only clears UNREACHABLE_RSSI
+        """
+        key = (mac_address, adapter)
+        if rssi is not None:
+            self.rssi[key] = rssi
+        elif self.rssi.get(key) == UNREACHABLE_RSSI:
+            del self.rssi[key]
+
+    def choose(self, mac_address):
+        """Return the adapter to service a device with, None if all are busy
+        """
+        free = [a for a in self.names if self.active[a] < self.limits[a]]
+        if not free:
+            return None
+        signal = dict((a, self.rssi.get((mac_address, a), UNKNOWN_RSSI)) for a in free)
+        best = max(signal.values())
+        candidates = [a for a in free if signal[a] >= best - RSSI_MARGIN]
+        return min(candidates, key=lambda a: float(self.active[a]) / self.limits[a])
+
+    def reset_locks(self, adapter=None):
+        """Replace the lock of an adapter, every lock if None, e.g. once a
+        process that could hold it was killed; the locks dict itself is kept
+        so holders of it see them
+        """
+        for name in self.names if adapter is None else [adapter]:
+            self.locks[name] = self.lock_factory()
+
+    def acquire(self, adapter):
+        self.active[adapter] += 1
+
+    def release(self, adapter):
+        self.active[adapter] -= 1
@@ -0,0 +1,11 @@
+import os
+
+# BLE backend, `simulated` serves synthetic devices instead of real hardware
+BACKEND = os.environ.get('WED_BACKEND', 'gattlib')
+
+if BACKEND == 'simulated':
+    from simulator import GATTRequester, DiscoveryService
+elif BACKEND == 'gattlib':
+    from gattlib import GATTRequester, DiscoveryService
+else:
+    raise ImportError("Unknown WED_BACKEND {}, use gattlib or simulated".format(BACKEND))
@@ -2,13 +2,15 @@ import sys
 import time
 from datetime import datetime
 import struct as st
-from gattlib import *
-from pyprind import ProgBar
+from backend import GATTRequester
 from threading import Event
 
-from cutils.sensors.converter import get_log_count
 from wed_settings import *
-from parsers.log_parse import get_accel_counts
+from parsers.manifest import DownloadManifest
+from parsers.container import ChunkedWriter, DEFAULT_CHUNK_SIZE
+from writer import RingBufferWriter, DEFAULT_BUFFER_SIZE, DEFAULT_FLUSH_INTERVAL
+from telemetry import SessionTelemetry
+from adapters import DEFAULT_ADAPTER, UNREACHABLE_RSSI
 
 
 class Requester(GATTRequester):
@@ -19,16 +21,24 @@ class Requester(GATTRequester):
         self.done = False
         self.max_logs = 50
         self.file = None
+        self.writer = None
+        self.manifest = None
+        self.telemetry = None
         self.next_print = 0
         self.print_step = 200
 
     def on_notification(self, handle, data):
-        self.log_count += get_log_count(data[3:])
+        # runs on the BLE callback thread, only copy the payload
+        self.telemetry.notification(len(data) - 3)
+        self.writer.write(memoryview(data)[3:])
+
+    def on_batch(self, data):
+        # runs on the writer thread with a batch of payloads
+        self.log_count += self.manifest.update(data)
         if self.log_count > self.max_logs:
             if not self.done:
                 self.done = True
                 self.wake_up.set()
-        self.file.write(data[3:])
         if self.log_count > self.next_print:
             self.next_print += self.print_step
             self.wake_up.set()
@@ -44,7 +54,15 @@ class DeviceInterface:
                  stop_event=None,
                  battery_warn=20,
                  status_dict=None,
-                 min_logs=1000):
+                 telemetry_dict=None,
+                 state_store=None,
+                 adapter=DEFAULT_ADAPTER,
+                 min_logs=1000,
+                 write_buffer=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 fsync_interval=None,
+                 data_format=1,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
 
         self.mac_address = mac_address
         self.fname = fname
@@ -66,6 +84,10 @@ class DeviceInterface:
         else:
             self.device_settings = device_settings
         self.status_dict = status_dict
+        self.telemetry_dict = telemetry_dict
+        self.state_store = state_store
+        self.adapter = adapter
+        self.telemetry = SessionTelemetry(mac_address, adapter)
 
         # Initialize configs
         self.status = None
@@ -73,6 +95,13 @@ class DeviceInterface:
         self.full_fname = None
         self.total_logs = 0
         self.min_logs = min_logs
+        self.write_buffer = write_buffer
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        if data_format not in (1, 2):
+            raise ValueError("Unknown data file format {}".format(data_format))
+        self.data_format = data_format
+        self.chunk_size = chunk_size
         self.config = None
         self.sample_period = None
         if stop_event is None:
@@ -85,7 +114,8 @@ class DeviceInterface:
         else:
             self.received = wake_up
 
-        self.requester = Requester(self.received, mac_address, False)
+        self.requester = Requester(self.received, mac_address, False, adapter)
+        self.requester.telemetry = self.telemetry
 
     @property
     def stopped(self):
@@ -144,9 +174,17 @@ class DeviceInterface:
         self.log_stream.flush()
 
     def connect(self):
-        self.log_print("Connecting to MAC address {} .......".format(self.mac_address))
-        with self.backend_lock:
-            self.requester.connect(True)
+        self.log_print("Connecting to MAC address {} on {} .......".format(self.mac_address, self.adapter))
+        with self.telemetry.locked(self.backend_lock):
+            start = time.time()
+            try:
+                self.requester.connect(True)
+            except Exception:
+                self.telemetry.rssi = UNREACHABLE_RSSI
+                raise
+            self.telemetry.connect_seconds = time.time() - start
+            # only the simulated backend reports the signal strength
+            self.telemetry.rssi = getattr(self.requester, 'rssi', None)
             self.log_print("Connected to {}!".format(self.mac_address))
 
     def disconnect(self):
@@ -154,17 +192,17 @@ class DeviceInterface:
         if not self.is_connected():
             self.log_print("Device {} is already disconnected".format(self.mac_address))
             return
-        with self.backend_lock:
+        with self.telemetry.locked(self.backend_lock):
             self.requester.disconnect()
         self.log_print("Disconnected from device {}!".format(self.mac_address))
 
     def read_by_handle(self, handle):
-        with self.backend_lock:
+        with self.telemetry.locked(self.backend_lock):
             ret = self.requester.read_by_handle(handle)
         return ret
 
     def write_by_handle(self, handle, data):
-        with self.backend_lock:
+        with self.telemetry.locked(self.backend_lock):
             self.requester.write_by_handle(handle, data)
 
     def read_status(self, update=False):
@@ -175,6 +213,8 @@ class DeviceInterface:
             self.config = st.unpack(self.device_settings.config_pattern, _config)
             self.total_logs = self.status[0]
             self.sample_period = 10 * self.config[self.mode * 2 + 1]
+            if self.state_store is not None:
+                self.state_store.update(self.mac_address, battery=self.battery_level, backlog=self.total_logs)
 
     def print_status(self):
         status = ["Status of the Device {}:".format(self.mac_address),
@@ -213,16 +253,39 @@ class DeviceInterface:
         self.start_time = datetime.now()
         self.full_fname = self.fname + '_%s.dat' % self.mac_address.replace(':', '') + self.start_time.strftime("_%m-%d-%y_%H-%M-%S")
         self.log_print("Writing data to file: {}".format(self.full_fname))
-        self.requester.file = open(self.full_fname, 'w+')
-        self.requester.file.write("raw\n" if self.raw else "compressed\n")
-        self.requester.file.write("start_time: " + str(self.start_time) + '\n')
-        self.requester.file.write("sample_period: " + str(self.sample_period) + '\n')
+        self.requester.file = open(self.full_fname, 'wb+')
+        if self.data_format == 2:
+            out = ChunkedWriter(self.requester.file, not self.raw, self.start_time, self.sample_period,
+                                chunk_size=self.chunk_size)
+        else:
+            out = self.requester.file
+            header = "raw\n" if self.raw else "compressed\n"
+            header += "start_time: " + str(self.start_time) + '\n'
+            header += "sample_period: " + str(self.sample_period) + '\n'
+            out.write(header.encode('ascii'))
+        self.requester.manifest = DownloadManifest(self.full_fname,
+                                                   mac_address=self.mac_address,
+                                                   raw=self.raw,
+                                                   start_time=self.start_time,
+                                                   sample_period=self.sample_period,
+                                                   total_logs=self.total_logs)
+        self.requester.manifest.save()
+        self.requester.writer = RingBufferWriter(out,
+                                                 buffer_size=self.write_buffer,
+                                                 flush_interval=self.flush_interval,
+                                                 fsync_interval=self.fsync_interval,
+                                                 on_batch=self.requester.on_batch,
+                                                 on_error=self.on_write_error).start()
+        self.telemetry.start_download()
         self.start_broadcast()
+        from pyprind import ProgBar
         bar = ProgBar(100, width=70, stream=self.log_stream)
         last_check = self.start_time
         timed_out = False
+        outcome = 'interrupted'
         try:
-            while not timed_out and not self.requester.done and not self.stopped:
+            while not timed_out and not self.requester.done and not self.stopped \
+                    and self.requester.writer.error is None:
                 if (datetime.now() - last_check).seconds > 30:
                     self.stop_broadcast()
                     self.read_status(update=True)
@@ -231,14 +294,23 @@ class DeviceInterface:
                     self.start_broadcast()
                 self.received.clear()
                 timed_out = not self.received.wait(30)
+                self.requester.manifest.save()
                 bar.update()
+            if self.requester.writer.error is not None:
+                self.log_print("")
+                self.log_print("Writing the data file failed")
+                outcome = 'error'
+                raise self.requester.writer.error
             if self.requester.done:
                 while bar.cnt < bar.max_iter:
                     bar.update()
                 self.log_print("Download Complete")
+                outcome = 'complete'
             else:
                 self.log_print("")
                 self.log_print("Download Interrupted")
+                if timed_out:
+                    outcome = 'timed_out'
 
         except (KeyboardInterrupt, SystemExit):
             self.log_print("")
@@ -252,7 +324,24 @@ class DeviceInterface:
                 self.log_print("Waiting for all notifications to get handled ....")
                 time.sleep(2)
             self.log_print("Closing File ....")
+            writer = self.requester.writer
+            writer.close()
+            if self.data_format == 2:
+                # the last chunk and the index
+                writer.file.close()
             self.requester.file.close()
+            self.log_print("Wrote {} bytes, write buffer high-water mark {} of {} bytes".format(
+                writer.bytes_written, writer.high_water, len(writer.buffer)))
+            if writer.overruns:
+                self.log_print("****WARNING: write buffer overrun, {} notifications ({} bytes) dropped".format(
+                    writer.overruns, writer.overrun_bytes))
+            self.requester.manifest.complete = self.requester.done
+            self.requester.manifest.save()
+            self.telemetry.end_download(outcome, self.requester.log_count)
+
+    def on_write_error(self, error):
+        # runs on the writer thread, download_data raises the error
+        self.received.set()
 
     def run(self):
         try:
@@ -265,16 +354,41 @@ class DeviceInterface:
             elif self.command == Commands.STATUS:
                 self.print_status()
             self.disconnect()
+        except SystemExit:
+            # terminated by the scheduler, e.g. stuck in connect()
+            self.log_print("Device {} terminated".format(self.mac_address))
+            self.disconnect()
+            raise
         except (Exception) as e:
+            self.telemetry.outcome = 'error'
+            if self.state_store is not None:
+                self.state_store.update(self.mac_address, last_error=str(e))
             self.log_print("Error encountered while running device {}\n {}\n".format(self.mac_address, str(e)))
         finally:
-            if self.status_dict is not None and self.command == Commands.DOWNLOAD:
-                if self.requester.log_count > 0:
-                    epoch_time = (self.start_time - datetime(1970, 1, 1)).total_seconds()
-                    if not self.requester.done:
-                        epoch_time -= (self.total_logs - get_accel_counts(self.full_fname)) * self.sample_period / 1000
-                    self.status_dict[self.mac_address] = int(epoch_time)
-                elif self.total_logs < self.min_logs:
-                    epoch_time = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
-                    self.status_dict[self.mac_address] = int(epoch_time)
+            self.telemetry.end()
+            if self.telemetry_dict is not None:
+                self.telemetry_dict[self.mac_address] = self.telemetry.as_dict()
+            if self.command == Commands.DOWNLOAD:
+                self.save_last_checked()
+
+    def save_last_checked(self):
+        epoch_time = None
+        if self.requester.log_count > 0:
+            epoch_time = (self.start_time - datetime(1970, 1, 1)).total_seconds()
+            if not self.requester.done:
+                epoch_time -= (self.total_logs - self.requester.manifest.accel_logs) * self.sample_period / 1000
+        elif self.total_logs < self.min_logs:
+            epoch_time = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
+        if epoch_time is None:
+            return
+        if self.status_dict is not None:
+            self.status_dict[self.mac_address] = int(epoch_time)
+        if self.state_store is not None:
+            state = {'last_checked': int(epoch_time)}
+            if self.requester.done:
+                state['last_download'] = (self.start_time - datetime(1970, 1, 1)).total_seconds()
+                state['backlog'] = 0
+            elif self.requester.log_count > 0:
+                state['backlog'] = max(self.total_logs - self.requester.manifest.accel_logs, 0)
+            self.state_store.update(self.mac_address, **state)
 
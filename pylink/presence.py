@@ -0,0 +1,169 @@
+import sys
+import time
+import threading
+from datetime import datetime
+from collections import namedtuple
+
+DEFAULT_TTL = 300
+DEFAULT_SCAN_SECONDS = 2
+DEFAULT_SCAN_INTERVAL = 30
+
+# devices whose backlogs are within the same number of logs are ranked by
+#   signal strength
+BACKLOG_BUCKET = 10000
+
+Sighting = namedtuple('Sighting', ['time', 'rssi', 'adapter'])
+
+
+class PresenceCache(object):
+    """Last time and signal strength each device was seen by a scan,
+    sightings older than ttl seconds do not count
+
+    Until a scan succeeds, or if none did for ttl seconds, the cache is not
+    ready and every device counts as present.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.last_scan = None
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def scanned(self, when=None):
+        """Record a successful scan, whatever it found
+        """
+        self.last_scan = time.time() if when is None else when
+
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        return self.last_scan is not None and now - self.last_scan <= self.ttl
+
+    def seen(self, mac_address, rssi=None, adapter=None, when=None):
+        sighting = Sighting(time.time() if when is None else when, rssi, adapter)
+        with self._lock:
+            self._seen[mac_address.upper()] = sighting
+
+    def get(self, mac_address, now=None):
+        """Return the Sighting of a device, None if not seen within ttl
+        """
+        with self._lock:
+            sighting = self._seen.get(mac_address.upper())
+        now = time.time() if now is None else now
+        if sighting is None or now - sighting.time > self.ttl:
+            return None
+        return sighting
+
+    def is_present(self, mac_address, now=None):
+        return self.get(mac_address, now) is not None
+
+    def choose(self, queued, backlogs=None, now=None):
+        """Return the (last_checked, mac) of queued to service next, the
+        present device with the largest backlog (in BACKLOG_BUCKET steps),
+        then the strongest signal and the oldest last_checked, None if no
+        queued device is present. The stalest of queued if the cache is not ready.
+        :param backlogs:  logs waiting on each device by MAC address, e.g. from a
+                          DeviceStateStore; an unknown backlog ranks first
+        """
+        now = time.time() if now is None else now
+        if not self.ready(now):
+            return min(queued) if queued else None
+        backlogs = backlogs or {}
+        best = None
+        best_key = None
+        for item in queued:
+            last_checked, mac_address = item
+            sighting = self.get(mac_address, now)
+            if sighting is None:
+                continue
+            rssi = sighting.rssi if sighting.rssi is not None else -128
+            backlog = backlogs.get(mac_address)
+            bucket = int(backlog // BACKLOG_BUCKET) if backlog is not None else 0
+            key = (backlog is not None, -bucket, -rssi, last_checked)
+            if best_key is None or key < best_key:
+                best, best_key = item, key
+        return best
+
+
+class BackgroundScanner(object):
+    """Thread that scans every adapter in turn and records the devices
+    found in a PresenceCache
+
+    gattlib's DiscoveryService only returns names; a discovery service with
+    a discover_rssi() method (the simulated one) also reports signal strength.
+    """
+
+    def __init__(self, cache, discovery_factory, adapters=('hci0',), locks=None,
+                 scan_seconds=DEFAULT_SCAN_SECONDS, interval=DEFAULT_SCAN_INTERVAL, log_stream=None):
+        """
+        :param cache:              PresenceCache to update
+        :param discovery_factory:  called with an adapter name, returns a DiscoveryService
+        :param adapters:           adapter names to scan with
+        :param locks:              backend lock of each adapter, held while it scans
+        :param scan_seconds:       duration of one scan
+        :param interval:           seconds between the starts of two rounds of scans
+        :param log_stream:         stream scan errors are logged to, stdout if None
+        """
+        self.cache = cache
+        self.discovery_factory = discovery_factory
+        self.adapters = list(adapters)
+        self.locks = locks or {}
+        self.scan_seconds = scan_seconds
+        self.interval = interval
+        self.log_stream = log_stream or sys.stdout
+        self.scans = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def log_print(self, message):
+        self.log_stream.write(datetime.now().strftime("[%m-%d-%y_%H-%M-%S] ") + message + '\n')
+        self.log_stream.flush()
+
+    def scan(self, adapter):
+        service = self.discovery_factory(adapter)
+        lock = self.locks.get(adapter)
+        if lock is not None:
+            lock.acquire()
+        try:
+            if hasattr(service, 'discover_rssi'):
+                found = service.discover_rssi(self.scan_seconds)
+            else:
+                found = dict((mac, (name, None)) for mac, name in service.discover(self.scan_seconds).items())
+        finally:
+            if lock is not None:
+                lock.release()
+        now = time.time()
+        for mac_address, (name, rssi) in found.items():
+            self.cache.seen(mac_address, rssi, adapter, now)
+        self.cache.scanned(now)
+        self.scans += 1
+        return found
+
+    def scan_all(self):
+        for adapter in self.adapters:
+            if self._stop.is_set():
+                return
+            try:
+                self.scan(adapter)
+            except Exception as e:
+                # a busy or missing adapter, try again next round
+                self.errors += 1
+                self.log_print("Scan on {} failed\n {}".format(adapter, str(e)))
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.scan_all()
+            self._stop.wait(max(self.interval - (time.time() - start), 0))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,365 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import signal
+import asyncio
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import SyncManager
+
+# Modules of a device visit, imported once by the fork server instead of
+#   by every process it starts
+WORKER_PRELOAD = ['backend', 'devices']
+
+
+class WorkerDied(Exception):
+    """The process of a device visit exited without a result
+    """
+
+
+def worker_context(start_method='forkserver'):
+    """multiprocessing context the device visits are started from, a fork
+    server with WORKER_PRELOAD imported if the platform has one
+    """
+    if start_method not in multiprocessing.get_all_start_methods():
+        start_method = None
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == 'forkserver':
+        context.set_forkserver_preload(WORKER_PRELOAD)
+    return context
+
+
+def device_job(mac_address, log_file, stop_event, kwargs, adapter, backend_lock):
+    """Service one device
+    :param backend_lock:  lock of the adapter
+    :return:              the new last_checked epoch of the device, None if
+                          unchanged, and the telemetry record of the session
+    """
+    from devices import DeviceInterface
+    status_dict = {}
+    telemetry_dict = {}
+    if log_file:
+        logger = open(log_file, 'a')
+    else:
+        logger = sys.stdout
+    try:
+        device = DeviceInterface(mac_address, log_stream=logger,
+                                 backend_lock=backend_lock, adapter=adapter,
+                                 stop_event=stop_event, status_dict=status_dict,
+                                 telemetry_dict=telemetry_dict, **kwargs)
+        try:
+            device.run()
+        except SystemExit:
+            # terminated, the session is recorded all the same
+            pass
+    finally:
+        if log_file:
+            logger.close()
+    return status_dict.get(mac_address), telemetry_dict.get(mac_address)
+
+
+def _terminate_visit(signum, frame):
+    # SIGTERM of the scheduler, unwinding the visit stops the broadcast,
+    #   closes the data file and disconnects (see DeviceInterface.run), a
+    #   second SIGTERM exits at once
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    raise SystemExit(128 + signum)
+
+
+def visit_process(conn, *args):
+    """Target of the process of one device visit, sends the result of
+    device_job(*args), or its error, back on conn
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate_visit)
+    try:
+        result = device_job(*args), None
+    except Exception as e:
+        result = None, str(e)
+    conn.send(result)
+    conn.close()
+
+
+def _wait_visit(process, conn):
+    # runs on a waiter thread until the process of a visit exits
+    try:
+        result, error = conn.recv()
+    except EOFError:
+        result, error = None, None
+    finally:
+        conn.close()
+    process.join()
+    if error is not None:
+        raise RuntimeError(error)
+    if result is None:
+        raise WorkerDied("exit code {}".format(process.exitcode))
+    return result
+
+
+def _sync_manager_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def epoch_now():
+    return (datetime.now() - datetime(1970, 1, 1)).total_seconds()
+
+
+class FleetScheduler(object):
+    """Event-driven download scheduler for a fleet of devices
+
+    Devices are serviced stalest first (lowest last_checked), each visit in
+    its own process, at most the concurrency limit of each adapter of an
+    AdapterPool at a time; a slot is handed to the next device as soon as a
+    visit finishes. A device whose last_checked did
+    not move for more than max_retries visits in a row is pushed to the
+    back of the queue and held back for backoff seconds. The session
+    records of the devices are aggregated by telemetry, a FleetTelemetry.
+    With a state_store (DeviceStateStore) the queue order and retry counts
+    are loaded from it and saved after every visit, so a restart resumes
+    where the previous run stopped. With a presence cache (PresenceCache)
+    only devices seen recently are handed a slot, by the backlog in the
+    state_store and signal strength, the others wait in the queue; all of
+    them are handed slots while no scan succeeded. Visits are started from mp_context,
+    see worker_context(), the adapter locks must come from the same context.
+
+    A visit that does not stop within stop_grace seconds of a timeout is
+    terminated, it cleans up and records its session on SIGTERM. One that
+    does not exit within another stop_grace seconds is killed and the lock
+    of its adapter replaced, the other visits are not affected.
+    """
+
+    def __init__(self, dev_macs, adapters, log_dir, device_kwargs,
+                 timeout=900, max_retries=3, backoff=0,
+                 last_checked=None, log_stream=None, telemetry=None, state_store=None,
+                 mp_context=None, presence=None, presence_poll=1.0, stop_grace=60):
+        self.dev_macs = list(dev_macs)
+        self.adapters = adapters
+        self.log_dir = log_dir
+        self.device_kwargs = device_kwargs
+        self.max_process = min(adapters.capacity, len(self.dev_macs))
+        self.timeout = timeout
+        self.stop_grace = stop_grace
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.last_checked = dict((d, 0) for d in self.dev_macs)
+        self.retries = dict((d, 0) for d in self.dev_macs)
+        self.state_store = state_store
+        if state_store is not None:
+            self.device_kwargs = dict(device_kwargs, state_store=state_store)
+            states = state_store.all()
+            for mac in self.dev_macs:
+                if mac in states:
+                    self.last_checked[mac] = states[mac]['last_checked']
+                    self.retries[mac] = states[mac]['retries']
+        if last_checked:
+            self.last_checked.update(last_checked)
+        self.log_stream = log_stream or sys.stdout
+        self.telemetry = telemetry
+        self.mp_context = mp_context or multiprocessing.get_context()
+        self.presence = presence
+        self.presence_poll = presence_poll
+
+        self.serviced = 0
+        self.timed_out = 0
+        self.terminated = 0
+        self.killed = 0
+        self.started = None
+        self._stop_events = {}
+        self._tasks = set()
+        self._stopping = False
+        self._waiters = None
+        self._cancelled = []
+
+    @property
+    def devices_per_hour(self):
+        if not self.started:
+            return 0.0
+        elapsed = time.time() - self.started
+        return self.serviced * 3600.0 / elapsed if elapsed > 0 else 0.0
+
+    def log_print(self, message):
+        self.log_stream.write(datetime.now().strftime("[%m-%d-%y_%H-%M-%S] ") + message + '\n')
+        self.log_stream.flush()
+
+    def _start_visit(self, loop, mac, log_file, stop_event, adapter):
+        """Start the process of a visit, return it and a future of its result
+        """
+        reader, writer = self.mp_context.Pipe(duplex=False)
+        process = self.mp_context.Process(target=visit_process,
+                                          args=(writer, mac, log_file, stop_event, self.device_kwargs,
+                                                adapter, self.adapters.locks[adapter]),
+                                          name="visit-{}".format(mac))
+        try:
+            process.start()
+        except Exception:
+            reader.close()
+            raise
+        finally:
+            # the process holds the only writer, recv() sees it exit
+            writer.close()
+        return process, loop.run_in_executor(self._waiters, _wait_visit, process, reader)
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        manager = SyncManager()
+        manager.start(_sync_manager_init)
+        # one thread per running visit waits for its process
+        self._waiters = ThreadPoolExecutor(max_workers=self.max_process)
+        main = loop.create_task(self._main(loop, manager))
+        try:
+            loop.run_until_complete(main)
+        except (KeyboardInterrupt, SystemExit):
+            self.log_print("Cancelling downloads, waiting for all devices to clean up....")
+            self._stopping = True
+            main.cancel()
+            for stop_event in list(self._stop_events.values()):
+                stop_event.set()
+            if self._tasks:
+                loop.run_until_complete(asyncio.wait(list(self._tasks), timeout=60))
+            for task in self._tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(main, *self._tasks, return_exceptions=True))
+        finally:
+            for process in self._cancelled:
+                process.join(self.stop_grace)
+                if process.is_alive():
+                    process.kill()
+            self._waiters.shutdown(wait=True)
+            manager.shutdown()
+            loop.close()
+            self.log_print("Serviced {} devices ({} timed out, {} terminated, {} killed), "
+                           "{:.1f} devices/hour".format(self.serviced, self.timed_out, self.terminated,
+                                                        self.killed, self.devices_per_hour))
+
+    async def _main(self, loop, manager):
+        self.started = time.time()
+        queue = asyncio.PriorityQueue()
+        for mac in self.dev_macs:
+            queue.put_nowait((self.last_checked[mac], mac))
+        slots = asyncio.Semaphore(self.max_process)
+        while not self._stopping:
+            await slots.acquire()
+            last_checked, mac = await self._next_device(queue)
+            adapter = self.adapters.choose(mac)
+            self.adapters.acquire(adapter)
+            task = loop.create_task(self._service(loop, manager, queue, slots, mac, last_checked, adapter))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _next_device(self, queue):
+        if self.presence is None:
+            return await queue.get()
+        while True:
+            waiting = [await queue.get()]
+            while not queue.empty():
+                waiting.append(queue.get_nowait())
+            backlogs = None
+            if self.state_store is not None:
+                backlogs = dict((mac, state['backlog']) for mac, state in self.state_store.all().items())
+            chosen = self.presence.choose(waiting, backlogs)
+            for item in waiting:
+                if item is not chosen:
+                    queue.put_nowait(item)
+            if chosen is not None:
+                sighting = self.presence.get(chosen[1])
+                if sighting is not None and sighting.adapter is not None:
+                    self.adapters.seen(chosen[1], sighting.adapter, sighting.rssi)
+                return chosen
+            await asyncio.sleep(self.presence_poll)
+
+    async def _stop_visit(self, mac, process, future, adapter):
+        """Terminate the process of a visit that did not stop, kill it if it
+        does not exit either
+        """
+        self.log_print("Device {} did not stop within {} s, terminating its process".format(
+            mac, self.stop_grace))
+        self.terminated += 1
+        process.terminate()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.stop_grace)
+        except asyncio.TimeoutError:
+            self.log_print("Device {} did not exit within {} s, killing its process".format(
+                mac, self.stop_grace))
+            self.killed += 1
+            process.kill()
+            # it may have died holding the lock of its adapter
+            self.adapters.reset_locks(adapter)
+            return await future
+
+    async def _service(self, loop, manager, queue, slots, mac, last_checked, adapter):
+        stop_event = manager.Event()
+        self._stop_events[mac] = stop_event
+        log_file = os.path.join(self.log_dir, "log_%s.log" % mac.replace(':', ''))
+        process = None
+        result = None
+        timed_out = False
+        try:
+            process, future = self._start_visit(loop, mac, log_file, stop_event, adapter)
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                # ask the download to stop and let the device clean up
+                self.timed_out += 1
+                timed_out = True
+                self.log_print("Device {} timed out after {} s".format(mac, self.timeout))
+                stop_event.set()
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(future), self.stop_grace)
+                except asyncio.TimeoutError:
+                    # stuck before it checks stop_event, e.g. in connect()
+                    result = await self._stop_visit(mac, process, future, adapter)
+        except WorkerDied as e:
+            self.log_print("Process of device {} died ({})".format(mac, str(e)))
+        except Exception as e:
+            self.log_print("Error encountered while running device {}\n {}".format(mac, str(e)))
+        finally:
+            del self._stop_events[mac]
+            if process is not None and process.is_alive():
+                # cancelled, e.g. on KeyboardInterrupt, run() kills it if it
+                #   does not exit
+                process.terminate()
+                self._cancelled.append(process)
+            self.adapters.release(adapter)
+            slots.release()
+
+        new_checked, record = result if result is not None else (None, None)
+        delay = 0
+        try:
+            if result is not None:
+                self.serviced += 1
+            if record is not None:
+                self.adapters.seen(mac, adapter, record['rssi'])
+            if self.telemetry is not None and record is not None:
+                if timed_out:
+                    record['outcome'] = 'timed_out'
+                self.telemetry.devices_per_hour = self.devices_per_hour
+                self.telemetry.add(record)
+
+            if new_checked is None or new_checked == last_checked:
+                self.retries[mac] += 1
+                if self.retries[mac] > self.max_retries:
+                    new_checked = epoch_now()
+                    self.retries[mac] = 0
+                    delay = self.backoff
+                else:
+                    new_checked = last_checked
+            else:
+                self.retries[mac] = 0
+            self.last_checked[mac] = new_checked
+            if self.state_store is not None:
+                self.state_store.update(mac, last_checked=new_checked, retries=self.retries[mac])
+        except Exception as e:
+            self.log_print("Error recording the visit of device {}\n {}".format(mac, str(e)))
+        finally:
+            # a failed update does not drop the device from the queue
+            self._requeue(loop, queue, mac, last_checked if new_checked is None else new_checked, delay)
+
+    def _requeue(self, loop, queue, mac, last_checked, delay):
+        if self._stopping:
+            return
+        if delay > 0:
+            loop.call_later(delay, queue.put_nowait, (last_checked, mac))
+        else:
+            queue.put_nowait((last_checked, mac))
@@ -0,0 +1,263 @@
+from __future__ import print_function
+import os
+import time
+import random
+import struct as st
+import threading
+import yaml
+
+from wed_settings import AmiigoSettings
+from parsers.synthetic import synthetic_stream, split_notifications
+
+# ATT opcode of a handle value notification
+ATT_OP_HANDLE_NOTIFY = 0x1B
+NOTIFY_HANDLE = 0x0022
+
+DEFAULT_DEVICE = {
+    'name': 'Wavelet',
+    'total_logs': 20000,        # accelerometer samples waiting on the device
+    'battery': 90,
+    'mode': 0,                  # 0 slow, 1 fast, 2 sleep
+    'sample_periods': [20, 10, 1000],   # ms, per mode
+    'reboots': 0,
+    'rate': 0,                  # notifications per second, 0 for unlimited
+    'loss': 0.0,                # probability of losing a notification
+    'disconnect': 0.0,          # probability of a disconnect during a download
+    'in_range': True,
+    'rssi': -60,                # dBm, or a mapping of adapter name to dBm, None when out of its range
+    'connect_time': 0.0,        # seconds to establish a connection
+    'connect_timeout': 0.0,     # seconds a connect to an out of range device takes to fail
+    'seed': None,
+}
+
+_devices = {}
+
+
+def load_config(path=None):
+    """Simulated devices from a yaml file, the path defaults to the
+    WED_SIMULATOR_CONFIG environment variable
+
+    The file has a `defaults` mapping of DEFAULT_DEVICE keys and a `devices`
+    mapping of MAC address to overrides. Devices not listed use the defaults.
+    """
+    path = path or os.environ.get('WED_SIMULATOR_CONFIG')
+    config = {'defaults': {}, 'devices': {}}
+    if path:
+        with open(path, 'r') as f:
+            config.update(yaml.safe_load(f) or {})
+    return config
+
+
+def get_device(mac_address):
+    """SimulatedDevice of a MAC address, shared by all requesters of a process
+    """
+    mac_address = mac_address.upper()
+    device = _devices.get(mac_address)
+    if device is None:
+        config = load_config()
+        settings = dict(DEFAULT_DEVICE)
+        settings.update(config.get('defaults') or {})
+        settings.update((config.get('devices') or {}).get(mac_address) or {})
+        device = SimulatedDevice(mac_address, **settings)
+        _devices[mac_address] = device
+    return device
+
+
+class SimulatedDevice(object):
+    """Flash contents and radio behaviour of one simulated Wavelet
+    """
+
+    def __init__(self, mac_address, **settings):
+        self.mac_address = mac_address
+        self.settings = AmiigoSettings()
+        for k, v in DEFAULT_DEVICE.items():
+            setattr(self, k, settings.get(k, v))
+        if self.seed is None:
+            self.seed = int(mac_address.replace(':', ''), 16) & 0xFFFF
+        self._streams = {}
+        self._total_logs = None
+
+    @property
+    def sample_period(self):
+        return self.sample_periods[self.mode]
+
+    def rssi_on(self, adapter):
+        """Signal strength seen by an adapter, None if out of its range
+        """
+        if not self.in_range:
+            return None
+        if isinstance(self.rssi, dict):
+            return self.rssi.get(adapter)
+        return self.rssi
+
+    def stream(self, compressed):
+        """Logs stored on the device, ending with a WED_LOG_COUNT packet
+        """
+        stream = self._streams.get(compressed)
+        if stream is None:
+            stream = synthetic_stream(self.total_logs, compressed=compressed,
+                                      sample_period=self.sample_period, seed=self.seed)
+            self._streams[compressed] = stream
+        return stream
+
+    def notifications(self, compressed):
+        key = ('notifications', compressed)
+        payloads = self._streams.get(key)
+        if payloads is None:
+            payloads = split_notifications(self.stream(compressed))
+            self._streams[key] = payloads
+        return payloads
+
+    def status(self):
+        mode_flags = {0: 0, 1: 0x02, 2: 0x10}[self.mode]
+        # the log count packet is added to the stream when downloading, raw
+        #   and compressed streams hold the same number of logs
+        if self._total_logs is None:
+            from cutils.sensors.converter import get_log_stats
+            self._total_logs = get_log_stats(self.stream(True))[0] - 1
+        return st.pack(self.settings.status_pattern, self._total_logs, self.battery, mode_flags, 0, 0, self.reboots)
+
+    def config(self):
+        periods = [p // 10 for p in self.sample_periods]
+        return st.pack(self.settings.config_pattern, 0, periods[0], 0, periods[1], 0, periods[2], 0, 0, 0, 0)
+
+
+class GATTRequester(object):
+    """Pure Python stand-in for gattlib.GATTRequester backed by a
+    SimulatedDevice, notifications are delivered from a streaming thread
+    """
+
+    def __init__(self, address, do_connect=True, device='hci0', *args):
+        self.address = address
+        self.adapter = device
+        self.device = get_device(address)
+        self._connected = False
+        self._streaming = threading.Event()
+        self._thread = None
+        self._random = random.Random(self.device.seed)
+        # next notification to send, a stopped broadcast resumes from there
+        self.position = 0
+        self.notifications = 0
+        self.lost = 0
+        self.bytes_sent = 0
+        self.stream_cpu = 0.0
+        self.first_sent = None
+        self.last_sent = None
+        if do_connect:
+            self.connect()
+
+    @property
+    def rssi(self):
+        return self.device.rssi_on(self.adapter)
+
+    def connect(self, wait=False, channel_type=None, security_level=None, *args):
+        if self.rssi is None:
+            if self.device.connect_timeout:
+                time.sleep(self.device.connect_timeout)
+            raise RuntimeError("Channel or attrib not ready")
+        if self.device.connect_time:
+            time.sleep(self.device.connect_time)
+        self._connected = True
+
+    def is_connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._stop_stream()
+        self._connected = False
+
+    def _check_connected(self):
+        if not self._connected:
+            raise RuntimeError("Not connected")
+
+    def read_by_handle(self, handle):
+        self._check_connected()
+        settings = self.device.settings
+        if handle == settings.status_handle:
+            return [self.device.status()]
+        if handle == settings.config_handle:
+            return [self.device.config()]
+        raise RuntimeError("Invalid handle 0x{:04x}".format(handle))
+
+    def write_by_handle(self, handle, data):
+        self._check_connected()
+        settings = self.device.settings
+        if handle != settings.config_handle:
+            raise RuntimeError("Invalid handle 0x{:04x}".format(handle))
+        if len(data) == st.calcsize(settings.download_pattern):
+            command, log_bit = st.unpack(settings.download_pattern, data)
+            if command == 6:
+                self._stop_stream()
+                if log_bit:
+                    self._start_stream(compressed=bool(log_bit & 0x02))
+        return []
+
+    def on_notification(self, handle, data):
+        pass
+
+    def _start_stream(self, compressed):
+        self._streaming.set()
+        self._thread = threading.Thread(target=self._stream, args=(compressed,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop_stream(self):
+        self._streaming.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _stream(self, compressed):
+        cpu_start = time.thread_time()
+        device = self.device
+        header = st.pack('<BH', ATT_OP_HANDLE_NOTIFY, NOTIFY_HANDLE)
+        payloads = device.notifications(compressed)
+        disconnect_at = -1
+        if self.position < len(payloads) and self._random.random() < device.disconnect:
+            disconnect_at = self._random.randrange(self.position, len(payloads))
+        first = self.position
+        start = time.time()
+        while self.position < len(payloads) and self._streaming.is_set():
+            if self.position == disconnect_at:
+                self._connected = False
+                break
+            if device.rate:
+                ahead = start + (self.position - first) / float(device.rate) - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+            payload = payloads[self.position]
+            self.position += 1
+            if device.loss and self._random.random() < device.loss:
+                self.lost += 1
+                continue
+            self.notifications += 1
+            self.bytes_sent += len(payload)
+            if self.first_sent is None:
+                self.first_sent = time.time()
+            self.on_notification(NOTIFY_HANDLE, header + payload)
+            self.last_sent = time.time()
+        self.stream_cpu += time.thread_time() - cpu_start
+
+
+class DiscoveryService(object):
+    """Stand-in for gattlib.DiscoveryService listing the simulated devices in
+    range, those of the config file
+    """
+
+    def __init__(self, device='hci0'):
+        self.device = device
+
+    def discover(self, timeout=5):
+        return dict((mac, name) for mac, (name, rssi) in self.discover_rssi(timeout).items())
+
+    def discover_rssi(self, timeout=5):
+        """Same as discover() with the signal strength, {mac: (name, rssi)}
+        """
+        config = load_config()
+        found = {}
+        for mac_address in (config.get('devices') or {}):
+            device = get_device(mac_address)
+            rssi = device.rssi_on(self.device)
+            if rssi is not None:
+                found[device.mac_address] = (device.name, rssi)
+        return found
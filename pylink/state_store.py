@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+
+FIELDS = ('last_checked', 'last_download', 'backlog', 'retries', 'battery', 'last_error', 'last_error_time')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    mac TEXT PRIMARY KEY,
+    last_checked REAL NOT NULL DEFAULT 0,
+    last_download REAL,
+    backlog INTEGER,
+    retries INTEGER NOT NULL DEFAULT 0,
+    battery INTEGER,
+    last_error TEXT,
+    last_error_time REAL,
+    updated REAL
+)
+"""
+
+
+class DeviceStateStore(object):
+    """Scheduling state of every device in a local SQLite database
+
+    Keeps per MAC address the last_checked epoch the schedulers order the
+    queue by, the time of the last successful download, the estimated log
+    backlog, the failed visits in a row, the battery level and the last error.
+    The database is in WAL mode so the scheduler and the device processes
+    read and write it concurrently. The store can be passed to other
+    processes, each one opens its own connection on first use.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        """
+        :param path:     database file, created if missing
+        :param timeout:  seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['timeout'])
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def get(self, mac_address):
+        """Return the state of a device as a dict, None if never seen
+        """
+        row = self.conn.execute("SELECT * FROM devices WHERE mac = ?", (mac_address,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def all(self):
+        """Return the state of every device keyed by MAC address
+        """
+        return dict((row['mac'], dict(row)) for row in self.conn.execute("SELECT * FROM devices"))
+
+    def last_checked(self, mac_address):
+        row = self.conn.execute("SELECT last_checked FROM devices WHERE mac = ?", (mac_address,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def update(self, mac_address, **fields):
+        """Set some FIELDS of a device, adding it if missing
+        """
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError("Unknown device state field {}".format(field))
+        if 'last_error' in fields and 'last_error_time' not in fields:
+            fields['last_error_time'] = time.time()
+        names = sorted(fields)
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO devices (mac) VALUES (?)", (mac_address,))
+            conn.execute("UPDATE devices SET {}, updated = ? WHERE mac = ?".format(
+                ', '.join('{} = ?'.format(name) for name in names)),
+                [fields[name] for name in names] + [time.time(), mac_address])
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def queue(self, dev_macs):
+        """Return (last_checked, mac) of the devices, stalest first, the
+        order a restarted scheduler resumes in
+        """
+        states = self.all()
+        return sorted(((states[mac]['last_checked'] if mac in states else 0), mac) for mac in dev_macs)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import bisect
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the notification inter-arrival histogram buckets
+INTERVAL_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+OUTCOMES = ('complete', 'interrupted', 'timed_out', 'error', 'skipped')
+
+
+class SessionTelemetry(object):
+    """Measurements of one device session
+
+    notification() runs on the BLE callback thread for every notification,
+    it only takes the time and bumps counters.
+    """
+
+    def __init__(self, mac_address, adapter=None):
+        self.mac_address = mac_address
+        self.adapter = adapter
+        self.rssi = None
+        self.started = time.time()
+        self.ended = None
+        self.outcome = 'skipped'
+        self.connect_seconds = None
+        self.lock_wait = 0.0
+        self.lock_hold = 0.0
+        self.lock_count = 0
+        self.download_started = None
+        self.download_ended = None
+        self.notifications = 0
+        self.bytes = 0
+        self.logs = 0
+        self.interval_counts = [0] * (len(INTERVAL_BUCKETS) + 1)
+        self.interval_sum = 0.0
+        self._last_notification = None
+
+    @contextmanager
+    def locked(self, lock):
+        """Hold lock, timing the wait for it and how long it was held
+        """
+        start = time.time()
+        lock.acquire()
+        acquired = time.time()
+        try:
+            yield
+        finally:
+            lock.release()
+            self.lock_wait += acquired - start
+            self.lock_hold += time.time() - acquired
+            self.lock_count += 1
+
+    def notification(self, n_bytes):
+        now = time.time()
+        if self._last_notification is not None:
+            interval = now - self._last_notification
+            self.interval_counts[bisect.bisect_left(INTERVAL_BUCKETS, interval)] += 1
+            self.interval_sum += interval
+        self._last_notification = now
+        self.notifications += 1
+        self.bytes += n_bytes
+
+    def start_download(self):
+        self.download_started = time.time()
+
+    def end_download(self, outcome, logs):
+        self.download_ended = time.time()
+        self.outcome = outcome
+        self.logs = logs
+
+    def end(self):
+        self.ended = time.time()
+
+    def as_dict(self):
+        download_seconds = None
+        if self.download_started is not None and self.download_ended is not None:
+            download_seconds = self.download_ended - self.download_started
+        return {'mac_address': self.mac_address,
+                'adapter': self.adapter,
+                'rssi': self.rssi,
+                'started': self.started,
+                'duration': (self.ended or time.time()) - self.started,
+                'outcome': self.outcome,
+                'connect_seconds': self.connect_seconds,
+                'lock_wait_seconds': self.lock_wait,
+                'lock_hold_seconds': self.lock_hold,
+                'lock_acquisitions': self.lock_count,
+                'download_seconds': download_seconds,
+                'notifications': self.notifications,
+                'bytes': self.bytes,
+                'logs': self.logs,
+                'bytes_per_second': self.bytes / download_seconds if download_seconds else None,
+                'logs_per_second': self.logs / download_seconds if download_seconds else None,
+                'notification_interval': {'buckets': list(INTERVAL_BUCKETS),
+                                          'counts': list(self.interval_counts),
+                                          'sum': self.interval_sum},
+                }
+
+
+class FleetTelemetry(object):
+    """Aggregate session records of all devices serviced by a scheduler
+
+    Every record is appended to a JSON lines file, the totals are written
+    to a Prometheus textfile (node_exporter textfile collector format).
+    """
+
+    def __init__(self, json_file=None, prom_file=None):
+        """
+        :param json_file:  JSON lines file the session records are appended to
+        :param prom_file:  Prometheus textfile rewritten after every session
+        """
+        self.json_file = json_file
+        self.prom_file = prom_file
+        self.sessions = dict((o, 0) for o in OUTCOMES)
+        self.bytes = 0
+        self.logs = 0
+        self.notifications = 0
+        self.session_seconds = 0.0
+        self.connect_seconds = 0.0
+        self.connects = 0
+        self.lock_wait = 0.0
+        self.lock_hold = 0.0
+        self.lock_count = 0
+        self.interval_counts = [0] * (len(INTERVAL_BUCKETS) + 1)
+        self.interval_sum = 0.0
+        self.devices = {}
+        self.adapters = {}
+        self.devices_per_hour = 0.0
+
+    def add(self, record):
+        """Aggregate a SessionTelemetry.as_dict() record and export it
+        """
+        self.sessions[record['outcome']] = self.sessions.get(record['outcome'], 0) + 1
+        self.bytes += record['bytes']
+        self.logs += record['logs']
+        self.notifications += record['notifications']
+        self.session_seconds += record['duration']
+        if record['connect_seconds'] is not None:
+            self.connect_seconds += record['connect_seconds']
+            self.connects += 1
+        self.lock_wait += record['lock_wait_seconds']
+        self.lock_hold += record['lock_hold_seconds']
+        self.lock_count += record['lock_acquisitions']
+        for i, count in enumerate(record['notification_interval']['counts']):
+            self.interval_counts[i] += count
+        self.interval_sum += record['notification_interval']['sum']
+        self.devices[record['mac_address']] = record
+        adapter = self.adapters.setdefault(record.get('adapter'), {'sessions': 0, 'bytes': 0, 'lock_wait': 0.0})
+        adapter['sessions'] += 1
+        adapter['bytes'] += record['bytes']
+        adapter['lock_wait'] += record['lock_wait_seconds']
+
+        if self.json_file:
+            with open(self.json_file, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.write_prometheus()
+
+    def prometheus_text(self):
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if label_text else '',
+                                                repr(float(value)) if isinstance(value, float) else value))
+
+        metric('wed_sessions_total', 'counter', 'Device sessions by outcome',
+               [('', [('outcome', o)], n) for o, n in sorted(self.sessions.items())])
+        metric('wed_download_bytes_total', 'counter', 'Log bytes received', [('', [], self.bytes)])
+        metric('wed_download_logs_total', 'counter', 'Logs received', [('', [], self.logs)])
+        metric('wed_notifications_total', 'counter', 'Notifications received', [('', [], self.notifications)])
+        metric('wed_session_seconds', 'summary', 'Time spent in device sessions',
+               [('_sum', [], self.session_seconds), ('_count', [], sum(self.sessions.values()))])
+        metric('wed_connect_seconds', 'summary', 'Connect latency',
+               [('_sum', [], self.connect_seconds), ('_count', [], self.connects)])
+        metric('wed_backend_lock_wait_seconds', 'summary', 'Time spent waiting for the backend lock',
+               [('_sum', [], self.lock_wait), ('_count', [], self.lock_count)])
+        metric('wed_backend_lock_hold_seconds', 'summary', 'Time the backend lock was held',
+               [('_sum', [], self.lock_hold), ('_count', [], self.lock_count)])
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(INTERVAL_BUCKETS, self.interval_counts):
+            cumulative += count
+            buckets.append(('_bucket', [('le', repr(bound))], cumulative))
+        cumulative += self.interval_counts[-1]
+        buckets.append(('_bucket', [('le', '+Inf')], cumulative))
+        buckets.append(('_sum', [], self.interval_sum))
+        buckets.append(('_count', [], cumulative))
+        metric('wed_notification_interval_seconds', 'histogram', 'Time between notifications', buckets)
+        metric('wed_devices_per_hour', 'gauge', 'Devices serviced per hour by the scheduler',
+               [('', [], self.devices_per_hour)])
+        adapters = sorted(a for a in self.adapters if a is not None)
+        metric('wed_adapter_sessions_total', 'counter', 'Device sessions by adapter',
+               [('', [('adapter', a)], self.adapters[a]['sessions']) for a in adapters])
+        metric('wed_adapter_bytes_total', 'counter', 'Log bytes received by adapter',
+               [('', [('adapter', a)], self.adapters[a]['bytes']) for a in adapters])
+        metric('wed_adapter_lock_wait_seconds_total', 'counter', 'Time spent waiting for the lock of each adapter',
+               [('', [('adapter', a)], self.adapters[a]['lock_wait']) for a in adapters])
+        macs = sorted(self.devices)
+        metric('wed_device_bytes_per_second', 'gauge', 'Download rate of the last session of each device',
+               [('', [('mac', m)], self.devices[m]['bytes_per_second'] or 0.0) for m in macs])
+        metric('wed_device_connect_seconds', 'gauge', 'Connect latency of the last session of each device',
+               [('', [('mac', m)], self.devices[m]['connect_seconds'] or 0.0) for m in macs])
+        metric('wed_device_last_session_timestamp_seconds', 'gauge', 'Start of the last session of each device',
+               [('', [('mac', m)], self.devices[m]['started']) for m in macs])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        if not self.prom_file:
+            return
+        # atomic so the collector never reads a partial file
+        tmp_file = self.prom_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.prometheus_text())
+        os.rename(tmp_file, self.prom_file)
@@ -0,0 +1,59 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+
+from parsers.export import export_data_file, DEFAULT_MAX_MEMORY
+from parsers.batch import convert_directory, export_path
+
+
+def print_report(report):
+    if report['error']:
+        print("Failed {} after {:.1f} s\n{}".format(report['file'], report['seconds'], report['error']))
+    else:
+        print("Exported {} samples of {} in {:.1f} s".format(report['samples'], report['file'], report['seconds']))
+    sys.stdout.flush()
+
+
+def main():
+    description = "Export Wavelet data files to Parquet or HDF5"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('files', help="Data files to export", nargs='*')
+    parser.add_argument('--dir', dest='data_dir', help="Export all data files of a directory in parallel")
+    parser.add_argument('--out', dest='out', help="Output directory", default='./export/')
+    parser.add_argument('--format', dest='fmt', help="Output format", choices=['parquet', 'hdf5'], default='parquet')
+    parser.add_argument('--jobs', dest='jobs', help="Number of parallel workers for --dir", type=int)
+    parser.add_argument('--threads', dest='threads', help="Use threads instead of processes for --dir",
+                        action='store_true')
+    parser.add_argument('--max-memory', dest='max_memory', help="Memory ceiling in MB for decoded data (per worker)",
+                        type=int, default=DEFAULT_MAX_MEMORY // (1024 * 1024))
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        return
+
+    options = parser.parse_args()
+    max_memory = options.max_memory * 1024 * 1024
+
+    if options.data_dir:
+        start = time.time()
+        reports = convert_directory(options.data_dir, options.out, fmt=options.fmt, workers=options.jobs,
+                                    threads=options.threads, max_memory=max_memory, callback=print_report)
+        failed = len([r for r in reports if r['error']])
+        print("Converted {} files ({} failed) in {:.1f} s".format(len(reports) - failed, failed, time.time() - start))
+        return
+
+    if not os.path.isdir(options.out):
+        os.makedirs(options.out)
+    for fname in options.files:
+        out = export_path(fname, options.out, options.fmt)
+        print("Exporting {} to {} ....".format(fname, out))
+        sys.stdout.flush()
+        start = time.time()
+        samples = export_data_file(fname, out, fmt=options.fmt, max_memory=max_memory)
+        print("Exported {} samples in {:.1f} s".format(samples, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,10 @@ from datetime import datetime
 from multiprocessing import Process, Lock, Event
 from multiprocessing.managers import SyncManager
 from wed_settings import Commands
+from writer import DEFAULT_BUFFER_SIZE, DEFAULT_FLUSH_INTERVAL
+from parsers.container import DEFAULT_CHUNK_SIZE
+from adapters import AdapterPool, parse_adapters, DEFAULT_ADAPTER
+from presence import DEFAULT_TTL, DEFAULT_SCAN_SECONDS, DEFAULT_SCAN_INTERVAL
 
 backend_lock = Lock()
 
@@ -37,58 +41,153 @@ def sync_manager_init():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def start_pool(config_file):
-    manager = SyncManager()
-    manager.start(sync_manager_init)
-    status_dict = manager.dict()
-    pr_queue = PriorityQueue()
+def load_pool_options(config_file):
     with open(config_file, 'r') as f:
         options = yaml.load(f)
 
     dev_macs = options.get('devices', None)
     if not dev_macs:
-        print("No device found in the config file")
-        return
-
+        return None
     for dev_mac in dev_macs:
         if not is_mac_valid(dev_mac):
             raise ValueError("{} is not a valid MAC address!".format(dev_mac))
-        pr_queue.put_nowait((0, dev_mac))
-        status_dict[dev_mac] = 0
 
-    battery_warn = options.get('battery_warn', 0) or 20
-    log_dir = options.get('log_dir', 0) or './logs/'
     data_dir = options.get('data_dir', 0) or './data/'
+    log_dir = options.get('log_dir', 0) or './logs/'
     max_process = options.get('max_process', 0) or 3
-    raw = options.get('raw', False)
-    fname = os.path.join(data_dir, options.get('data_prefix', 'WED_data'))
-    min_logs = options.get('min_logs', 1000)
-
-    common_kwargs = {'command': Commands.DOWNLOAD,
-                     'backend_lock': backend_lock,
-                     'fname': fname,
-                     'battery_warn': battery_warn,
-                     'raw': raw,
-                     'status_dict': status_dict,
-                     'min_logs': min_logs,
+    return {'devices': dev_macs,
+            'scheduler': options.get('scheduler', 0) or 'async',
+            'log_dir': log_dir,
+            'metrics_json': options.get('metrics_json', os.path.join(log_dir, 'telemetry.jsonl')),
+            'metrics_textfile': options.get('metrics_textfile', None),
+            'state_db': options.get('state_db', 0) or os.path.join(log_dir, 'wed_state.db'),
+            'adapters': parse_adapters(options.get('adapters', None), max_process),
+            'start_method': options.get('start_method', 0) or 'forkserver',
+            'presence_ttl': options.get('presence_ttl', DEFAULT_TTL),
+            'scan_seconds': options.get('scan_seconds', 0) or DEFAULT_SCAN_SECONDS,
+            'scan_interval': options.get('scan_interval', 0) or DEFAULT_SCAN_INTERVAL,
+            'timeout': options.get('timeout', 0) or 900,
+            'stop_grace': options.get('stop_grace', 0) or 60,
+            'max_retries': options.get('max_retries', 3),
+            'backoff': options.get('backoff', 0),
+            'device_kwargs': {'command': Commands.DOWNLOAD,
+                              'fname': os.path.join(data_dir, options.get('data_prefix', 'WED_data')),
+                              'battery_warn': options.get('battery_warn', 0) or 20,
+                              'raw': options.get('raw', False),
+                              'min_logs': options.get('min_logs', 1000),
+                              'write_buffer': options.get('write_buffer', 0) or DEFAULT_BUFFER_SIZE,
+                              'flush_interval': options.get('flush_interval', 0) or DEFAULT_FLUSH_INTERVAL,
+                              'fsync_interval': options.get('fsync_interval', None),
+                              'data_format': options.get('data_format', 0) or 1,
+                              'chunk_size': options.get('chunk_size', 0) or DEFAULT_CHUNK_SIZE,
+                              },
+            }
+
+
+def fleet_telemetry(pool_options):
+    from telemetry import FleetTelemetry
+    return FleetTelemetry(json_file=pool_options['metrics_json'], prom_file=pool_options['metrics_textfile'])
+
+
+def device_state_store(pool_options):
+    from state_store import DeviceStateStore
+    return DeviceStateStore(pool_options['state_db'])
+
+
+def presence_scanner(pool_options, adapters):
+    """PresenceCache kept up to date by a BackgroundScanner over all adapters,
+    (None, None) if presence_ttl is 0
+    """
+    if not pool_options['presence_ttl']:
+        return None, None
+    from backend import DiscoveryService
+    from presence import PresenceCache, BackgroundScanner
+    cache = PresenceCache(pool_options['presence_ttl'])
+    scanner = BackgroundScanner(cache, DiscoveryService, adapters.names, adapters.locks,
+                                scan_seconds=pool_options['scan_seconds'],
+                                interval=pool_options['scan_interval'])
+    return cache, scanner
+
+
+def start_pool(config_file):
+    pool_options = load_pool_options(config_file)
+    if pool_options is None:
+        print("No device found in the config file")
+        return
+
+    if pool_options['scheduler'] == 'polling':
+        start_pool_polling(pool_options)
+        return
+
+    from scheduler import FleetScheduler, worker_context
+    context = worker_context(pool_options['start_method'])
+    adapters = AdapterPool(pool_options['adapters'], context.Lock)
+    presence, scanner = presence_scanner(pool_options, adapters)
+    scheduler = FleetScheduler(pool_options['devices'], adapters,
+                               pool_options['log_dir'], pool_options['device_kwargs'],
+                               mp_context=context, presence=presence,
+                               timeout=pool_options['timeout'],
+                               stop_grace=pool_options['stop_grace'],
+                               max_retries=pool_options['max_retries'],
+                               backoff=pool_options['backoff'],
+                               telemetry=fleet_telemetry(pool_options),
+                               state_store=device_state_store(pool_options))
+    if scanner is not None:
+        scanner.start()
+    try:
+        scheduler.run()
+    finally:
+        if scanner is not None:
+            scanner.stop()
+
+
+def start_pool_polling(pool_options):
+    """Legacy scheduler, one new process per device visit polled every 2 s
+    """
+    from scheduler import worker_context
+    context = worker_context(pool_options['start_method'])
+    manager = SyncManager()
+    manager.start(sync_manager_init)
+    telemetry_dict = manager.dict()
+    telemetry = fleet_telemetry(pool_options)
+    state_store = device_state_store(pool_options)
+    pr_queue = PriorityQueue()
+
+    dev_macs = pool_options['devices']
+    for last_checked, dev_mac in state_store.queue(dev_macs):
+        pr_queue.put_nowait((last_checked, dev_mac))
+
+    log_dir = pool_options['log_dir']
+    max_retries = pool_options['max_retries']
+    adapters = AdapterPool(pool_options['adapters'], context.Lock)
+    common_kwargs = {'state_store': state_store,
+                     'telemetry_dict': telemetry_dict,
                      }
+    common_kwargs.update(pool_options['device_kwargs'])
     process_list = []
-    max_process = min(max_process, len(dev_macs))
-    retries = {d: 0 for d in dev_macs}
+    max_process = min(adapters.capacity, len(dev_macs))
+    states = state_store.all()
+    retries = {d: states[d]['retries'] if d in states else 0 for d in dev_macs}
+    started = time.time()
+    serviced = 0
 
     def get_next_process():
         mac_address = pr_queue.get_nowait()[1]
-        stop_event = Event()
-        wake_up = Event()
+        adapter = adapters.choose(mac_address)
+        adapters.acquire(adapter)
+        stop_event = context.Event()
+        wake_up = context.Event()
         log_file = os.path.join(log_dir, "log_%s.log" % mac_address.replace(':', ''))
         kwargs = {'mac_address': mac_address,
                   'log_file': log_file,
                   'wake_up': wake_up,
                   'stop_event': stop_event,
+                  'adapter': adapter,
+                  'backend_lock': adapters.locks[adapter],
                   }
         kwargs.update(common_kwargs)
-        p = Process(target=start_command, kwargs=kwargs)
-        return p, mac_address, status_dict[mac_address], wake_up, stop_event
+        p = context.Process(target=start_command, kwargs=kwargs)
+        return p, mac_address, state_store.last_checked(mac_address), wake_up, stop_event, adapter
 
     for i in range(max_process):
         process_list.append(get_next_process())
@@ -101,14 +200,22 @@ def start_pool(config_file):
             if p[0].is_alive():
                 process_list.append(p)
             else:
-                last_checked = status_dict[p[1]]
+                serviced += 1
+                adapters.release(p[5])
+                record = telemetry_dict.pop(p[1], None)
+                if record is not None:
+                    adapters.seen(p[1], p[5], record['rssi'])
+                    telemetry.devices_per_hour = serviced * 3600.0 / (time.time() - started)
+                    telemetry.add(record)
+                last_checked = state_store.last_checked(p[1])
                 if last_checked == p[2]:
                     retries[p[1]] += 1
-                    if retries[p[1]] > 3:
+                    if retries[p[1]] > max_retries:
                         last_checked = (datetime.now() - datetime(1970, 1, 1)).total_seconds()
                         retries[p[1]] = 0
                 else:
                     retries[p[1]] = 0
+                state_store.update(p[1], last_checked=last_checked, retries=retries[p[1]])
                 pr_queue.put_nowait((last_checked, p[1]))
                 new_process = get_next_process()
                 new_process[0].start()
@@ -121,6 +228,8 @@ def start_pool(config_file):
         time.sleep(delay)
         for p in process_list:
             p[0].terminate()
+        elapsed = time.time() - started
+        print("Serviced {} devices, {:.1f} devices/hour".format(serviced, serviced * 3600.0 / elapsed))
         sys.exit(0)
     except:
         raise
@@ -134,6 +243,7 @@ def is_mac_valid(mac_address):
 def main():
     description = "Wavelet Device Communication Module"
     parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--adapter', dest='adapter', default=DEFAULT_ADAPTER, help="Bluetooth adapter to use, e.g. hci1")
     parser.add_argument('--blink', dest='blink', help="Blink the red LED of the device", action='store_true')
     parser.add_argument('--device', dest='dev_macs', help="MAC address of the device", nargs='+')
     parser.add_argument('--download', dest='download', help="Download device log", action='store_true')
@@ -151,8 +261,8 @@ def main():
     options = parser.parse_args()
 
     if options.discover:
-        from gattlib import DiscoveryService
-        service = DiscoveryService()
+        from backend import DiscoveryService
+        service = DiscoveryService(options.adapter)
         print("Discovering devices nearby...")
         sys.stdout.flush()
         devices = service.discover(2)
@@ -200,6 +310,7 @@ def main():
             kwargs = {'mac_address': dev,
                       'command': command,
                       'backend_lock': backend_lock,
+                      'adapter': options.adapter,
                       'log_file': log_file,
                       'fname': options.fname,
                       'wake_up': wake_up,
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class RingBufferWriter(object):
+    """Write notification payloads to a binary file off the callback thread
+
+    write() copies the payload into a preallocated ring buffer and returns,
+    it never waits for the disk. A writer thread drains the buffer in large
+    batches, hands each batch to on_batch and writes it to the file. A payload
+    that does not fit in the buffer is dropped and counted as an overrun.
+    An exception in on_batch or the file stops the writer thread, it is kept
+    as error and passed to on_error; later payloads are dropped.
+    """
+
+    def __init__(self, f, buffer_size=DEFAULT_BUFFER_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, fsync_interval=None, on_batch=None, on_error=None):
+        """
+        :param f:               file opened in binary mode
+        :param buffer_size:     ring buffer size in bytes
+        :param batch_size:      bytes buffered before the writer thread wakes up
+        :param flush_interval:  seconds between file flushes, the writer thread
+                                also drains the buffer at least this often
+        :param fsync_interval:  seconds between fsyncs, None to never fsync
+        :param on_batch:        called from the writer thread with each batch
+        :param on_error:        called from the writer thread with the exception
+                                that stopped it
+        """
+        self.file = f
+        self.buffer = bytearray(buffer_size)
+        self.batch_size = min(batch_size, buffer_size)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.on_batch = on_batch
+        self.on_error = on_error
+        self.error = None
+
+        self._head = 0
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closing = False
+        self._thread = None
+
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self.high_water = 0
+        self.overruns = 0
+        self.overrun_bytes = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def write(self, data):
+        """Queue a payload, returns False if it was dropped for lack of room
+        """
+        data = memoryview(data)
+        n = len(data)
+        capacity = len(self.buffer)
+        if self.error is not None:
+            return False
+        with self._cond:
+            if n > capacity - self._size:
+                self.overruns += 1
+                self.overrun_bytes += n
+                return False
+            tail = (self._head + self._size) % capacity
+            first = min(n, capacity - tail)
+            self.buffer[tail:tail + first] = data[:first]
+            if first < n:
+                self.buffer[:n - first] = data[first:]
+            self._size += n
+            self.bytes_in += n
+            if self._size > self.high_water:
+                self.high_water = self._size
+            if self._size >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def _take(self):
+        capacity = len(self.buffer)
+        n = self._size
+        end = self._head + n
+        if end <= capacity:
+            batch = bytes(self.buffer[self._head:end])
+        else:
+            batch = bytes(self.buffer[self._head:]) + bytes(self.buffer[:end - capacity])
+        self._head = end % capacity
+        self._size = 0
+        return batch
+
+    def _run(self):
+        try:
+            self._drain()
+        except Exception as e:
+            self.error = e
+            if self.on_error is not None:
+                self.on_error(e)
+
+    def _drain(self):
+        last_flush = last_fsync = time.time()
+        closing = False
+        while not closing:
+            with self._cond:
+                if self._size < self.batch_size and not self._closing:
+                    self._cond.wait(self.flush_interval)
+                closing = self._closing
+                batch = self._take() if self._size else None
+            if batch:
+                if self.on_batch is not None:
+                    self.on_batch(batch)
+                self.file.write(batch)
+                self.bytes_written += len(batch)
+            now = time.time()
+            if closing or now - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = now
+                if self.fsync_interval is not None and (closing or now - last_fsync >= self.fsync_interval):
+                    os.fsync(self.file.fileno())
+                    last_fsync = now
+
+    def close(self):
+        """Drain the buffer and stop the writer thread, the file stays open
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -72,7 +72,15 @@ else:
             return _build_ext.build_ext.run(self)
 
 
-CYTHON_REQUIREMENT = 'Cython==0.19.1'
+features_module = Extension(
+    'cutils.sensors.features',
+    ['cutils/sensors/features.pyx',
+     'cutils/sensors/cmodules/sensor_parse.c',
+     ],
+    include_dirs=include_dirs,
+)
+
+CYTHON_REQUIREMENT = 'Cython>=0.28'
 
 setup(
     name='cutils',
@@ -89,5 +97,6 @@ setup(
     },
     ext_modules=[
         sensor_module,
+        features_module,
     ],
 )
@@ -0,0 +1,129 @@
+import mmap
+import numpy as np
+import pytest
+
+from parsers.synthetic import synthetic_stream
+from cutils.sensors.converter import (decompress_stream, decompress_stream_parallel, decompressed_size, compress_stream,
+                                      StreamDecompressor, _decompress_stream_scalar)
+
+N_SAMPLES = 50000
+
+
+@pytest.fixture(scope='module', params=[0.0, 0.02], ids=['clean', 'lossy'])
+def streams(request):
+    """(compressed, uncompressed) synthetic streams of the same signal, the
+    lossy ones drop different packets
+    """
+    return (synthetic_stream(N_SAMPLES, lost=request.param),
+            synthetic_stream(N_SAMPLES, compressed=False, lost=request.param))
+
+
+def reference(logs):
+    return bytes(decompress_stream(logs)[0])
+
+
+def test_compress_round_trip(streams):
+    compressed, raw = streams
+    out, n_in = compress_stream(raw)
+    assert n_in == len(raw)
+    assert len(out) < len(raw)
+    assert bytes(decompress_stream(out)[0]) == raw
+
+
+def test_decompress_clean_stream():
+    assert bytes(decompress_stream(synthetic_stream(N_SAMPLES))[0]) == \
+        synthetic_stream(N_SAMPLES, compressed=False)
+
+
+def test_batch_matches_scalar(streams):
+    compressed, raw = streams
+    for logs in (compressed, raw):
+        batch = decompress_stream(logs)
+        scalar = _decompress_stream_scalar(logs)
+        assert bytes(batch[0]) == bytes(scalar[0])
+        assert batch[1:] == scalar[1:]
+
+
+@pytest.mark.parametrize('workers', [2, 3, 8])
+def test_parallel_matches_serial(streams, workers):
+    compressed, raw = streams
+    serial = decompress_stream(compressed)
+    parallel = decompress_stream_parallel(compressed, workers=workers, min_segment=1024)
+    assert bytes(parallel[0]) == bytes(serial[0])
+    assert parallel[1:] == serial[1:]
+
+
+def test_parallel_into_buffer(streams):
+    compressed, raw = streams
+    out = bytearray(2 * len(raw))
+    decoded = decompress_stream_parallel(compressed, workers=4, min_segment=1024, out=out)[0]
+    assert bytes(decoded) == reference(compressed)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 20, 31, 64, 1000, 4096])
+def test_feed_matches_whole_stream(streams, chunk_size):
+    compressed, raw = streams
+    decompressor = StreamDecompressor()
+    pieces = [decompressor.feed(compressed[i:i + chunk_size]) for i in range(0, len(compressed), chunk_size)]
+    assert decompressor.pending == 0
+    assert decompressor.bytes_in == len(compressed)
+    assert b''.join(bytes(piece) for piece in pieces) == reference(compressed)
+
+
+def test_feed_random_chunks(streams):
+    compressed, raw = streams
+    rng = np.random.RandomState(0)
+    decompressor = StreamDecompressor()
+    pieces = []
+    offset = 0
+    while offset < len(compressed):
+        size = int(rng.randint(0, 200))
+        pieces.append(bytes(decompressor.feed(compressed[offset:offset + size])))
+        offset += size
+    assert b''.join(pieces) == reference(compressed)
+
+
+def test_stream_over_int_range():
+    # zero pages are not touched, the length check comes first
+    logs = np.zeros(2 ** 31 + 8, dtype=np.uint8)
+    with pytest.raises(OverflowError):
+        decompressed_size(logs)
+    with pytest.raises(OverflowError):
+        StreamDecompressor().feed(logs)
+
+
+@pytest.fixture(params=['bytearray', 'mmap'])
+def buffers(request, streams, tmp_path):
+    """The compressed stream in a writable bytearray or a read-only mmap
+    """
+    compressed, raw = streams
+    if request.param == 'bytearray':
+        yield bytearray(compressed)
+        return
+    path = tmp_path / 'logs.bin'
+    path.write_bytes(compressed)
+    with open(str(path), 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def test_buffers_match_bytes(streams, buffers):
+    compressed, raw = streams
+    expected = reference(compressed)
+    assert decompressed_size(buffers) == len(expected)
+    assert bytes(decompress_stream(buffers)[0]) == expected
+    out = bytearray(len(expected))
+    decoded = decompress_stream(buffers, out=out)[0]
+    assert bytes(decoded) == expected
+    assert bytes(out) == expected
+    decompressor = StreamDecompressor()
+    assert bytes(decompressor.feed(buffers)) == expected
+    assert decompressor.pending == 0
+
+
+def test_out_buffer_too_small(streams, buffers):
+    size = decompressed_size(buffers)
+    with pytest.raises(ValueError):
+        decompress_stream(buffers, out=bytearray(size - 1))
+    with pytest.raises(ValueError):
+        decompress_stream_parallel(buffers, workers=4, min_segment=1024, out=bytearray(size - 1))
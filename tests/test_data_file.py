@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from parsers import data_file as data_file_module
+from parsers.synthetic import synthetic_stream, write_data_file
+from parsers.data_file import WedDataFile
+from cutils.sensors.converter import decompress_stream
+
+
+@pytest.fixture(scope='module', params=[0.0, 0.02], ids=['clean', 'lossy'])
+def stream_file(request, tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('data') / 'WED_data.dat')
+    stream = synthetic_stream(100000, lost=request.param)
+    write_data_file(fname, stream)
+    return fname, stream
+
+
+def test_segments_cover_payload(stream_file, monkeypatch):
+    fname, stream = stream_file
+    monkeypatch.setattr(data_file_module, 'SEGMENT_BYTES', 16 * 1024)
+    monkeypatch.setattr(data_file_module, 'SEGMENT_SPACING', 1024)
+    with WedDataFile(fname) as data_file:
+        segments = data_file.segments()
+    assert len(segments) > 5
+    assert segments[0][0] == 0 and segments[-1][1] == len(stream)
+    assert all(stop == begin for (_, stop), (begin, _) in zip(segments, segments[1:]))
+    assert all(stop - begin <= 16 * 1024 for begin, stop in segments)
+
+
+def test_decompress_in_segments(stream_file, monkeypatch):
+    fname, stream = stream_file
+    expected = bytes(decompress_stream(stream)[0])
+    monkeypatch.setattr(data_file_module, 'SEGMENT_BYTES', 16 * 1024)
+    monkeypatch.setattr(data_file_module, 'SEGMENT_SPACING', 1024)
+    with WedDataFile(fname) as data_file:
+        assert bytes(data_file.decompressed()) == expected
+        out = bytearray(len(expected) + 10)
+        assert bytes(data_file.decompressed(out=out)) == expected
+        with pytest.raises(ValueError):
+            data_file.decompressed(out=bytearray(len(expected) - 1))
@@ -0,0 +1,36 @@
+import struct
+
+import numpy as np
+import pytest
+
+from parsers.synthetic import synthetic_stream, WED_LOG_ACCEL_CMP, CMP_STILL
+from cutils.sensors.converter import decompress_stream
+from cutils.sensors.features import FeatureExtractor, accel_features
+
+N_SAMPLES = 20000
+WINDOW = 250
+
+
+@pytest.fixture(scope='module', params=[0.0, 0.02], ids=['clean', 'lossy'])
+def stream(request):
+    """Compressed stream that starts with STILL packets, before any sample
+    the decoder could repeat
+    """
+    still = b''.join(struct.pack('<BB', WED_LOG_ACCEL_CMP, CMP_STILL | n) for n in (0, 3, 15))
+    return still + synthetic_stream(N_SAMPLES, lost=request.param)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 17, 1000])
+def test_feed_matches_whole_stream(stream, chunk_size):
+    expected = accel_features(stream, WINDOW)
+    extractor = FeatureExtractor(WINDOW)
+    rows = [extractor.feed(stream[i:i + chunk_size]) for i in range(0, len(stream), chunk_size)]
+    rows.append(extractor.flush())
+    assert extractor.pending == 0
+    assert np.array_equal(np.concatenate(rows), expected)
+
+
+def test_ignored_count_matches_decoder(stream):
+    extractor = FeatureExtractor(WINDOW)
+    extractor.feed(stream)
+    assert extractor.ignored_cmp_count == decompress_stream(stream)[2] == 3
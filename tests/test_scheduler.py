@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import signal
+import threading
+
+import pytest
+
+PYLINK = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'pylink')
+if PYLINK not in sys.path:
+    sys.path.insert(0, PYLINK)
+
+HUNG = "AA:00:00:00:00:01"
+HEALTHY = "AA:00:00:00:00:02"
+
+
+@pytest.fixture
+def simulated(tmp_path, monkeypatch):
+    """Simulated backend with a device that hangs in connect, set before the
+    fork server starts so the visits inherit it
+    """
+    config = tmp_path / 'simulator.yaml'
+    config.write_text(u'defaults: {total_logs: 2000, rssi: {hci0: -50, hci1: -50}}\n'
+                      u'devices:\n'
+                      u'  "%s": {connect_time: 300}\n' % HUNG)
+    monkeypatch.setenv('WED_BACKEND', 'simulated')
+    monkeypatch.setenv('WED_SIMULATOR_CONFIG', str(config))
+    return tmp_path
+
+
+def test_hung_visit_does_not_stop_others(simulated):
+    from adapters import AdapterPool, parse_adapters
+    from devices import Commands
+    from scheduler import FleetScheduler, worker_context
+    from telemetry import FleetTelemetry
+
+    context = worker_context('forkserver')
+    adapters = AdapterPool(parse_adapters(['hci0', 'hci1'], 1), context.Lock)
+    json_file = str(simulated / 'sessions.json')
+    scheduler = FleetScheduler([HUNG, HEALTHY], adapters, str(simulated),
+                               {'command': Commands.DOWNLOAD, 'fname': str(simulated / 'data'), 'min_logs': 10},
+                               timeout=4, stop_grace=1, max_retries=100, mp_context=context,
+                               telemetry=FleetTelemetry(json_file=json_file),
+                               log_stream=open(os.devnull, 'w'))
+    timer = threading.Timer(10, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    try:
+        scheduler.run()
+    finally:
+        timer.cancel()
+
+    with open(json_file) as f:
+        records = [json.loads(line) for line in f]
+    outcomes = dict((mac, [r['outcome'] for r in records if r['mac_address'] == mac]) for mac in (HUNG, HEALTHY))
+    assert scheduler.terminated >= 1
+    assert scheduler.killed == 0
+    # the terminated visits recorded their sessions
+    assert 'timed_out' in outcomes[HUNG]
+    assert 'complete' in outcomes[HEALTHY]
+    assert scheduler.last_checked[HEALTHY] > 0
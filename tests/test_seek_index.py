@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pytest
+
+from parsers.synthetic import synthetic_stream, write_data_file
+from parsers.data_file import convert_data_file
+from parsers.log_parse import stamp_log_file
+from parsers.seek_index import SeekIndex
+
+
+@pytest.fixture(scope='module', params=[1, 2], ids=['v1', 'v2'])
+def data_file(request, tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('seek') / 'WED_data.dat')
+    write_data_file(fname, synthetic_stream(200000, lost=0.02))
+    if request.param == 2:
+        convert_data_file(fname, fname + '.v2')
+        fname += '.v2'
+    return fname
+
+
+def test_read_range_is_inclusive(data_file):
+    full = stamp_log_file(data_file, cache=False)
+    index = SeekIndex.build(data_file, spacing=4096)
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        a, b = sorted(rng.randint(0, len(full), 2))
+        start, end = full.index[a], full.index[b]
+        expected = full[(full.index >= start) & (full.index <= end)]
+        assert index.read_range(start, end).equals(expected)
+
+
+def test_read_range_between_samples(data_file):
+    full = stamp_log_file(data_file, cache=False)
+    index = SeekIndex.build(data_file, spacing=4096)
+    start = full.index[1000] + np.timedelta64(1, 'ms')
+    end = full.index[2000] - np.timedelta64(1, 'ms')
+    assert index.read_range(start, end).equals(full.iloc[1001:2000])
+    assert len(index.read_range(end, start)) == 0